@@ -6,6 +6,7 @@ import numpy as np
 
 # my packages
 from deeptools import writeBedGraph
+from deeptools import mapReduce
 from deeptools.SES_scaleFactor import estimateScaleFactor
 from deeptools import parserCommon
 from deeptools import bamHandler
@@ -304,6 +305,9 @@ def main(args=None):
 
     """
     args = process_args(args)
+    # the worker processes are forked once and reused by all steps of the tool,
+    # each of them opens the input files once
+    mapReduce.startPool(args.numberOfProcessors, bamHandler.openHandles, ([args.bamfile1, args.bamfile2],))
 
     scale_factors = get_scale_factors(args)
     if args.verbose:
@@ -335,6 +339,7 @@ def main(args=None):
                                      )
 
     wr.run(FUNC, func_args, args.outFileName, blackListFileName=args.blackListFileName, format=args.outFileFormat, smoothLength=args.smoothLength)
+    mapReduce.closePool()
 
 if __name__ == "__main__":
     main()
@@ -3,11 +3,14 @@
 
 # own tools
 import argparse
+import copy
 import sys
 import numpy as np
 from deeptools import writeBedGraph  # This should be made directly into a bigWig
+from deeptools import mapReduce
+from deeptools import bamHandler
 from deeptools import parserCommon
-from deeptools.getScaleFactor import get_scale_factor
+from deeptools.getScaleFactor import get_scale_factor, get_num_kept_reads
 
 debug = 0
 
@@ -104,6 +107,20 @@ def get_optional_args():
                           choices=['forward', 'reverse'],
                           default=None)
 
+    optional.add_argument('--extraOutput',
+                          help='Writes a further coverage file from the same pass over the BAM '
+                          'file, which is faster than running bamCoverage once per file. The '
+                          'file name can be followed by KEY=VALUE settings of the file: binSize, '
+                          'outFileFormat, normalizeUsingRPKM (yes or no) and normalizeTo1x (the '
+                          'effective genome size or 0 for no normalization to 1x). The settings '
+                          'not given are those of the main output file. This option can be used '
+                          'several times, e.g. --extraOutput coverage_1kb.bw binSize=1000 '
+                          'normalizeUsingRPKM=yes --extraOutput coverage.bedgraph '
+                          'outFileFormat=bedgraph. It can not be combined with --smoothLength.',
+                          metavar='FILENAME [KEY=VALUE ...]',
+                          nargs='+',
+                          action='append')
+
     return parser
 
 
@@ -119,6 +136,49 @@ def scaleFactor(string):
     return scalefactors
 
 
+def extraOutput(spec, args):
+    """
+    Returns a copy of the arguments with the file name and settings
+    given to --extraOutput.
+
+    >>> args = argparse.Namespace(binSize=50, outFileFormat='bigwig', scaleFactor=1.0,
+    ...                           normalizeUsingRPKM=True, normalizeTo1x=None)
+    >>> out = extraOutput(['cov.bg', 'binSize=10', 'outFileFormat=bedgraph', 'normalizeTo1x=1000'], args)
+    >>> out.outFileName, out.binSize, out.outFileFormat, out.normalizeUsingRPKM, out.normalizeTo1x
+    ('cov.bg', 10, 'bedgraph', False, 1000)
+    """
+    out = copy.copy(args)
+    out.outFileName = parserCommon.writableFile(spec[0])
+    for setting in spec[1:]:
+        key, _, value = setting.partition("=")
+        try:
+            if key == 'binSize':
+                out.binSize = int(value)
+                if out.binSize < 1:
+                    raise ValueError
+            elif key == 'outFileFormat':
+                if value not in ('bigwig', 'bedgraph'):
+                    raise ValueError
+                out.outFileFormat = value
+            elif key == 'normalizeUsingRPKM':
+                out.normalizeUsingRPKM = {'yes': True, 'no': False}[value]
+                if out.normalizeUsingRPKM:
+                    out.normalizeTo1x = None
+            elif key == 'normalizeTo1x':
+                out.normalizeTo1x = int(value) if int(value) > 0 else None
+                if out.normalizeTo1x:
+                    out.normalizeUsingRPKM = False
+            else:
+                sys.exit("*Error*: Unknown --extraOutput setting {}. Valid settings are binSize, outFileFormat, "
+                         "normalizeUsingRPKM and normalizeTo1x.".format(key))
+        except (ValueError, KeyError):
+            sys.exit("*Error*: The value of the --extraOutput setting {} is not valid.".format(setting))
+
+    if out.scaleFactor != 1:
+        out.normalizeTo1x = None
+    return out
+
+
 def process_args(args=None):
     args = parseArguments().parse_args(args)
 
@@ -129,11 +189,18 @@ def process_args(args=None):
               "size ({}).\n\n No smoothing will be done".format(args.smoothLength, args.binSize))
         args.smoothLength = None
 
+    args.extraOutputs = [extraOutput(spec, args) for spec in args.extraOutput or []]
+    if args.extraOutputs and args.smoothLength:
+        sys.exit("*Error*: --extraOutput can not be combined with --smoothLength.")
+
     return args
 
 
 def main(args=None):
     args = process_args(args)
+    # the worker processes are forked once and reused by all steps of the tool,
+    # each of them opens the input files once
+    mapReduce.startPool(args.numberOfProcessors, bamHandler.openHandles, ([args.bam],))
 
     global debug
     if args.verbose:
@@ -141,7 +208,11 @@ def main(args=None):
     else:
         debug = 0
 
-    func_args = {'scaleFactor': get_scale_factor(args)}
+    # the reads are counted once for the scale factors of all outputs
+    num_kept_reads = get_num_kept_reads(args)
+    func_args = {'scaleFactor': get_scale_factor(args, num_kept_reads)}
+    extra_outputs = [(x.outFileName, x.binSize, {'scaleFactor': get_scale_factor(x, num_kept_reads)},
+                      x.outFileFormat) for x in args.extraOutputs]
 
     if args.MNase:
         # check that library is paired end
@@ -246,7 +317,9 @@ def main(args=None):
 
     wr.run(writeBedGraph.scaleCoverage, func_args, args.outFileName,
            blackListFileName=args.blackListFileName,
-           format=args.outFileFormat, smoothLength=args.smoothLength)
+           format=args.outFileFormat, smoothLength=args.smoothLength,
+           extra_outputs=extra_outputs)
+    mapReduce.closePool()
 
 
 class OffsetFragment(writeBedGraph.WriteBedGraph):
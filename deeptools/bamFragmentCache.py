@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+
+from deeptools.fragmentCache import writeFragmentCache, cacheFileName
+from deeptools.parserCommon import numberOfProcessors
+from deeptools._version import __version__
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""
+This tool extracts, once, the alignment information that deepTools uses to
+compute read fragments (positions, aligned blocks, flag, mapping quality,
+template length and mate position) from BAM files into a compact fragment
+cache file stored next to each BAM file (e.g. reads.bam.dtcache).
+
+All deepTools tools reading BAM files then read the cache instead of the
+BAM file. The tools counting reads in bins or regions (bamCoverage,
+bamCompare, multiBamSummary, plotFingerprint and plotCoverage) filter the
+reads and compute their fragments from the columns of the cache, which is
+faster than reading the BAM file when it is processed several times, unless
+the fragments are computed read by read (--Offset, --MNase, --centerReads,
+--filterRNAstrand). The other tools read the alignments of the cache one by
+one. The results are the same. A cache is ignored if the BAM file is
+modified after its creation.
+
+""")
+
+    parser.add_argument('--bamfiles', '-b',
+                        help='List of BAM files to process. The BAM files must be indexed.',
+                        nargs='+',
+                        metavar='bam files',
+                        required=True)
+
+    parser.add_argument('--numberOfProcessors', '-p',
+                        help='Number of processors to use. Type "max/2" to '
+                        'use half the maximum number of processors or "max" '
+                        'to use all available processors.',
+                        metavar="INT",
+                        type=numberOfProcessors,
+                        default=1,
+                        required=False)
+
+    parser.add_argument('--verbose', '-v',
+                        help='Set to see processing messages.',
+                        action='store_true')
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(__version__))
+
+    return parser
+
+
+def main(args=None):
+    args = parse_arguments().parse_args(args)
+
+    for bamFile in args.bamfiles:
+        if args.verbose:
+            print("Writing {}".format(cacheFileName(bamFile)))
+        writeFragmentCache(bamFile, numberOfProcessors=args.numberOfProcessors, verbose=args.verbose)
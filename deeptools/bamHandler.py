@@ -1,5 +1,15 @@
 import sys
+import os
+import io
+import gzip
+import struct
+import numpy as np
 import pysam
+import pyBigWig
+
+# bam and bigWig files opened by the current process, see getHandle
+_handles = {}
+_handlesPid = None
 
 
 def openBam(bamFile):
@@ -27,3 +37,262 @@ def openBam(bamFile):
                  "it contains mapped reads.".format(bamFile))
 
     return bam
+
+
+def getHandle(fileName):
+    """
+    Returns an open pysam (bam) or pyBigWig handle of the file. Each file
+    is opened only once per process and the handle is then reused, such
+    that workers do not re-read the header and index of every file for
+    every chunk. The handles must not be closed by the caller.
+
+    If a bam file has an up to date fragment cache (see
+    deeptools.fragmentCache), the cache is returned instead. It can be
+    used like the pysam handle.
+
+    >>> import os
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> bam = getHandle(root + "testA.bam")
+    >>> bam is getHandle(root + "testA.bam")
+    True
+    >>> getHandle(root + "testA.bw").chroms()
+    {'3R': 200}
+    """
+    global _handlesPid
+
+    if _handlesPid != os.getpid():
+        # handles inherited from a parent process share their file
+        # offsets with it and must not be used
+        _handles.clear()
+        _handlesPid = os.getpid()
+
+    if isinstance(fileName, bytes):
+        # e.g. the filename attribute of pysam handles under python 3
+        fileName = fileName.decode()
+    if fileName not in _handles:
+        isBigWig = _isBigWig(fileName)
+        if isBigWig:
+            _handles[fileName] = pyBigWig.open(fileName)
+        elif isBigWig is False:
+            from deeptools.fragmentCache import openFragmentCache
+            _handles[fileName] = openFragmentCache(fileName)
+            if _handles[fileName] is None:
+                _handles[fileName] = openBam(fileName)
+        else:
+            try:
+                _handles[fileName] = openBam(fileName)
+            except:
+                _handles[fileName] = pyBigWig.open(fileName)
+    return _handles[fileName]
+
+
+def _isBigWig(fileName):
+    """
+    Checks the magic number of a file. Returns None if the file can not
+    be read locally (e.g. remote files).
+    """
+    try:
+        with open(fileName, 'rb') as f:
+            return f.read(4) in (b"\x26\xfc\x8f\x88", b"\x88\x8f\xfc\x26")
+    except (IOError, OSError):
+        return None
+
+
+def openHandles(fileNames):
+    """
+    Opens the given bam or bigWig files, see getHandle. This is meant to
+    be used as initializer of a pool of worker processes, such that every
+    worker opens every file once, on startup.
+    """
+    for fileName in fileNames:
+        try:
+            getHandle(fileName)
+        except (IOError, OSError, ValueError, SystemExit):
+            # invalid files are reported by the tool itself, a failing
+            # initializer would only make the pool restart the worker
+            pass
+
+
+def closeHandles():
+    """
+    Closes the handles opened by getHandle in the current process.
+    """
+    if _handlesPid == os.getpid():
+        for handle in _handles.values():
+            handle.close()
+    _handles.clear()
+
+
+def _voffsetDistance(begin, end):
+    """
+    Approximate number of (uncompressed) bytes between two BGZF virtual
+    file offsets. The upper 48 bits of an offset are the position of a
+    compressed block in the file and the lower 16 the position within the
+    uncompressed block. Across blocks, a compression ratio of about 4
+    is assumed.
+    """
+    cBegin, uBegin = begin >> 16, begin & 0xFFFF
+    cEnd, uEnd = end >> 16, end & 0xFFFF
+    if cBegin == cEnd:
+        return max(uEnd - uBegin, 1)
+    return max(4 * (cEnd - cBegin) + uEnd - uBegin, 1)
+
+
+def _indexFileName(bamFile):
+    """
+    Returns the name of the .bai or .csi index of a bam file or None
+    if no index file is found.
+    """
+    candidates = [bamFile + ".bai", bamFile + ".csi"]
+    if bamFile.endswith(".bam"):
+        candidates.append(bamFile[:-4] + ".bai")
+    for fname in candidates:
+        if os.path.isfile(fname):
+            return fname
+    return None
+
+
+def readIndexDensity(bamFile):
+    """
+    Estimates the number of alignments in consecutive windows of each
+    chromosome of a bam file using only its (BAI or CSI) index, i.e.
+    without reading any alignment. The amount of data stored in each bin
+    of the index is spread uniformly over the windows the bin covers, and
+    scaled such that the sum over a chromosome is its number of mapped
+    reads (as reported by samtools idxstats).
+
+    A window without alignments overlapping it always gets a value of
+    zero; otherwise the values are just estimates.
+
+    Returns a tuple with the size of the windows (16384 for BAI indices)
+    and a dictionary of chromosome name: numpy array, or None if no
+    index can be read (e.g. for remote files).
+
+    >>> import os
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> windowSize, density = readIndexDensity(root + "testA.bam")
+    >>> windowSize
+    16384
+    >>> sorted([(k, v.tolist()) for k, v in density.items()])
+    [('3R', [2.0]), ('chr_cigar', [1.0])]
+    """
+    indexFile = _indexFileName(bamFile)
+    if indexFile is None:
+        return None
+
+    with open(indexFile, 'rb') as f:
+        data = f.read()
+    if data[:4] == b"BAI\1":
+        isCSI = False
+        minShift, depth = 14, 5
+        offset = 4
+    else:
+        if data[:2] == b"\x1f\x8b":
+            # CSI indices are BGZF compressed, i.e. concatenated gzip members
+            try:
+                data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+            except (IOError, OSError):
+                return None
+        if data[:4] != b"CSI\1":
+            return None
+        isCSI = True
+        minShift, depth, lAux = struct.unpack_from('<iii', data, 4)
+        offset = 16 + lAux
+
+    bam = openBam(bamFile)
+    references, lengths, totalMapped = bam.references, bam.lengths, bam.mapped
+    bam.close()
+
+    windowSize = 1 << minShift
+    # first bin id of each level of the binning scheme
+    levelStart = np.array([((1 << (3 * level)) - 1) // 7 for level in range(depth + 1)])
+    pseudoBin = ((1 << (3 * (depth + 1))) - 1) // 7 + 1
+
+    nRef, = struct.unpack_from('<i', data, offset)
+    offset += 4
+    density = {}
+    byteSum = 0
+    hasCounts = True
+    for refIdx in range(nRef):
+        nBin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        binIds = []
+        binBytes = []
+        mapped = None
+        for _ in range(nBin):
+            if isCSI:
+                binId, nChunk = struct.unpack_from('<I8xi', data, offset)
+                offset += 16
+            else:
+                binId, nChunk = struct.unpack_from('<Ii', data, offset)
+                offset += 8
+            chunks = struct.unpack_from('<{}Q'.format(2 * nChunk), data, offset)
+            offset += 16 * nChunk
+            if binId == pseudoBin:
+                mapped = chunks[2]
+                continue
+            binIds.append(binId)
+            binBytes.append(sum(_voffsetDistance(chunks[i], chunks[i + 1]) for i in range(0, 2 * nChunk, 2)))
+        if not isCSI:
+            # skip the linear index
+            nIntv, = struct.unpack_from('<i', data, offset)
+            offset += 4 + 8 * nIntv
+
+        if refIdx >= len(references):
+            break
+        nWindows = (lengths[refIdx] - 1) // windowSize + 1
+        diff = np.zeros(nWindows + 1)
+        if len(binIds):
+            binIds = np.array(binIds, dtype=np.int64)
+            binBytes = np.array(binBytes, dtype=np.float64)
+            level = np.searchsorted(levelStart, binIds, side='right') - 1
+            # number of windows covered by a bin of each level
+            span = np.left_shift(1, 3 * (depth - level))
+            first = np.minimum((binIds - levelStart[level]) * span, nWindows)
+            last = np.minimum(first + span, nWindows)
+            keep = last > first
+            perWindow = binBytes[keep] / (last[keep] - first[keep])
+            np.add.at(diff, first[keep], perWindow)
+            np.add.at(diff, last[keep], -perWindow)
+        windows = np.cumsum(diff[:-1])
+        # remove rounding noise such that empty windows are exactly zero
+        windows[windows < 1e-6] = 0
+        if mapped is not None:
+            if windows.sum() > 0:
+                windows *= float(mapped) / windows.sum()
+        else:
+            hasCounts = False
+        byteSum += windows.sum()
+        density[references[refIdx]] = windows
+
+    if not hasCounts and byteSum > 0:
+        # old index without counts per chromosome, use the total instead
+        for chrom in density:
+            density[chrom] *= float(totalMapped) / byteSum
+
+    return windowSize, density
+
+
+def getReadDensity(bamFilesList):
+    """
+    Sums the read density estimated by readIndexDensity over several
+    bam files. Only chromosomes found in all files are returned.
+
+    Returns None if the index of any of the files can not be read or
+    if the indices use different window sizes.
+    """
+    windowSize = None
+    total = None
+    for bamFile in bamFilesList:
+        res = readIndexDensity(bamFile)
+        if res is None or (windowSize is not None and res[0] != windowSize):
+            return None
+        windowSize, density = res
+        if total is None:
+            total = density
+        else:
+            total = dict([(chrom, total[chrom] + density[chrom]) for chrom in total
+                          if chrom in density and len(density[chrom]) == len(total[chrom])])
+    if total is None:
+        return None
+    return windowSize, total
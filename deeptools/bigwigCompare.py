@@ -7,6 +7,8 @@ import os
 from deeptools import parserCommon
 from deeptools.getRatio import getRatio
 from deeptools import writeBedGraph_bam_and_bw
+from deeptools import mapReduce
+from deeptools import bamHandler
 import deeptools.deepBlue as db
 
 debug = 0
@@ -138,6 +140,8 @@ def main(args=None):
         deepBlueFiles = [[x[0], x[1]] for x in deepBlueFiles]
         del regs
 
+    # the worker processes are forked once, each of them opens the input files once
+    mapReduce.startPool(args.numberOfProcessors, bamHandler.openHandles, ([args.bigwig1, args.bigwig2],))
     writeBedGraph_bam_and_bw.writeBedGraph(
         [(args.bigwig1, getType(args.bigwig1)),
          (args.bigwig2, getType(args.bigwig2))],
@@ -150,6 +154,7 @@ def main(args=None):
         smoothLength=False,
         missingDataAsZero=not args.skipNonCoveredRegions,
         extendPairedEnds=False)
+    mapReduce.closePool()
 
     # Clean up temporary bigWig files, if applicable
     if not args.deepBlueKeepTemp:
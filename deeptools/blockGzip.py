@@ -0,0 +1,194 @@
+"""
+Block gzip files, similar to the BGZF files of samtools.
+
+A block gzip file is a series of gzip members, each compressed on its
+own, so it is still an ordinary gzip file (e.g. for gunzip or Python's
+gzip module). The header of every member has an extra field ('DT') with
+the size of the member, which allows to find all the members without
+decompressing them. The members are compressed and decompressed on a
+thread pool, since zlib releases the GIL.
+
+A member is at most 2**32 - 1 bytes long (BGZF members are limited to
+64 kb, which is shorter than a line of a large matrix file).
+"""
+
+import gzip
+import struct
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# uncompressed size of a block, see iterBlocks
+BLOCK_SIZE = 1 << 20
+# gzip header with the FEXTRA flag and an extra field of 8 bytes: the
+# 'DT' subfield with the member size (4 bytes, little endian)
+HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x08\x00DT\x04\x00"
+HEADER_SIZE = len(HEADER) + 4
+
+
+def threadCount(numberOfProcessors=None):
+    """
+    Returns the number of threads to use, at least one. By default, half
+    of the available processors are used.
+    """
+    if numberOfProcessors is None:
+        numberOfProcessors = multiprocessing.cpu_count() // 2
+    return max(1, numberOfProcessors)
+
+
+def compressBlock(data, level=6):
+    """
+    Returns a gzip member with the compressed data
+
+    >>> import io
+    >>> member = compressBlock(b"chr1\\t0\\t10\\n")
+    >>> gzip.GzipFile(fileobj=io.BytesIO(member * 2)).read() == b"chr1\\t0\\t10\\n" * 2
+    True
+    >>> len(member) == memberSize(member[:HEADER_SIZE])
+    True
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = HEADER_SIZE + len(deflated) + 8
+    return b"".join([HEADER, struct.pack('<I', size), deflated,
+                     struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)])
+
+
+def decompressBlock(member):
+    """
+    Returns the data of a gzip member written by compressBlock
+    """
+    data = zlib.decompress(member[HEADER_SIZE:-8], -zlib.MAX_WBITS)
+    crc, size = struct.unpack('<II', member[-8:])
+    if crc != zlib.crc32(data) & 0xffffffff or size != len(data) & 0xffffffff:
+        raise IOError("Corrupted block gzip member")
+    return data
+
+
+def memberSize(header):
+    """
+    Returns the size of a gzip member from its header, or None if it was
+    not written by compressBlock
+    """
+    if len(header) < HEADER_SIZE or header[:len(HEADER)] != HEADER:
+        return None
+    return struct.unpack('<I', header[len(HEADER):HEADER_SIZE])[0]
+
+
+def blockOffsets(fileName):
+    """
+    Returns the position and size of every member of a block gzip file,
+    or None if the file is not a block gzip file.
+    """
+    offsets = []
+    with open(fileName, 'rb') as f:
+        pos = 0
+        while True:
+            header = f.read(HEADER_SIZE)
+            if not header:
+                break
+            size = memberSize(header)
+            if size is None:
+                return None
+            offsets.append((pos, size))
+            pos += size
+            f.seek(pos)
+    return offsets
+
+
+def iterBlocks(chunks, blockSize=BLOCK_SIZE):
+    """
+    Joins strings (e.g. lines) into blocks of at least blockSize bytes,
+    encoded as utf-8. The strings are not split between blocks.
+
+    >>> list(iterBlocks(['a\\n', 'bc\\n', 'd\\n'], blockSize=4)) == [b'a\\nbc\\n', b'd\\n']
+    True
+    """
+    block = []
+    size = 0
+    for chunk in chunks:
+        block.append(chunk)
+        size += len(chunk)
+        if size >= blockSize:
+            yield "".join(block).encode('utf-8')
+            block = []
+            size = 0
+    if block:
+        yield "".join(block).encode('utf-8')
+
+
+def writeBlocks(fileName, blocks, numberOfProcessors=None):
+    """
+    Writes a block gzip file. blocks is an iterable of bytes, each
+    written as a gzip member. The members are compressed on a pool of
+    numberOfProcessors threads while the next blocks are produced.
+    """
+    numberOfProcessors = threadCount(numberOfProcessors)
+    pool = ThreadPool(numberOfProcessors)
+    pending = []
+    with open(fileName, 'wb') as f:
+        for block in blocks:
+            pending.append(pool.apply_async(compressBlock, (block,)))
+            # bounds the memory used by the blocks not yet written
+            if len(pending) > 2 * numberOfProcessors:
+                f.write(pending.pop(0).get())
+        for res in pending:
+            f.write(res.get())
+    pool.close()
+    pool.join()
+
+
+def _decompressAndCall(args):
+    fileName, pos, size, func = args
+    with open(fileName, 'rb') as f:
+        f.seek(pos)
+        data = decompressBlock(f.read(size))
+    return func(data)
+
+
+def readBlocks(fileName, func, numberOfProcessors=None):
+    """
+    Returns, in order, the result of func for each decompressed block of
+    a gzip file. For block gzip files, the blocks are decompressed and
+    func is called on a pool of numberOfProcessors threads. Other gzip
+    files are decompressed serially into blocks of about BLOCK_SIZE
+    bytes, split after a newline.
+
+    >>> import os
+    >>> from deeptools.utilities import getTempFileName
+    >>> fileName = getTempFileName(suffix='.gz')
+    >>> writeBlocks(fileName, [b'a\\nb\\n', b'c\\n'], numberOfProcessors=2)
+    >>> readBlocks(fileName, len, numberOfProcessors=2)
+    [4, 2]
+    >>> f = gzip.open(fileName, 'wb')
+    >>> _ = f.write(b'a\\nb\\nc\\n')
+    >>> f.close()
+    >>> readBlocks(fileName, lambda x: x.split()) == [[b'a', b'b', b'c']]
+    True
+    >>> os.remove(fileName)
+    """
+    offsets = blockOffsets(fileName)
+    if offsets is None:
+        results = []
+        rest = b""
+        fh = gzip.open(fileName, 'rb')
+        while True:
+            data = fh.read(BLOCK_SIZE)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b"\n") + 1
+            rest = data[end:]
+            if end:
+                results.append(func(data[:end]))
+        fh.close()
+        if rest:
+            results.append(func(rest))
+        return results
+
+    numberOfProcessors = threadCount(numberOfProcessors)
+    pool = ThreadPool(numberOfProcessors)
+    results = pool.map(_decompressAndCall, [(fileName, pos, size, func) for pos, size in offsets])
+    pool.close()
+    pool.join()
+    return results
@@ -11,7 +11,7 @@ import py2bit
 import sys
 
 from deeptoolsintervals import GTF
-from deeptools.utilities import tbitToBamChrName, getGC_content
+from deeptools.utilities import tbitToBamChrName, getGC_content, getBlackList
 from deeptools import parserCommon, mapReduce
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
 from deeptools import bamHandler
@@ -158,7 +158,7 @@ def getPositionsToSample(chrom, start, end, stepSize):
     positions_to_sample = np.arange(start, end, stepSize)
 
     if global_vars['filter_out']:
-        filter_out_tree = GTF(global_vars['filter_out'])
+        filter_out_tree = getBlackList(global_vars['filter_out'])
     else:
         filter_out_tree = None
 
@@ -187,17 +187,8 @@ def getPositionsToSample(chrom, start, end, stepSize):
 
     # skip regions that are filtered out
     if filter_out_tree:
-        try:
-            out_match = filter_out_tree.findOverlaps(chrom, start, end)
-        except KeyError:
-            out_match = []
-
-        if len(out_match) > 0:
-            for intval in out_match:
-                positions_to_sample = \
-                    positions_to_sample[
-                        (positions_to_sample < intval[0]) |
-                        (positions_to_sample >= intval[1])]
+        positions_to_sample = positions_to_sample[
+            ~filter_out_tree.mask(chrom, positions_to_sample, positions_to_sample + 1)]
     return positions_to_sample
 
 
@@ -215,7 +206,7 @@ def countReadsPerGC_worker(chromNameBam,
 
     chromNameBit = chrNameBamToBit[chromNameBam]
     tbit = py2bit.open(global_vars['2bit'])
-    bam = bamHandler.openBam(global_vars['bam'])
+    bam = bamHandler.getHandle(global_vars['bam'])
     c = 1
     sub_reads_per_gc = []
     positions_to_sample = getPositionsToSample(chromNameBit,
@@ -314,7 +305,7 @@ def tabulateGCcontent_worker(chromNameBam, start, end, stepSize,
     subF_gc = np.zeros(fragmentLength['median'] + 1, dtype='int')
 
     tbit = py2bit.open(global_vars['2bit'])
-    bam = bamHandler.openBam(global_vars['bam'])
+    bam = bamHandler.getHandle(global_vars['bam'])
     peak = 0
     startTime = time.time()
 
@@ -11,6 +11,8 @@ from deeptools._version import __version__
 import deeptools.config as cfg
 from deeptools import parserCommon
 from deeptools import heatmapper
+from deeptools import mapReduce
+from deeptools import bamHandler
 import deeptools.computeMatrixOperations as cmo
 import deeptools.deepBlue as db
 
@@ -112,6 +114,15 @@ def computeMatrixOutputArgs(args=None):
                         'needed by the "plotHeatmap" and "plotProfile" tools.',
                         type=writableFile,
                         required=True)
+    output.add_argument('--outFileFormat',
+                        help='Format of the --outFileName file: "gzip" for '
+                        'the gzipped text matrix file or "binary" for a binary '
+                        'matrix file, with the values in single precision, that '
+                        'is faster to write and to read (deeptools.matrixFile). '
+                        'Both formats can be used by '
+                        'plotHeatmap, plotProfile and computeMatrixOperations.',
+                        choices=['gzip', 'binary'],
+                        default='gzip')
     # TODO This isn't implemented, see deeptools/heatmapper.py in the saveTabulatedValues() function
     # output.add_argument('--outFileNameData',
     #                    help='Name to save the averages per matrix '
@@ -411,7 +422,11 @@ def main(args=None):
         del regs
 
     scores_file_list = args.scoreFileName
+    # each worker process opens the bigWig files once
+    mapReduce.startPool(args.numberOfProcessors, bamHandler.openHandles, (scores_file_list,))
     hm.computeMatrix(scores_file_list, args.regionsFileName, parameters, blackListFileName=args.blackListFileName, verbose=args.verbose, allArgs=args)
+    mapReduce.closePool()
+
     if args.sortRegions not in ['no', 'keep']:
 
         sortUsingSamples = []
@@ -429,7 +444,7 @@ def main(args=None):
         hm.parameters["group_boundaries"] = hm.matrix.group_boundaries
         cmo.sortMatrix(hm, args.regionsFileName, args.transcriptID, args.transcript_id_designator)
 
-    hm.save_matrix(args.outFileName)
+    hm.save_matrix(args.outFileName, args.outFileFormat, args.numberOfProcessors)
 
     if args.outFileNameMatrix:
         hm.save_matrix_values(args.outFileNameMatrix)
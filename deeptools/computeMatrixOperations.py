@@ -60,7 +60,7 @@ or
     subparsers.add_parser(
         'subset',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        parents=[infoArgs(), subsetArgs()],
+        parents=[infoArgs(), subsetArgs(), outputFormatArgs()],
         help="Actually subset the matrix. The group and sample orders are honored, so one can also reorder files.",
         usage='An example usage is:\n  computeMatrixOperations subset -m '
         'input.mat.gz -o output.mat.gz --groups "group 1" "group 2" '
@@ -70,7 +70,7 @@ or
     subparsers.add_parser(
         'filterStrand',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        parents=[infoArgs(), filterStrandArgs()],
+        parents=[infoArgs(), filterStrandArgs(), outputFormatArgs()],
         help="Filter entries by strand.",
         usage='Example usage:\n  computeMatrixOperations filterStrand -m '
         'input.mat.gz -o output.mat.gz --strand +\n\n')
@@ -79,7 +79,7 @@ or
     subparsers.add_parser(
         'rbind',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        parents=[bindArgs()],
+        parents=[bindArgs(), outputFormatArgs()],
         help="merge multiple matrices by concatenating them head to tail. This assumes that the same samples are present in each in the same order.",
         usage='Example usage:\n  computeMatrixOperations rbind -m '
         'input1.mat.gz input2.mat.gz -o output.mat.gz\n\n')
@@ -88,7 +88,7 @@ or
     subparsers.add_parser(
         'cbind',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        parents=[bindArgs()],
+        parents=[bindArgs(), outputFormatArgs()],
         help="merge multiple matrices by concatenating them left to right. No assumptions are made about the row order. Regions not present in the first file specified are ignored. Regions missing in subsequent files will result in NAs.",
         usage='Example usage:\n  computeMatrixOperations cbind -m '
         'input1.mat.gz input2.mat.gz -o output.mat.gz\n\n')
@@ -97,7 +97,7 @@ or
     subparsers.add_parser(
         'sort',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        parents=[sortArgs()],
+        parents=[sortArgs(), outputFormatArgs()],
         help='Sort a matrix file to correspond to the order if entries in the desired input files. The groups of regions designated by the files must be present in the order found in the output of computeMatrix (otherwise, use the subset command first).',
         usage='Example usage:\n  computeMatrixOperations sort -m input.mat.gz -R regions1.bed regions2.bed regions3.gtf -o input.sorted.mat.gz\n\n')
 
@@ -123,6 +123,20 @@ def bindArgs():
     return parser
 
 
+def outputFormatArgs():
+    parser = argparse.ArgumentParser(add_help=False)
+    optional = parser.add_argument_group('Output options')
+
+    optional.add_argument('--outFileFormat',
+                          help='Format of the output file: "gzip" for the gzipped '
+                          'text matrix file or "binary" for a binary matrix file '
+                          '(see computeMatrix --outFileFormat).',
+                          choices=['gzip', 'binary'],
+                          default='gzip')
+
+    return parser
+
+
 def infoArgs():
     parser = argparse.ArgumentParser(add_help=False)
     required = parser.add_argument_group('Required arguments')
@@ -670,18 +684,18 @@ def main(args=None):
             args.groups = hm.matrix.group_labels
         hm.matrix.group_labels = args.groups
         # save
-        hm.save_matrix(args.outFileName)
+        hm.save_matrix(args.outFileName, args.outFileFormat)
     elif args.command == 'filterStrand':
         filterHeatmap(hm, args)
-        hm.save_matrix(args.outFileName)
+        hm.save_matrix(args.outFileName, args.outFileFormat)
     elif args.command == 'rbind':
         rbindMatrices(hm, args)
-        hm.save_matrix(args.outFileName)
+        hm.save_matrix(args.outFileName, args.outFileFormat)
     elif args.command == 'cbind':
         cbindMatrices(hm, args)
-        hm.save_matrix(args.outFileName)
+        hm.save_matrix(args.outFileName, args.outFileFormat)
     elif args.command == 'sort':
         sortMatrix(hm, args.regionsFileName, args.transcriptID, args.transcript_id_designator)
-        hm.save_matrix(args.outFileName)
+        hm.save_matrix(args.outFileName, args.outFileFormat)
     else:
         sys.exit("Unknown command {0}!\n".format(args.command))
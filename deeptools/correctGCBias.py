@@ -18,6 +18,7 @@ from scipy.stats import binom
 from deeptools.utilities import tbitToBamChrName, getGC_content
 from deeptools import writeBedGraph, parserCommon, mapReduce
 from deeptools import utilities
+from deeptools.readFilter import ReadFilter
 
 old_settings = np.seterr(all='ignore')
 
@@ -200,6 +201,8 @@ def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
              if r.flag & 4 == 0]
 
     bam.close()
+    # whether each read has the same orientation and position as the previous
+    repeated = ReadFilter.duplicates(ReadFilter.columns(reads), np.arange(len(reads))).tolist()
     r_index = -1
     for read in reads:
         r_index += 1
@@ -216,9 +219,7 @@ def writeCorrected_worker(chrNameBam, chrNameBit, start, end, step):
             continue
 
         # is this read in the same orientation and position as the previous?
-        if r_index > 0 and read.pos == reads[r_index - 1].pos and \
-                read.is_reverse == reads[r_index - 1].is_reverse \
-                and read.pnext == reads[r_index - 1].pnext:
+        if repeated[r_index]:
             read_repetitions += 1
             if read_repetitions >= global_vars['max_dup_gc'][gc]:
                 removed_duplicated_reads += 1
@@ -346,6 +347,8 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
     # have a genomic position
     reads = [r for r in bam.fetch(chrNameBam, start, end)
              if r.pos > start and r.flag & 4 == 0]
+    # whether each read has the same orientation and position as the previous
+    repeated = ReadFilter.duplicates(ReadFilter.columns(reads), np.arange(len(reads))).tolist()
 
     r_index = -1
     for read in reads:
@@ -371,9 +374,7 @@ def writeCorrectedSam_worker(chrNameBam, chrNameBit, start, end,
             else:
                 copies = 1
         # is this read in the same orientation and position as the previous?
-        if gc and r_index > 0 and read.pos == reads[r_index - 1].pos \
-                and read.is_reverse == reads[r_index - 1].is_reverse \
-                and read.pnext == reads[r_index - 1].pnext:
+        if gc and repeated[r_index]:
             read_repetitions += 1
             if read_repetitions >= global_vars['max_dup_gc'][gc]:
                 copies = 0  # in other words do not take into account this read
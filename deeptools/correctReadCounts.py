@@ -62,6 +62,41 @@ def computeCorrectedReadcounts(tileCoverage, args):
     return treatmentCorrectedTags
 
 
+def computeLambdaArray(coverage, args):
+    """
+    Same as computeLambda, for a coverage matrix with a row per tile
+    """
+    treatmentExtraSignalTags = coverage[:, 0] - args['treatmentMean']
+    controlLambda = args['controlMean'] + (treatmentExtraSignalTags * args['controlSignalRatio'])
+
+    return -1 * poisson.logsf(coverage[:, 1], controlLambda) / np.log(10)
+
+
+def computePvalueArray(coverage, args):
+    """
+    Same as computePvalue, for a coverage matrix with a row per tile
+    """
+    treatmentLambda = coverage[:, 1] * args['treatmentControlRatio']
+
+    log10pvalue = -1 * poisson.logsf(coverage[:, 0], treatmentLambda) / np.log(10)
+
+    # same as min(300, log10pvalue), which is 300 for nans
+    return np.where(log10pvalue < 300, log10pvalue, 300)
+
+
+def computeCorrectedReadcountsArray(coverage, args):
+    """
+    Same as computeCorrectedReadcounts, for a coverage matrix with a row per tile
+    """
+    return coverage[:, 0] - args['treatmentControlRatio'] * (coverage[:, 1] - args['controlMean'])
+
+
+# see writeBedGraph.applyTileFunction
+computeLambda.arrayFunction = computeLambdaArray
+computePvalue.arrayFunction = computePvalueArray
+computeCorrectedReadcounts.arrayFunction = computeCorrectedReadcountsArray
+
+
 def correctReadCounts(bamFilesList, binLength, numberOfSamples, defaultFragmentLength,
                       outFileName, outFileFormat, outFileNameCorr=None, region=None,
                       extendPairedEnds=True,
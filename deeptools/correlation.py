@@ -58,7 +58,7 @@ class Correlation:
             self.remove_outliers()
 
         if log1p is True:
-            self.matrix = np.log1p(self.matrix)
+            self.matrix = np.log1p(self.matrix, dtype='float64')
 
         if corr_method:
             self.compute_correlation()
@@ -69,12 +69,15 @@ class Correlation:
         savez method. Two keys are expected:
         'matrix' and 'labels'. The matrix should
         contain one sample per row
+
+        The matrix keeps the dtype it was saved with, e.g. the
+        compact integer counts of multiBamSummary.
         """
 
         _ma = np.load(matrix_file)
         # matrix:  cols correspond to  samples
-        self.matrix = np.asarray(_ma['matrix'].tolist())
-        if np.any(np.isnan(self.matrix)):
+        self.matrix = np.asarray(_ma['matrix'])
+        if self.matrix.dtype.kind == 'f' and np.any(np.isnan(self.matrix)):
             num_nam = len(np.flatnonzero(np.isnan(self.matrix.flatten())))
             sys.stderr.write("*Warning*. {} NaN values were found. They will be removed along with the "
                              "corresponding bins in other samples for the computation "
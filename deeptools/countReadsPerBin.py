@@ -9,7 +9,9 @@ import numpy as np
 import deeptools.utilities
 from deeptools import bamHandler
 from deeptools import mapReduce
-from deeptoolsintervals import GTF
+from deeptools.readFilter import ReadFilter
+from deeptools.fragmentCache import FragmentCache
+from deeptools.rawCounts import RawCountsWriter, textHeader, textRows
 import pyBigWig
 
 debug = 0
@@ -24,8 +26,20 @@ def countReadsInRegions_wrapper(args):
     The args var, contains as first element the 'self' value
     from the countReadsPerBin object
 
+    The counts are written to the output buffer of the object
+    and only the number of rows is returned.
     """
-    return CountReadsPerBin.count_reads_in_region(*args)
+    _values, tempFileName = CountReadsPerBin.count_reads_in_region(*args)
+    return args[0].save_counts(args[1], args[2], args[3], _values), tempFileName
+
+
+def countReadsInEmptyRegions_wrapper(args):
+    """
+    Same as countReadsInRegions_wrapper, but for regions known to
+    contain no reads. The bam files are not accessed.
+    """
+    _values, tempFileName = CountReadsPerBin.count_reads_in_region(*args, noReads=True)
+    return args[0].save_counts(args[1], args[2], args[3], _values), tempFileName
 
 
 class CountReadsPerBin(object):
@@ -121,6 +135,19 @@ class CountReadsPerBin(object):
     out_file_for_raw_data : str
         File name to save the raw counts computed
 
+    raw_data_format : str
+        Format of ``out_file_for_raw_data``: 'tab' (tab-delimited text) or
+        'binary' (see deeptools.rawCounts). Default: 'tab'
+
+    labels : list
+        Labels of the samples. If given, they are written to the header
+        of ``out_file_for_raw_data``.
+
+    compact_counts : bool
+        If true, the counts are returned with the smallest dtype that holds
+        them (see get_count_dtype), e.g. uint16 for the read counts of a bam
+        file with less than 65536 mapped reads, instead of float64.
+
     Returns
     -------
     numpy array
@@ -160,12 +187,16 @@ class CountReadsPerBin(object):
                  smoothLength=0,
                  minFragmentLength=0,
                  maxFragmentLength=0,
-                 out_file_for_raw_data=None):
+                 out_file_for_raw_data=None,
+                 compact_counts=False,
+                 raw_data_format='tab',
+                 labels=None):
 
         self.bamFilesList = bamFilesList
         self.binLength = binLength
         self.numberOfSamples = numberOfSamples
         self.blackListFileName = blackListFileName
+        self.blackList = None
 
         if extendReads and len(bamFilesList):
             from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
@@ -212,6 +243,12 @@ class CountReadsPerBin(object):
         self.maxFragmentLength = maxFragmentLength
         self.zerosToNans = zerosToNans
         self.smoothLength = smoothLength
+        self.compact_counts = compact_counts
+        # see plan_output
+        self.output_buffer = None
+        # largest number of mapped reads of the files, or None for bigWig
+        # files, set by run()
+        self.max_mapped = None
 
         if out_file_for_raw_data:
             self.save_data = True
@@ -219,6 +256,8 @@ class CountReadsPerBin(object):
         else:
             self.save_data = False
             self.out_file_for_raw_data = None
+        self.raw_data_format = raw_data_format
+        self.labels = labels
 
         # check that wither numberOfSamples or stepSize are set
         if numberOfSamples is None and stepSize is None and bedFile is None:
@@ -271,13 +310,23 @@ class CountReadsPerBin(object):
             raise ValueError("numberOfSamples has to be bigger than {} ".format(min_num_of_samples))
 
         max_mapped = []
+        all_bam = True
         for x in bamFilesHandlers:
             try:
                 max_mapped.append(x.mapped)
             except:
                 # bigWig, use a fixed value
                 max_mapped.append(0)
+                all_bam = False
         max_mapped = max(max_mapped)
+        self.max_mapped = max_mapped if all_bam else None
+
+        # The bam indices tell how the reads are distributed along the genome.
+        # This is used to balance the work among the processors and to skip
+        # regions without reads (not possible for bigWig input)
+        readDensity = None
+        if all_bam:
+            readDensity = bamHandler.getReadDensity(self.bamFilesList)
 
         # If max_mapped is 0 (i.e., bigWig input), set chunkSize to a multiple of binLength and use every bin
         if max_mapped == 0:
@@ -299,11 +348,48 @@ class CountReadsPerBin(object):
             # in case a region is used, append the tilesize
             self.region += ":{}".format(self.binLength)
 
+        # Chunks can be cut to balance the number of reads per chunk,
+        # unless bins overlap: those spanning a cut would be lost
+        chunkAlignment = self.stepSize if self.stepSize >= self.binLength else None
+
+        # the blacklist is parsed here, once, and sent to the workers
+        # together with the rest of the object
+        self.get_blacklist()
+
         # Handle GTF options
         transcriptID, exonID, transcript_id_designator, keepExons = deeptools.utilities.gtfOptions(allArgs)
 
-        # use map reduce to call countReadsInRegions_wrapper
-        imap_res = mapReduce.mapReduce([],
+        if self.out_file_for_raw_data:
+            if len(non_common):
+                sys.stderr.write("*Warning*\nThe resulting bed file does not contain information for "
+                                 "the chromosomes that were not common between the bigwig files\n")
+
+            # intermediary files are concatenated as they arrive
+            if self.raw_data_format == 'binary':
+                ofile = RawCountsWriter(self.out_file_for_raw_data, labels=self.labels)
+            else:
+                ofile = open(self.out_file_for_raw_data, "w")
+                if self.labels is not None:
+                    ofile.write(textHeader(self.labels))
+        else:
+            ofile = None
+
+        def collect_results(num_rows, result):
+            _rows, tempFileName = result
+            if tempFileName:
+                # concatenate all intermediate tempfiles into one
+                if self.raw_data_format == 'binary':
+                    ofile.appendFile(tempFileName)
+                else:
+                    _foo = open(tempFileName, 'r')
+                    shutil.copyfileobj(_foo, ofile)
+                    _foo.close()
+                os.remove(tempFileName)
+            return num_rows + _rows
+
+        # use map reduce to call countReadsInRegions_wrapper. The workers
+        # write their counts into the output buffer set up by plan_output
+        num_rows = mapReduce.mapReduce([],
                                        countReadsInRegions_wrapper,
                                        chromSizes,
                                        self_=self,
@@ -315,30 +401,21 @@ class CountReadsPerBin(object):
                                        transcriptID=transcriptID,
                                        exonID=exonID,
                                        keepExons=keepExons,
-                                       transcript_id_designator=transcript_id_designator)
-
-        if self.out_file_for_raw_data:
-            if len(non_common):
-                sys.stderr.write("*Warning*\nThe resulting bed file does not contain information for "
-                                 "the chromosomes that were not common between the bigwig files\n")
-
-            # concatenate intermediary bedgraph files
-            ofile = open(self.out_file_for_raw_data, "w")
-            for _values, tempFileName in imap_res:
-                if tempFileName:
-                    # concatenate all intermediate tempfiles into one
-                    _foo = open(tempFileName, 'r')
-                    shutil.copyfileobj(_foo, ofile)
-                    _foo.close()
-                    os.remove(tempFileName)
-
+                                       transcript_id_designator=transcript_id_designator,
+                                       reducer=collect_results,
+                                       reducerInit=0,
+                                       readDensity=readDensity,
+                                       chunkAlignment=chunkAlignment,
+                                       chunkMargin=self.get_read_extension(),
+                                       emptyChunkFunc=countReadsInEmptyRegions_wrapper,
+                                       planFunc=self.plan_output)
+
+        if ofile is not None:
             ofile.close()
 
-        try:
-            num_reads_per_bin = np.concatenate([x[0] for x in imap_res], axis=0)
-            return num_reads_per_bin
-
-        except ValueError:
+        num_reads_per_bin = self.load_output()
+        assert num_reads_per_bin.shape[0] == num_rows
+        if num_rows == 0:
             if self.bedFile:
                 sys.exit('\nNo coverage values could be computed.\n\n'
                          'Please check that the chromosome names in the BED file are found on the bam files.\n\n'
@@ -347,7 +424,17 @@ class CountReadsPerBin(object):
                 sys.exit('\nNo coverage values could be computed.\n\nCheck that all bam files are valid and '
                          'contain mapped reads.')
 
-    def count_reads_in_region(self, chrom, start, end, bed_regions_list=None):
+        return num_reads_per_bin
+
+    def get_read_extension(self):
+        """
+        Returns the maximum distance, in bp, by which reads are extended
+        """
+        if self.defaultFragmentLength == 'read length':
+            return 0
+        return self.maxPairedFragmentLength
+
+    def count_reads_in_region(self, chrom, start, end, bed_regions_list=None, noReads=False):
         """Counts the reads in each bam file at each 'stepSize' position
         within the interval (start, end) for a window or bin of size binLength.
 
@@ -372,6 +459,10 @@ class CountReadsPerBin(object):
             corresponding to bed regions to be processed.
             If not bed file was passed to the object constructor
             then this list is empty.
+        noReads : bool
+            If True, the region is known to contain no reads, e.g.
+            from the bam index, and zeros (or nans) are returned
+            without accessing the bam files.
 
         Returns
         -------
@@ -411,39 +502,30 @@ class CountReadsPerBin(object):
 
         bam_handlers = []
         for fname in self.bamFilesList:
-            try:
-                bam_handlers.append(bamHandler.openBam(fname))
-            except:
-                bam_handlers.append(pyBigWig.open(fname))
+            if noReads:
+                bam_handlers.append(None)
+            else:
+                bam_handlers.append(bamHandler.getHandle(fname))
 
-        blackList = None
-        if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+        blackList = self.get_blacklist()
 
         # A list of lists of tuples
-        transcriptsToConsider = []
-        if bed_regions_list is not None:
-            transcriptsToConsider = [x[1] for x in bed_regions_list]
-        else:
-            if self.stepSize == self.binLength:
-                transcriptsToConsider.append([(start, end, self.binLength)])
-            else:
-                for i in range(start, end, self.stepSize):
-                    if i + self.binLength > end:
-                        break
-                    if blackList is not None and blackList.findOverlaps(chrom, i, i + self.binLength):
-                        continue
-                    transcriptsToConsider.append([(i, i + self.binLength)])
+        transcriptsToConsider = self.get_regions_to_count(chrom, start, end, bed_regions_list, blackList)
 
-        if self.save_data:
-            _file = open(deeptools.utilities.getTempFileName(suffix='.bed'), 'w+t')
-            _file_name = _file.name
-        else:
-            _file_name = ''
+        _file_name = ''
+
+        # the regions are grouped into clusters of nearby regions only once,
+        # the reads of each cluster are then fetched once per file
+        clusters = None
+        if not noReads:
+            clusters = self.get_fetch_clusters(chrom, transcriptsToConsider, blackList)
 
         for bam in bam_handlers:
-            for trans in transcriptsToConsider:
-                tcov = self.get_coverage_of_region(bam, chrom, trans)
+            if bam is None:
+                tcovs = [self.get_empty_coverage(trans) for trans in transcriptsToConsider]
+            else:
+                tcovs = self.get_coverage_of_regions(bam, chrom, transcriptsToConsider, clusters=clusters)
+            for tcov in tcovs:
                 if bed_regions_list is not None:
                     subnum_reads_per_bin.append(np.sum(tcov))
                 else:
@@ -452,24 +534,20 @@ class CountReadsPerBin(object):
         subnum_reads_per_bin = np.concatenate([subnum_reads_per_bin]).reshape(-1, len(self.bamFilesList), order='F')
 
         if self.save_data:
-            idx = 0
-            for i, trans in enumerate(transcriptsToConsider):
-                if len(trans[0]) != 3:
-                    starts = ",".join([str(x[0]) for x in trans])
-                    ends = ",".join([str(x[1]) for x in trans])
-                    _file.write("\t".join([chrom, starts, ends]) + "\t")
-                    _file.write("\t".join(["{}".format(x) for x in subnum_reads_per_bin[i, :]]) + "\n")
-                else:
-                    for exon in trans:
-                        for startPos in range(exon[0], exon[1], exon[2]):
-                            if idx >= subnum_reads_per_bin.shape[0]:
-                                # At the end of chromosomes (or due to blacklisted regions), there are bins smaller than the bin size
-                                # Counts there are added to the bin before them, but range() will still try to include them.
-                                break
-                            _file.write("{0}\t{1}\t{2}\t".format(chrom, startPos, startPos + exon[2]))
-                            _file.write("\t".join(["{}".format(x) for x in subnum_reads_per_bin[idx, :]]) + "\n")
-                            idx += 1
-            _file.close()
+            # the rows of all regions are formatted or written at once
+            coordinates = self.get_row_coordinates(transcriptsToConsider, subnum_reads_per_bin.shape[0],
+                                                   bed_regions_list is not None)
+            if self.raw_data_format == 'binary':
+                _file_name = deeptools.utilities.getTempFileName(suffix='.dtraw')
+                writer = RawCountsWriter(_file_name,
+                                         dtype=self.output_buffer[2] if self.output_buffer else None)
+                writer.addChunk(chrom, counts=subnum_reads_per_bin, **coordinates)
+                writer.close()
+            else:
+                _file = open(deeptools.utilities.getTempFileName(suffix='.bed'), 'w+t')
+                _file_name = _file.name
+                _file.write(textRows(chrom, counts=subnum_reads_per_bin, **coordinates))
+                _file.close()
 
         if self.verbose:
             endTime = time.time()
@@ -481,6 +559,189 @@ class CountReadsPerBin(object):
 
         return subnum_reads_per_bin, _file_name
 
+    @staticmethod
+    def get_row_coordinates(transcripts, num_rows, keep_regions=False):
+        """
+        Returns the start and end positions of the rows of the counts of
+        count_reads_in_region for the regions returned by
+        get_regions_to_count, as a dictionary of the arguments of
+        deeptools.rawCounts.textRows. Lists of regions (e.g. the exons of
+        a BED file) start at their first region and end at their last one.
+        With keep_regions, the positions of all their regions are also
+        returned.
+
+        >>> c = CountReadsPerBin.get_row_coordinates([[(0, 130, 50)]], 2)
+        >>> c['starts'].tolist(), c['ends'].tolist()
+        ([0, 50], [50, 100])
+        >>> c = CountReadsPerBin.get_row_coordinates([[(0, 10), (20, 30)], [(40, 50)]], 2, True)
+        >>> c['starts'].tolist(), c['ends'].tolist(), c['regionPtr'].tolist(), c['regionStarts'].tolist()
+        ([0, 40], [30, 50], [0, 2, 3], [0, 20, 40])
+        """
+        if len(transcripts) and len(transcripts[0][0]) == 3:
+            # At the end of chromosomes (or due to blacklisted regions), there are bins smaller than the bin size
+            # Counts there are added to the bin before them and these bins are not returned
+            starts = np.concatenate([np.arange(exon[0], exon[1], exon[2], dtype=np.int64)
+                                     for trans in transcripts for exon in trans])[:num_rows]
+            ends = np.concatenate([np.arange(exon[0], exon[1], exon[2], dtype=np.int64) + exon[2]
+                                   for trans in transcripts for exon in trans])[:num_rows]
+            return {'starts': starts, 'ends': ends}
+
+        coordinates = {'starts': np.array([trans[0][0] for trans in transcripts], dtype=np.int64),
+                       'ends': np.array([trans[-1][1] for trans in transcripts], dtype=np.int64)}
+        if keep_regions:
+            coordinates['regionPtr'] = np.cumsum([0] + [len(trans) for trans in transcripts])
+            coordinates['regionStarts'] = np.array([reg[0] for trans in transcripts for reg in trans],
+                                                   dtype=np.int64)
+            coordinates['regionEnds'] = np.array([reg[1] for trans in transcripts for reg in trans],
+                                                 dtype=np.int64)
+        return coordinates
+
+    def get_blacklist(self):
+        """
+        Returns the blacklist (see deeptools.utilities.BlackList) or None
+        if no blacklist file is given. The file is parsed only once.
+        """
+        if self.blackList is None and self.blackListFileName is not None:
+            self.blackList = deeptools.utilities.getBlackList(self.blackListFileName)
+        return self.blackList
+
+    def get_read_filter(self):
+        """
+        Returns the ReadFilter (see deeptools.readFilter) of the mapping
+        quality, SAM flag and fragment length filters. Duplicates are
+        removed by count_fragments_of_cluster for each region separately.
+        """
+        return ReadFilter(minMappingQuality=self.minMappingQuality,
+                          samFlagInclude=self.samFlag_include,
+                          samFlagExclude=self.samFlag_exclude,
+                          minFragmentLength=self.minFragmentLength,
+                          maxFragmentLength=self.maxFragmentLength)
+
+    def get_regions_to_count(self, chrom, start, end, bed_regions_list=None, blackList=None):
+        """
+        Returns the regions whose coverage count_reads_in_region computes
+        for the interval (start, end), as a list of lists of (start, end)
+        or (start, end, tileSize) tuples.
+
+        >>> c = CountReadsPerBin([], 25, stepSize=50)
+        >>> c.get_regions_to_count('chr1', 0, 130)
+        [[(0, 25)], [(50, 75)], [(100, 125)]]
+        >>> c.stepSize = 25
+        >>> c.get_regions_to_count('chr1', 0, 130)
+        [[(0, 130, 25)]]
+        """
+        transcriptsToConsider = []
+        if bed_regions_list is not None:
+            transcriptsToConsider = [x[1] for x in bed_regions_list]
+        else:
+            if self.stepSize == self.binLength:
+                transcriptsToConsider.append([(start, end, self.binLength)])
+            else:
+                starts = np.arange(start, end - self.binLength + 1, self.stepSize)
+                if blackList is not None:
+                    starts = starts[~blackList.mask(chrom, starts, starts + self.binLength)]
+                transcriptsToConsider = [[(i, i + self.binLength)] for i in starts.tolist()]
+        return transcriptsToConsider
+
+    @staticmethod
+    def get_count_dtype(max_count, nans=False):
+        """
+        Returns the smallest dtype that holds read counts up to max_count
+        exactly: uint16 or uint32, or float32 if the counts can also be NaN.
+        If max_count is None, the values are not read counts (e.g. the
+        mean values of bigWig files) and float32 is returned.
+
+        >>> CountReadsPerBin.get_count_dtype(1000)
+        'uint16'
+        >>> CountReadsPerBin.get_count_dtype(100000)
+        'uint32'
+        >>> CountReadsPerBin.get_count_dtype(1000, nans=True)
+        'float32'
+        >>> CountReadsPerBin.get_count_dtype(2 ** 25, nans=True)
+        'float64'
+        """
+        if max_count is None:
+            return 'float32'
+        if nans:
+            # float32 holds integers exactly up to 2 ** 24
+            return 'float32' if max_count <= 2 ** 24 else 'float64'
+        if max_count <= np.iinfo(np.uint16).max:
+            return 'uint16'
+        if max_count <= np.iinfo(np.uint32).max:
+            return 'uint32'
+        return 'float64'
+
+    def plan_output(self, tasks):
+        """
+        Pre-sizes the output of run() given the tasks sent to the workers
+        by mapReduce. The output is a memory mapped temporary file, into
+        which each worker writes the counts of a task at the rows reserved
+        for it (see save_counts). Thus, the counts are neither sent back
+        to the main process nor concatenated, and the rows are in genome
+        order whatever the order in which the tasks are processed.
+
+        With compact_counts, the output has the dtype returned by
+        get_count_dtype for the largest possible count: the number of
+        mapped reads, times the number of regions of a BED entry.
+        """
+        blackList = self.get_blacklist()
+
+        offsets = {}
+        num_rows = 0
+        max_regions = 1
+        for task in tasks:
+            chrom, start, end = task[:3]
+            bed_regions_list = task[3] if len(task) > 3 else None
+            offsets[(chrom, start, end)] = num_rows
+            regions = self.get_regions_to_count(chrom, start, end, bed_regions_list, blackList)
+            if bed_regions_list is not None:
+                num_rows += len(regions)
+                max_regions = max([max_regions] + [len(x) for x in regions])
+            else:
+                num_rows += sum([self.get_number_of_bins(x) for x in regions])
+
+        dtype = 'float64'
+        if self.compact_counts:
+            max_count = self.max_mapped * max_regions if self.max_mapped is not None else None
+            dtype = self.get_count_dtype(max_count, nans=self.zerosToNans)
+
+        shape = (num_rows, len(self.bamFilesList))
+        fileName = deeptools.utilities.getTempFileName(suffix='.bin')
+        if num_rows > 0:
+            np.memmap(fileName, dtype=dtype, mode='w+', shape=shape).flush()
+        self.output_buffer = (fileName, shape, dtype, offsets)
+
+    def save_counts(self, chrom, start, end, counts):
+        """
+        Writes the counts of the task (chrom, start, end) at its rows of
+        the output buffer set up by plan_output. Returns the number of
+        rows written.
+        """
+        fileName, shape, dtype, offsets = self.output_buffer
+        offset = offsets[(chrom, start, end)]
+        if counts.shape[0] > 0:
+            out = np.memmap(fileName, dtype=dtype, mode='r+', shape=shape)
+            out[offset:offset + counts.shape[0], :] = counts
+            out.flush()
+            del out
+        return counts.shape[0]
+
+    def load_output(self):
+        """
+        Returns the content of the output buffer set up by plan_output
+        and removes the buffer. The array is backed by the (already
+        deleted) memory mapped file instead of being copied into memory.
+        """
+        fileName, shape, dtype, offsets = self.output_buffer
+        self.output_buffer = None
+        if shape[0] == 0:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            return np.zeros(shape, dtype=dtype)
+        out = np.asarray(np.memmap(fileName, dtype=dtype, mode='r+', shape=shape))
+        os.remove(fileName)
+        return out
+
     def get_coverage_of_region(self, bamHandle, chrom, regions,
                                fragmentFromRead_func=None):
         """
@@ -517,137 +778,402 @@ class CountReadsPerBin(object):
 
 
         """
-        if not fragmentFromRead_func:
-            fragmentFromRead_func = self.get_fragment_from_read
-        nbins = len(regions)
-        if len(regions[0]) == 3:
-            nbins = 0
-            for reg in regions:
-                nbins += (reg[1] - reg[0]) // reg[2]
-        coverages = np.zeros(nbins, dtype='float64')
+        if hasattr(bamHandle, 'fetch'):
+            return self.get_coverage_of_regions(bamHandle, chrom, [regions], fragmentFromRead_func)[0]
 
-        if self.defaultFragmentLength == 'read length':
-            extension = 0
-        else:
-            extension = self.maxPairedFragmentLength
+        # bigWig input, as used by plotFingerprint
+        coverages = np.zeros(self.get_number_of_bins(regions), dtype='float64')
+
+        extension = self.get_read_extension()
 
-        blackList = None
-        if self.blackListFileName is not None:
-            blackList = GTF(self.blackListFileName)
+        blackList = self.get_blacklist()
 
-        vector_start = 0
         for idx, reg in enumerate(regions):
             if len(reg) == 3:
-                tileSize = int(reg[2])
-                nRegBins = (reg[1] - reg[0]) // tileSize
+                nRegBins = (reg[1] - reg[0]) // int(reg[2])
             else:
                 nRegBins = 1
-                tileSize = int(reg[1] - reg[0])
 
             # Blacklisted regions have a coverage of 0
             if blackList and blackList.findOverlaps(chrom, reg[0], reg[1]):
                 continue
-            regStart = int(max(0, reg[0] - extension))
-            regEnd = reg[1] + int(extension)
-
-            # If alignments are extended and there's a blacklist, ensure that no
-            # reads originating in a blacklist are fetched
-            if blackList and reg[0] > 0 and extension > 0:
-                o = blackList.findOverlaps(chrom, regStart, reg[0])
-                if o is not None and len(o) > 0:
-                    regStart = o[-1][1]
-                o = blackList.findOverlaps(chrom, reg[1], regEnd)
-                if o is not None and len(o) > 0:
-                    regEnd = o[0][0]
-
-            start_time = time.time()
-            # caching seems faster. TODO: profile the function
-            c = 0
-            try:
-                # BAM input
-                if chrom in bamHandle.references:
-                    reads = [r for r in bamHandle.fetch(chrom, regStart, regEnd)
-                             if r.flag & 4 == 0]
+            regStart, regEnd = self.get_fetch_interval(chrom, reg, extension, blackList)
+
+            if bamHandle.chroms(chrom):
+                _ = np.array(bamHandle.stats(chrom, regStart, regEnd, type="mean", nBins=nRegBins), dtype=np.float)
+                _[np.isnan(_)] = 0.0
+                coverages += _
+            else:
+                raise NameError("chromosome {} not found in bigWig file with chroms {}".format(chrom, bamHandle.chroms()))
+
+        # change zeros to NAN
+        if self.zerosToNans:
+            coverages[coverages == 0] = np.nan
+
+        return coverages
+
+    @staticmethod
+    def get_fetch_interval(chrom, reg, extension, blackList=None):
+        """
+        Returns the interval from which reads are fetched to compute the
+        coverage of the region reg, i.e. the region extended by the read
+        extension. Alignments originating in a blacklisted region are
+        excluded.
+        """
+        regStart = int(max(0, reg[0] - extension))
+        regEnd = reg[1] + int(extension)
+
+        # If alignments are extended and there's a blacklist, ensure that no
+        # reads originating in a blacklist are fetched
+        if blackList and reg[0] > 0 and extension > 0:
+            o = blackList.findOverlaps(chrom, regStart, reg[0])
+            if o is not None and len(o) > 0:
+                regStart = o[-1][1]
+            o = blackList.findOverlaps(chrom, reg[1], regEnd)
+            if o is not None and len(o) > 0:
+                regEnd = o[0][0]
+        return regStart, regEnd
+
+    def get_coverage_of_regions(self, bamHandle, chrom, transcripts,
+                                fragmentFromRead_func=None, clusters=None):
+        """
+        Same as get_coverage_of_region, for a list of lists of regions.
+        Returns a list with the coverage array of each list.
+
+        Instead of fetching the reads of every region separately, the
+        reads of each of the clusters of nearby regions returned by
+        get_fetch_clusters are fetched at once and then assigned to all
+        the regions they overlap. As the clusters do not depend on the bam
+        file, they can be computed once and passed for several files.
+
+        >>> test = Tester()
+        >>> import pysam
+        >>> c = CountReadsPerBin([], stepSize=1, extendReads=300)
+        >>> [x.tolist() for x in c.get_coverage_of_regions(pysam.AlignmentFile(test.bamFile_PE), 'chr2',
+        ... [[(5000833, 5000834)], [(5000834, 5000835)], [(5000090, 5000100), (5000100, 5000110)]])]
+        [[4.0], [5.0], [1.0, 0.0]]
+        """
+        if not hasattr(bamHandle, 'fetch'):
+            return [self.get_coverage_of_region(bamHandle, chrom, regions, fragmentFromRead_func)
+                    for regions in transcripts]
+        if chrom not in bamHandle.references:
+            raise NameError("chromosome {} not found in bam file".format(chrom))
+
+        if not fragmentFromRead_func:
+            fragmentFromRead_func = self.get_fragment_from_read
+        coverages = [np.zeros(self.get_number_of_bins(regions), dtype='float64') for regions in transcripts]
+
+        if clusters is None:
+            clusters = self.get_fetch_clusters(chrom, transcripts, self.get_blacklist())
+
+        for clusterStart, clusterEnd, clusterUnits in clusters:
+            self.count_fragments_of_cluster(bamHandle, chrom, clusterStart, clusterEnd,
+                                            clusterUnits, coverages, fragmentFromRead_func)
+
+        # change zeros to NAN
+        if self.zerosToNans:
+            for tcov in coverages:
+                tcov[tcov == 0] = np.nan
+
+        return coverages
+
+    def get_fetch_clusters(self, chrom, transcripts, blackList=None, max_gap=1000):
+        """
+        Groups the regions of a list of lists of regions (e.g. the exons of
+        the transcripts of a BED file) into clusters of regions whose fetch
+        intervals are less than max_gap bp apart. The reads of a cluster
+        are fetched at once. Regions far apart from each other are still
+        fetched one by one, since this is faster than reading all the
+        reads between them (as done by computeGCBias.tabulateGCcontent_worker).
+
+        Returns a list of [fetch start, fetch end, regions] in which each
+        region is given as a tuple of (fetch start, fetch end, region,
+        index of its list, index of its first bin in the coverage of the
+        list). Blacklisted regions are skipped.
+
+        >>> c = CountReadsPerBin([], stepSize=1)
+        >>> [cl[:2] for cl in c.get_fetch_clusters('chr2', [[(5000, 5100)], [(9000, 9100)], [(5300, 5400)]])]
+        [[5000, 5400], [9000, 9100]]
+        >>> [(u[3], u[4]) for u in c.get_fetch_clusters('chr2', [[(5000, 5100), (5300, 5400, 50)]])[0][2]]
+        [(0, 0), (0, 1)]
+        """
+        extension = self.get_read_extension()
+
+        # Blacklisted regions have a coverage of 0
+        blacklisted = [False] * sum([len(regions) for regions in transcripts])
+        if blackList is not None:
+            blacklisted = blackList.mask(chrom, [reg[0] for regions in transcripts for reg in regions],
+                                         [reg[1] for regions in transcripts for reg in regions]).tolist()
+        blacklisted = iter(blacklisted)
+
+        # The regions to count as tuples of (fetch start, fetch end, region,
+        # index of its list, index of its first bin in the coverage of the list)
+        units = []
+        for tIdx, regions in enumerate(transcripts):
+            vector_start = 0
+            for reg in regions:
+                if len(reg) == 3:
+                    nRegBins = (reg[1] - reg[0]) // int(reg[2])
                 else:
-                    raise NameError("chromosome {} not found in bam file".format(chrom))
-            except:
-                # bigWig input, as used by plotFingerprint
-                if bamHandle.chroms(chrom):
-                    _ = np.array(bamHandle.stats(chrom, regStart, regEnd, type="mean", nBins=nRegBins), dtype=np.float)
-                    _[np.isnan(_)] = 0.0
-                    coverages += _
+                    nRegBins = 1
+
+                if next(blacklisted):
                     continue
+                regStart, regEnd = self.get_fetch_interval(chrom, reg, extension, blackList)
+                units.append((regStart, regEnd, reg, tIdx, vector_start))
+                vector_start += nRegBins
+        units.sort(key=lambda x: x[0])
+
+        # group regions close to each other
+        clusters = []
+        for unit in units:
+            if clusters and unit[0] - clusters[-1][1] < max_gap:
+                clusters[-1][1] = max(clusters[-1][1], unit[1])
+                clusters[-1][2].append(unit)
+            else:
+                clusters.append([unit[0], unit[1], [unit]])
+        return clusters
+
+    def count_fragments_of_cluster(self, bamHandle, chrom, clusterStart, clusterEnd,
+                                   units, coverages, fragmentFromRead_func):
+        """
+        Fetches the reads of the interval (clusterStart, clusterEnd) once
+        and adds the fragments overlapping each of the regions in units
+        (see get_coverage_of_regions) to the coverages. For each region,
+        the reads are processed exactly as if they had been fetched for
+        the region alone.
+        """
+        start_time = time.time()
+        readFilter = self.get_read_filter()
+        # the fragments of the reads of a fragment cache are computed from
+        # their columns, unless they are computed by a function other than
+        # get_fragment_from_read (e.g. bamCoverage --Offset) or centered
+        columnFragments = False
+        read_fragments = None
+        if isinstance(bamHandle, FragmentCache):
+            reads = bamHandle.fetchReads(chrom, clusterStart, clusterEnd)
+            reads = reads.select(reads.columns['flag'] & 4 == 0)
+            cols = readFilter.columns(reads)
+            read_ends = cols['end']
+            columnFragments = not self.center_read and \
+                fragmentFromRead_func == CountReadsPerBin.get_fragment_from_read.__get__(self)
+            if columnFragments and self.defaultFragmentLength != 'read length':
+                read_fragments = self.get_fragments_from_columns(cols, reads.refId)
+        else:
+            reads = [r for r in bamHandle.fetch(chrom, clusterStart, clusterEnd)
+                     if r.flag & 4 == 0]
+            cols = readFilter.columns(reads)
+            read_ends = np.array([r.reference_end if r.reference_end is not None else r.reference_start + 1
+                                  for r in reads], dtype=np.int64)
+
+        # the reads are sorted by start position. As a read overlaps a fetch
+        # interval if it starts before its end and ends after its start, the
+        # running maximum of the end positions is used to find the first read
+        # that may overlap an interval
+        read_starts = cols['start']
+        read_ends = np.maximum(read_ends, read_starts + 1)
+        max_ends = np.maximum.accumulate(read_ends) if len(reads) else read_ends
+
+        # reads that are not filtered out and their fragment blocks
+        keep = readFilter.mask(cols)
+        blocks = {}
+        # fragments of each region, shared by the units of the same region
+        # with different tile sizes (see WriteBedGraph.get_outputs_coverage_runs)
+        region_fragments = {}
+
+        c = 0
+        for regStart, regEnd, reg, tIdx, vector_start in units:
+            if len(reg) == 3:
+                tileSize = int(reg[2])
+                nRegBins = (reg[1] - reg[0]) // tileSize
+            else:
+                nRegBins = 1
+                tileSize = int(reg[1] - reg[0])
+
+            region_key = (regStart, regEnd, reg[0], reg[1])
+            if region_key not in region_fragments:
+                first_read = np.searchsorted(max_ends, regStart, side='right')
+                last_read = np.searchsorted(read_starts, regEnd, side='left')
+                candidates = first_read + np.flatnonzero((read_ends[first_read:last_read] > regStart) &
+                                                         keep[first_read:last_read])
+
+                if columnFragments:
+                    candidates, region_fragments[region_key] = self.get_region_fragments_from_columns(
+                        reads, readFilter, candidates, reg, read_fragments)
                 else:
-                    raise NameError("chromosome {} not found in bigWig file with chroms {}".format(chrom, bamHandle.chroms()))
+                    # since reads can be split (e.g. RNA-seq reads) each part of the
+                    # read that maps is called a position block.
+                    for rIdx in candidates.tolist():
+                        if rIdx not in blocks:
+                            try:
+                                blocks[rIdx] = fragmentFromRead_func(reads[rIdx])
+                            except TypeError:
+                                # the get_fragment_from_read functions returns None in some cases.
+                                # Those cases are to be skipped.
+                                blocks[rIdx] = None
+                    candidates = np.array([rIdx for rIdx in candidates.tolist() if blocks[rIdx] is not None],
+                                          dtype=np.int64)
+
+                    # get rid of duplicate reads that have same position on each of the
+                    # pairs
+                    if self.ignoreDuplicates:
+                        candidates = candidates[~readFilter.duplicates(cols, candidates)]
+
+                    # fragment blocks in the region, and whether they are the first
+                    # block of their read
+                    fragment_starts = []
+                    fragment_ends = []
+                    first_blocks = []
+                    for rIdx in candidates.tolist():
+                        first_block = True
+                        for fragmentStart, fragmentEnd in blocks[rIdx]:
+                            if fragmentEnd is None or fragmentStart is None:
+                                continue
+                            fragmentLength = fragmentEnd - fragmentStart
+                            if fragmentLength == 0:
+                                continue
+                            # skip reads that are not in the region being
+                            # evaluated.
+                            if fragmentEnd <= reg[0] or fragmentStart >= reg[1]:
+                                continue
+
+                            fragment_starts.append(fragmentStart)
+                            fragment_ends.append(fragmentEnd)
+                            first_blocks.append(first_block)
+                            first_block = False
+                    region_fragments[region_key] = (fragment_starts, fragment_ends, first_blocks)
+                c += len(candidates)
+            fragment_starts, fragment_ends, first_blocks = region_fragments[region_key]
+
+            # the counts of all fragments are added at once
+            coverages[tIdx][vector_start:vector_start + nRegBins] += \
+                self.get_fragment_bin_counts(fragment_starts, fragment_ends, first_blocks,
+                                             reg[0], tileSize, nRegBins)
 
-            prev_start_pos = None  # to store the start positions
-            # of previous processed read pair
-            for read in reads:
-                if self.minMappingQuality and read.mapq < self.minMappingQuality:
-                    continue
+        if self.verbose:
+            endTime = time.time()
+            print("%s,  processing %s (%.1f per sec) reads @ %s:%s-%s for %s regions" % (
+                multiprocessing.current_process().name, c, c / (endTime - start_time),
+                chrom, clusterStart, clusterEnd, len(units)))
 
-                # filter reads based on SAM flag
-                if self.samFlag_include and read.flag & self.samFlag_include != self.samFlag_include:
-                    continue
-                if self.samFlag_exclude and read.flag & self.samFlag_exclude != 0:
-                    continue
+    def get_fragments_from_columns(self, cols, refId):
+        """
+        Same as get_fragment_from_read, for the reads of a fragment cache
+        extended to their fragments (see
+        deeptools.fragmentCache.CachedReads), computed from the arrays of
+        their columns. refId is the reference id of their chromosome.
+        Returns the fragment starts and ends, and whether the fragment of
+        each read could be computed (get_fragment_from_read fails for
+        reverse reads without reference end).
+        """
+        flag = cols['flag']
+        start = cols['start']
+        end = cols['referenceEnd']
+        pnext = cols['pnext']
+        tlen = np.abs(cols['tlen'])
+        reverse = flag & 16 != 0
+        # see is_proper_pair
+        proper = (flag & 2 != 0) & (cols['nextRefId'] == refId) & \
+            (tlen <= self.maxPairedFragmentLength) & (reverse != (flag & 32 != 0)) & \
+            np.where(reverse, start >= pnext, start <= pnext)
+        fragment_starts = np.where(reverse, np.where(proper, pnext, end - self.defaultFragmentLength), start)
+        fragment_ends = np.where(reverse, end, start + np.where(proper, tlen, self.defaultFragmentLength))
+        return fragment_starts, fragment_ends, ~reverse | (end >= 0)
+
+    def get_region_fragments_from_columns(self, reads, readFilter, candidates, reg, read_fragments=None):
+        """
+        Same as the fragments of the candidates of a region computed by
+        count_fragments_of_cluster, for the reads of a fragment cache. The
+        fragments are either the aligned blocks of the reads or, if reads
+        are extended, read_fragments (see get_fragments_from_columns).
+        Returns the candidates that are not skipped and the fragment
+        starts, ends and whether each fragment is the first block of its read.
+        """
+        if read_fragments is not None:
+            fragment_starts, fragment_ends, valid = read_fragments
+            candidates = candidates[valid[candidates]]
+            assert np.all(fragment_starts[candidates] < fragment_ends[candidates]), \
+                "fragment start greater than fragment end"
+        if self.ignoreDuplicates:
+            candidates = candidates[~readFilter.duplicates(reads.columns, candidates)]
+
+        if read_fragments is not None:
+            starts = fragment_starts[candidates]
+            ends = fragment_ends[candidates]
+            owner = np.arange(len(candidates))
+        else:
+            # the blocks of spliced reads
+            starts, ends, owner = reads.blocks(candidates)
 
-                # Fragment lengths
-                if self.minFragmentLength > 0 and abs(read.template_length) < self.minFragmentLength:
-                    continue
-                if self.maxFragmentLength > 0 and abs(read.template_length) > self.maxFragmentLength:
-                    continue
+        # skip the fragments that are not in the region being evaluated
+        inRegion = (ends != starts) & (ends > reg[0]) & (starts < reg[1])
+        owner = owner[inRegion]
+        first_blocks = np.ones(len(owner), dtype=bool)
+        first_blocks[1:] = owner[1:] != owner[:-1]
+        return candidates, (starts[inRegion], ends[inRegion], first_blocks)
 
-                # get rid of duplicate reads that have same position on each of the
-                # pairs
-                if self.ignoreDuplicates and prev_start_pos \
-                        and prev_start_pos == (read.reference_start, read.pnext, read.is_reverse):
-                    continue
+    @staticmethod
+    def get_fragment_bin_counts(fragment_starts, fragment_ends, first_blocks,
+                                reg_start, tileSize, nBins):
+        """
+        Returns the number of fragments overlapping each of nBins bins of
+        size tileSize starting at reg_start. The last bin extends to the
+        end of the region. The fragments are given as arrays of start and
+        end positions, along with whether each of them is the first block
+        of its read. A bin overlapped by several blocks of a read (e.g. a
+        spliced read) is counted once, if the blocks of a read are given
+        in order.
+
+        The counts are accumulated in a difference array, for all
+        fragments at once.
+
+        >>> CountReadsPerBin.get_fragment_bin_counts([0, 25, 30, 95], [20, 28, 45, 150],
+        ...                                          [True, True, False, True], 0, 10, 10).tolist()
+        [1, 1, 1, 1, 1, 0, 0, 0, 0, 1]
+        """
+        starts = np.asarray(fragment_starts, dtype=np.int64)
+        ends = np.asarray(fragment_ends, dtype=np.int64)
+        sIdx = np.maximum((starts - reg_start) // tileSize, 0)
+        # rounded up
+        eIdx = np.minimum(-((reg_start - ends) // tileSize), nBins)
+
+        # bins already counted for a previous block of the same read are skipped
+        keep = np.ones(len(sIdx), dtype=bool)
+        last_eIdx = None
+        for i in np.flatnonzero(np.logical_not(first_blocks)):
+            if first_blocks[i - 1]:
+                last_eIdx = eIdx[i - 1]
+            sIdx[i] = max(last_eIdx, sIdx[i])
+            if sIdx[i] >= eIdx[i]:
+                keep[i] = False
+                continue
+            last_eIdx = eIdx[i]
 
-                # since reads can be split (e.g. RNA-seq reads) each part of the
-                # read that maps is called a position block.
-                try:
-                    position_blocks = fragmentFromRead_func(read)
-                except TypeError:
-                    # the get_fragment_from_read functions returns None in some cases.
-                    # Those cases are to be skipped, hence the continue line.
-                    continue
+        keep &= sIdx < eIdx
+        counts = np.bincount(sIdx[keep], minlength=nBins + 1) - np.bincount(eIdx[keep], minlength=nBins + 1)
+        return np.cumsum(counts[:nBins])
 
-                last_eIdx = None
-                for fragmentStart, fragmentEnd in position_blocks:
-                    if fragmentEnd is None or fragmentStart is None:
-                        continue
-                    fragmentLength = fragmentEnd - fragmentStart
-                    if fragmentLength == 0:
-                        continue
-                    # skip reads that are not in the region being
-                    # evaluated.
-                    if fragmentEnd <= reg[0] or fragmentStart >= reg[1]:
-                        continue
-
-                    sIdx = vector_start + max((fragmentStart - reg[0]) // tileSize, 0)
-                    eIdx = vector_start + min(np.ceil(float(fragmentEnd - reg[0]) / tileSize).astype('int'), nRegBins)
-                    if last_eIdx is not None:
-                        sIdx = max(last_eIdx, sIdx)
-                        if sIdx >= eIdx:
-                            continue
-                    coverages[sIdx:eIdx] += 1
-                    last_eIdx = eIdx
-
-                prev_start_pos = (read.reference_start, read.pnext, read.is_reverse)
-                c += 1
-
-            if self.verbose:
-                endTime = time.time()
-                print("%s,  processing %s (%.1f per sec) reads @ %s:%s-%s" % (
-                    multiprocessing.current_process().name, c, c / (endTime - start_time), chrom, reg[0], reg[1]))
-
-            vector_start += nRegBins
+    @staticmethod
+    def get_number_of_bins(regions):
+        """
+        Returns the number of values get_coverage_of_region returns
+        for the given regions.
+        """
+        if len(regions[0]) == 3:
+            return sum([(reg[1] - reg[0]) // reg[2] for reg in regions])
+        return len(regions)
 
-        # change zeros to NAN
-        if self.zerosToNans:
-            coverages[coverages == 0] = np.nan
+    def get_empty_coverage(self, regions):
+        """
+        Same as get_coverage_of_region for regions without reads.
 
+        >>> c = CountReadsPerBin([], stepSize=1, zerosToNans=True)
+        >>> c.get_empty_coverage([(0, 100, 25), (200, 260, 25)]).tolist()
+        [nan, nan, nan, nan, nan, nan]
+        """
+        coverages = np.zeros(self.get_number_of_bins(regions), dtype='float64')
+        if self.zerosToNans:
+            coverages[:] = np.nan
         return coverages
 
     def getReadLength(self, read):
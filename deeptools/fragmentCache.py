@@ -0,0 +1,541 @@
+"""
+Fragment cache files of bam files.
+
+A fragment cache holds, for each chromosome of a bam file, the alignment
+information used by the deepTools tools to compute the read fragments
+(positions, aligned blocks, flag, mapping quality, template length and
+mate position), stored column by column, in the bam file order. Read
+names, sequences and qualities are not stored. The file is memory mapped
+and read without any decompression or decoding. The counting of reads
+(see CountReadsPerBin.count_fragments_of_cluster) uses the columns of
+the alignments as arrays (see FragmentCache.fetchReads), without
+creating an object for each alignment.
+
+The cache of a bam file is stored next to it, e.g. reads.bam.dtcache, and
+is created with the bamFragmentCache tool. bamHandler.getHandle uses it
+instead of the bam file whenever it is present and up to date, through
+a FragmentCache object that can be used in place of a pysam AlignmentFile.
+
+File layout: the magic number, the columns (each aligned to 8 bytes), a
+JSON header describing the bam file and the position, type and size of
+each column, the position of the header (8 bytes, little endian) and the
+magic number again.
+"""
+
+import os
+import sys
+import json
+import struct
+import shutil
+import multiprocessing
+from array import array
+from itertools import compress, repeat
+from operator import itemgetter
+import numpy as np
+
+from deeptools.bamHandler import openBam
+from deeptools.utilities import getTempFileName
+
+MAGIC = b"DTFCACHE"
+VERSION = 1
+SUFFIX = ".dtcache"
+
+# name and type of the columns stored for each chromosome
+COLUMNS = [('start', '<i4'),  # reference_start
+           ('referenceEnd', '<i4'),  # reference_end, -1 if None
+           ('maxEnd', '<i4'),  # running maximum of the end positions used by fetch
+           ('flag', '<u2'),
+           ('mapq', 'u1'),
+           ('tlen', '<i4'),  # template_length
+           ('nextStart', '<i4'),  # next_reference_start
+           ('nextRefId', '<i4'),  # next_reference_id
+           ('queryLength', '<i4'),  # infer_query_length(always=False), -1 if None
+           ('blockPtr', '<i8'),  # the blocks of read i are blockPtr[i]:blockPtr[i + 1]
+           ('blockStarts', '<i4'),
+           ('blockEnds', '<i4')]
+
+# typed arrays holding the values of a batch of alignments, the number of
+# blocks of each alignment is turned into blockPtr (see _flushBatch)
+BUFFER_TYPES = [('start', 'i'),
+                ('referenceEnd', 'i'),
+                ('flag', 'H'),
+                ('mapq', 'B'),
+                ('tlen', 'i'),
+                ('nextStart', 'i'),
+                ('nextRefId', 'i'),
+                ('queryLength', 'i'),
+                ('blockCount', 'i'),
+                ('blockStarts', 'i'),
+                ('blockEnds', 'i')]
+# number of alignments read before their columns are written
+BATCH_SIZE = 1 << 20
+
+# caches found to be older than their bam file, reported only once
+_staleWarned = set()
+
+
+def cacheFileName(bamFile):
+    """
+    Returns the name of the fragment cache of a bam file.
+
+    >>> cacheFileName("/data/reads.bam")
+    '/data/reads.bam.dtcache'
+    """
+    return bamFile + SUFFIX
+
+
+def _bamSignature(bamFile):
+    """
+    Size and modification time of a bam file, used to detect caches that
+    no longer match their bam file.
+    """
+    st = os.stat(bamFile)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def _flushBatch(files, buffers, state):
+    """
+    Converts a batch of alignments, held in typed arrays, into the columns
+    of the cache and appends them to the temporary file of each column.
+    The running maximum of the end positions and the block pointers
+    continue those of the previous batches (see state).
+    """
+    batch = {}
+    for name, typecode in BUFFER_TYPES:
+        buf = buffers[name]
+        batch[name] = np.frombuffer(buf, dtype=typecode) if len(buf) else np.zeros(0, dtype=typecode)
+        # new arrays for the next batch, the current ones are still referenced
+        buffers[name] = array(typecode)
+
+    # reads overlap a fetched region if they start before its end and
+    # end after its start, unmapped reads or reads without aligned bases
+    # span a single base
+    starts = batch['start'].astype(np.int64)
+    ends = batch['referenceEnd'].astype(np.int64)
+    ends = np.where(ends < 0, starts + 1, np.maximum(ends, starts + 1))
+    batch['maxEnd'] = np.maximum.accumulate(np.concatenate([[state['maxEnd']], ends]))[1:]
+    batch['blockPtr'] = state['blocks'] + np.cumsum(batch['blockCount'], dtype=np.int64)
+    if len(starts):
+        state['maxEnd'] = batch['maxEnd'][-1]
+        state['blocks'] = batch['blockPtr'][-1]
+
+    for name, dtype in COLUMNS:
+        files[name].write(batch[name].astype(dtype).tobytes())
+
+
+def _extractChromosome(args):
+    """
+    Reads all the alignments of a chromosome and writes each of their
+    columns to a temporary file. To keep the memory used independent of
+    the number of alignments, they are read in batches of BATCH_SIZE
+    alignments, stored in typed arrays. Returns a dictionary with the
+    (file name, type, length) of each column.
+    """
+    bamFile, chrom = args
+    bam = openBam(bamFile)
+    refIds = dict([(name, i) for i, name in enumerate(bam.references)])
+    files = dict([(name, open(getTempFileName(suffix='.dtcache'), 'wb')) for name, _ in COLUMNS])
+    buffers = dict([(name, array(typecode)) for name, typecode in BUFFER_TYPES])
+    state = {'maxEnd': -1, 'blocks': 0}
+    # the block pointers start at 0
+    files['blockPtr'].write(np.zeros(1, dtype='<i8').tobytes())
+    numReads = 0
+    numBlocks = 0
+    for read in bam.fetch(chrom):
+        buffers['start'].append(read.reference_start)
+        refEnd = read.reference_end
+        buffers['referenceEnd'].append(-1 if refEnd is None else refEnd)
+        buffers['flag'].append(read.flag)
+        buffers['mapq'].append(read.mapping_quality)
+        buffers['tlen'].append(read.template_length)
+        buffers['nextStart'].append(read.next_reference_start)
+        buffers['nextRefId'].append(read.next_reference_id)
+        queryLength = read.infer_query_length(always=False)
+        buffers['queryLength'].append(-1 if queryLength is None else queryLength)
+        blocks = read.get_blocks()
+        for blockStart, blockEnd in blocks:
+            buffers['blockStarts'].append(blockStart)
+            buffers['blockEnds'].append(blockEnd)
+        buffers['blockCount'].append(len(blocks))
+        numReads += 1
+        numBlocks += len(blocks)
+        if len(buffers['start']) == BATCH_SIZE:
+            _flushBatch(files, buffers, state)
+    bam.close()
+    _flushBatch(files, buffers, state)
+
+    lengths = {'blockPtr': numReads + 1, 'blockStarts': numBlocks, 'blockEnds': numBlocks}
+    columns = {}
+    for name, dtype in COLUMNS:
+        files[name].close()
+        columns[name] = (files[name].name, dtype, lengths.get(name, numReads))
+    return columns, refIds
+
+
+def writeFragmentCache(bamFile, fileName=None, numberOfProcessors=1, verbose=False):
+    """
+    Creates the fragment cache of a bam file. The chromosomes are
+    processed in parallel. The cache is written to a temporary file that
+    is renamed at the end, such that an incomplete cache is never used.
+
+    Returns the name of the cache file.
+    """
+    if fileName is None:
+        fileName = cacheFileName(bamFile)
+    bam = openBam(bamFile)
+    header = {'version': VERSION,
+              'bam': _bamSignature(bamFile),
+              'references': list(bam.references),
+              'lengths': list(bam.lengths),
+              'mapped': bam.mapped,
+              'chroms': {}}
+    bam.close()
+
+    tasks = [(bamFile, chrom) for chrom in header['references']]
+    if numberOfProcessors > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(numberOfProcessors)
+        results = pool.imap(_extractChromosome, tasks)
+    else:
+        pool = None
+        results = map(_extractChromosome, tasks)
+
+    partialFileName = fileName + ".part"
+    try:
+        with open(partialFileName, 'wb') as out:
+            out.write(MAGIC)
+            for (_, chrom), (columns, refIds) in zip(tasks, results):
+                header['chroms'][chrom] = {'refId': refIds[chrom]}
+                for name, _ in COLUMNS:
+                    tempFileName, dtype, size = columns[name]
+                    header['chroms'][chrom][name] = (out.tell(), dtype, size)
+                    with open(tempFileName, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                    os.remove(tempFileName)
+                    out.write(b"\0" * (-out.tell() % 8))
+                if verbose:
+                    print("{}: {} alignments".format(chrom, columns['start'][2]))
+            headerPos = out.tell()
+            out.write(json.dumps(header).encode())
+            out.write(struct.pack('<Q', headerPos))
+            out.write(MAGIC)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    os.rename(partialFileName, fileName)
+    return fileName
+
+
+def openFragmentCache(bamFile):
+    """
+    Returns a FragmentCache for a bam file, or None if the bam file has no
+    fragment cache or if the cache is older than the bam file.
+    """
+    fileName = cacheFileName(bamFile)
+    if not os.path.isfile(fileName):
+        return None
+    cache = FragmentCache(fileName, bamFile)
+    if cache.header['version'] != VERSION or cache.header['bam'] != _bamSignature(bamFile):
+        if fileName not in _staleWarned:
+            sys.stderr.write("The fragment cache {} does not match {} and is "
+                             "ignored. Please recreate it with "
+                             "bamFragmentCache.\n".format(fileName, bamFile))
+            _staleWarned.add(fileName)
+        return None
+    return cache
+
+
+class CachedRead(tuple):
+    """
+    An alignment read from a fragment cache. It has the attributes and
+    methods of pysam.AlignedSegment that the deepTools tools use to
+    filter alignments and to compute fragments.
+
+    To be cheap to create, it is a tuple of the values of the alignment
+    (see FragmentCache._reads) with read-only attributes.
+    """
+    __slots__ = ()
+
+    reference_start = pos = property(itemgetter(0))
+    flag = property(itemgetter(2))
+    mapping_quality = mapq = property(itemgetter(3))
+    template_length = tlen = isize = property(itemgetter(4))
+    next_reference_start = pnext = mpos = property(itemgetter(5))
+    next_reference_id = rnext = property(itemgetter(6))
+    reference_id = property(itemgetter(12))
+
+    @property
+    def reference_end(self):
+        return None if self[1] < 0 else self[1]
+
+    aend = reference_end
+
+    @property
+    def query_name(self):
+        # read names are not cached
+        return None
+
+    is_paired = property(lambda self: self[2] & 1 != 0)
+    is_proper_pair = property(lambda self: self[2] & 2 != 0)
+    is_unmapped = property(lambda self: self[2] & 4 != 0)
+    mate_is_unmapped = property(lambda self: self[2] & 8 != 0)
+    is_reverse = property(lambda self: self[2] & 16 != 0)
+    mate_is_reverse = property(lambda self: self[2] & 32 != 0)
+    is_read1 = property(lambda self: self[2] & 64 != 0)
+    is_read2 = property(lambda self: self[2] & 128 != 0)
+    is_secondary = property(lambda self: self[2] & 256 != 0)
+    is_qcfail = property(lambda self: self[2] & 512 != 0)
+    is_duplicate = property(lambda self: self[2] & 1024 != 0)
+    is_supplementary = property(lambda self: self[2] & 2048 != 0)
+
+    def get_blocks(self):
+        return list(zip(self[8][self[10]:self[11]], self[9][self[10]:self[11]]))
+
+    def infer_query_length(self, always=False):
+        return None if self[7] < 0 else self[7]
+
+
+class CachedReads(object):
+    """
+    The alignments of a region of a fragment cache, see
+    FragmentCache.fetchReads. The flag, mapping quality, template length,
+    start, mate start, end and mate reference id of the alignments are
+    numpy arrays (see columns, which has the keys of ReadFilter.columns,
+    'referenceEnd', -1 if reference_end is None, 'end', the end position
+    used to find the alignments overlapping a region, and 'nextRefId'). The
+    CachedRead objects are only created for the alignments accessed by
+    index, e.g. to compute their fragments.
+    """
+
+    def __init__(self, cache, chrom, index):
+        self.cache = cache
+        self.chrom = chrom
+        self.index = index
+        starts = cache.column(chrom, 'start')[index].astype(np.int64)
+        ends = cache.column(chrom, 'referenceEnd')[index].astype(np.int64)
+        self.columns = {'flag': cache.column(chrom, 'flag')[index].astype(np.int64),
+                        'mapq': cache.column(chrom, 'mapq')[index].astype(np.int64),
+                        'tlen': cache.column(chrom, 'tlen')[index].astype(np.int64),
+                        'start': starts,
+                        'pnext': cache.column(chrom, 'nextStart')[index].astype(np.int64),
+                        'end': np.where(ends < 0, starts + 1, np.maximum(ends, starts + 1)),
+                        'referenceEnd': ends,
+                        'nextRefId': cache.column(chrom, 'nextRefId')[index].astype(np.int64)}
+        self.refId = cache.header['chroms'][chrom]['refId']
+        self._reads = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.reads()[i]
+
+    def __iter__(self):
+        return iter(self.reads())
+
+    def reads(self):
+        """
+        Returns the list of the CachedRead objects of the alignments
+        """
+        if self._reads is None:
+            self._reads = self._createReads()
+        return self._reads
+
+    def _createReads(self):
+        """
+        Returns the list of the CachedRead objects of the alignments,
+        which are created at once
+        """
+        cache, chrom, index = self.cache, self.chrom, self.index
+        if len(index) == 0:
+            return []
+        cols = [cache.column(chrom, name)[index].tolist()
+                for name in ('start', 'referenceEnd', 'flag', 'mapq', 'tlen',
+                             'nextStart', 'nextRefId', 'queryLength')]
+        blockPtr = cache.column(chrom, 'blockPtr')
+        firstBlock, lastBlock = int(blockPtr[index[0]]), int(blockPtr[index[-1] + 1])
+        blockStarts = cache.column(chrom, 'blockStarts')[firstBlock:lastBlock].tolist()
+        blockEnds = cache.column(chrom, 'blockEnds')[firstBlock:lastBlock].tolist()
+        refId = cache.header['chroms'][chrom]['refId']
+        values = zip(*(cols + [repeat(blockStarts), repeat(blockEnds),
+                               (blockPtr[index] - firstBlock).tolist(),
+                               (blockPtr[index + 1] - firstBlock).tolist(),
+                               repeat(refId)]))
+        return list(map(CachedRead, values))
+
+    def blocks(self, i):
+        """
+        Returns the start and end positions of the aligned blocks (see
+        CachedRead.get_blocks) of the alignments i, an array of positions,
+        along with the position in i of the alignment of each block.
+        """
+        blockPtr = self.cache.column(self.chrom, 'blockPtr')
+        index = self.index[i]
+        first = blockPtr[index]
+        count = blockPtr[index + 1] - first
+        owner = np.repeat(np.arange(len(index)), count)
+        pos = np.arange(count.sum()) + np.repeat(first - (np.cumsum(count) - count), count)
+        return (self.cache.column(self.chrom, 'blockStarts')[pos].astype(np.int64),
+                self.cache.column(self.chrom, 'blockEnds')[pos].astype(np.int64),
+                owner)
+
+    def select(self, mask):
+        """
+        Returns the alignments for which mask is True
+        """
+        return CachedReads(self.cache, self.chrom, self.index[mask])
+
+
+class FragmentCache(object):
+    """
+    A memory mapped fragment cache file. It can be used in place of the
+    pysam AlignmentFile of its bam file by the deepTools tools, i.e.
+    fetch() and count() return the same alignments, in the same order.
+
+    >>> import os
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> bamFile = root + "test_paired2.bam"
+    >>> fileName = writeFragmentCache(bamFile, getTempFileName(suffix='.dtcache'))
+    >>> cache = FragmentCache(fileName, bamFile)
+    >>> bam = openBam(bamFile)
+    >>> cache.references == bam.references, cache.lengths == bam.lengths
+    (True, True)
+    >>> attrs = lambda r: (r.reference_start, r.reference_end, r.flag, r.mapq, r.tlen,
+    ...                    r.pnext, r.next_reference_id, r.get_blocks(), r.infer_query_length(always=False))
+    >>> [attrs(r) for r in cache.fetch('chr2', 5000000, 5000100)] == \\
+    ...     [attrs(r) for r in bam.fetch('chr2', 5000000, 5000100)]
+    True
+    >>> cache.count('chr2', 5000000, 5000100) == bam.count('chr2', 5000000, 5000100)
+    True
+    >>> cache.close()
+    >>> os.remove(fileName)
+    """
+
+    def __init__(self, fileName, bamFile=None):
+        self.cacheFile = fileName
+        with open(fileName, 'rb') as f:
+            f.seek(-8 - len(MAGIC), os.SEEK_END)
+            headerEnd = f.tell()
+            headerPos, = struct.unpack('<Q', f.read(8))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("{} is not a fragment cache file".format(fileName))
+            f.seek(headerPos)
+            self.header = json.loads(f.read(headerEnd - headerPos).decode())
+        self.filename = bamFile
+        self.references = tuple(self.header['references'])
+        self.lengths = tuple(self.header['lengths'])
+        self.nreferences = len(self.references)
+        self.mapped = self.header['mapped']
+        self._data = np.memmap(fileName, dtype=np.uint8, mode='r')
+        self._columns = {}
+
+    def column(self, chrom, name):
+        """
+        Returns a column of a chromosome as a (memory mapped) numpy array
+        """
+        key = (chrom, name)
+        if key not in self._columns:
+            offset, dtype, size = self.header['chroms'][chrom][name]
+            # plain array views, slicing a memmap is much slower
+            self._columns[key] = self._data[offset:offset + size * np.dtype(dtype).itemsize] \
+                .view(np.ndarray).view(dtype)
+        return self._columns[key]
+
+    def _fetchRange(self, chrom, start=None, end=None):
+        """
+        Returns the indices of the first and the last (exclusive)
+        alignments possibly overlapping the region and a boolean mask
+        of those overlapping it.
+        """
+        if chrom not in self.header['chroms']:
+            raise ValueError("invalid contig `{}`".format(chrom))
+        starts = self.column(chrom, 'start')
+        if start is None:
+            start = 0
+        if end is None:
+            return 0, len(starts), None
+        first = np.searchsorted(self.column(chrom, 'maxEnd'), start, side='right')
+        last = np.searchsorted(starts, end, side='left')
+        ends = self.column(chrom, 'referenceEnd')[first:last].astype(np.int64)
+        readStarts = starts[first:last].astype(np.int64)
+        ends = np.where(ends < 0, readStarts + 1, np.maximum(ends, readStarts + 1))
+        return first, last, ends > start
+
+    def fetch(self, contig=None, start=None, end=None, reference=None):
+        """
+        Iterates over the alignments overlapping a region, see
+        pysam.AlignmentFile.fetch
+        """
+        chrom = contig if contig is not None else reference
+        first, last, overlaps = self._fetchRange(chrom, start, end)
+        return self._reads(chrom, first, last, overlaps)
+
+    def fetchReads(self, contig=None, start=None, end=None, reference=None):
+        """
+        Returns the alignments overlapping a region, like fetch, as
+        CachedReads, such that their columns are read as arrays.
+
+        >>> import os
+        >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> bamFile = root + "test_paired2.bam"
+        >>> fileName = writeFragmentCache(bamFile, getTempFileName(suffix='.dtcache'))
+        >>> cache = FragmentCache(fileName, bamFile)
+        >>> reads = cache.fetchReads('chr2', 5000000, 5000100)
+        >>> fetched = list(cache.fetch('chr2', 5000000, 5000100))
+        >>> list(reads) == fetched
+        True
+        >>> reads.columns['start'].tolist() == [r.reference_start for r in fetched]
+        True
+        >>> [r.get_blocks() for r in reads] == [r.get_blocks() for r in fetched]
+        True
+        >>> starts, ends, owner = reads.blocks(np.arange(len(reads)))
+        >>> [[(s, e) for s, e, o in zip(starts.tolist(), ends.tolist(), owner.tolist()) if o == i]
+        ...  for i in range(len(reads))] == [r.get_blocks() for r in fetched]
+        True
+        >>> cache.close()
+        >>> os.remove(fileName)
+        """
+        chrom = contig if contig is not None else reference
+        first, last, overlaps = self._fetchRange(chrom, start, end)
+        index = np.arange(first, max(first, last), dtype=np.int64)
+        if overlaps is not None:
+            index = index[overlaps]
+        return CachedReads(self, chrom, index)
+
+    def _reads(self, chrom, first, last, overlaps):
+        """
+        Yields the alignments first to last (exclusive) of a chromosome
+        for which overlaps is True
+        """
+        if first >= last:
+            return
+        cols = [self.column(chrom, name)[first:last].tolist()
+                for name in ('start', 'referenceEnd', 'flag', 'mapq', 'tlen',
+                             'nextStart', 'nextRefId', 'queryLength')]
+        blockPtr = self.column(chrom, 'blockPtr')[first:last + 1]
+        firstBlock, lastBlock = int(blockPtr[0]), int(blockPtr[-1])
+        blockStarts = self.column(chrom, 'blockStarts')[firstBlock:lastBlock].tolist()
+        blockEnds = self.column(chrom, 'blockEnds')[firstBlock:lastBlock].tolist()
+        blockPtr = (blockPtr - firstBlock).tolist()
+        refId = self.header['chroms'][chrom]['refId']
+
+        values = zip(*(cols + [repeat(blockStarts), repeat(blockEnds), blockPtr[:-1], blockPtr[1:],
+                               repeat(refId)]))
+        if overlaps is not None:
+            values = compress(values, overlaps.tolist())
+        for read in map(CachedRead, values):
+            yield read
+
+    def count(self, contig=None, start=None, end=None, reference=None):
+        """
+        Returns the number of alignments overlapping a region
+        """
+        chrom = contig if contig is not None else reference
+        first, last, overlaps = self._fetchRange(chrom, start, end)
+        if overlaps is None:
+            return last - first
+        return int(overlaps.sum())
+
+    def close(self):
+        self._columns = {}
+        self._data = None
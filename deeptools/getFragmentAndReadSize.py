@@ -35,7 +35,7 @@ def getFragmentLength_worker(chrom, start, end, bamFile, distanceBetweenBins):
         an np.array, where first column is fragment length, the
         second is for read length
     """
-    bam = bamHandler.openBam(bamFile)
+    bam = bamHandler.getHandle(bamFile)
     end = max(start + 1, end - distanceBetweenBins)
     if chrom in bam.references:
         reads = np.array([(abs(r.template_length), r.infer_query_length(always=False))
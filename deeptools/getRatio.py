@@ -78,3 +78,53 @@ def getRatio(tileCoverage, args):
             bin_value = value2
 
     return bin_value
+
+
+def getRatioArray(coverage, args):
+    r"""
+    Same as getRatio, but computes the values of all tiles at once
+    from a coverage matrix with a row per tile.
+
+    >>> funcArgs= {'valueType': 'ratio', 'scaleFactors': (1,1), 'pseudocount': 1}
+    >>> getRatioArray(np.array([[9, 19], [0, 0], [np.nan, 1.0]]), funcArgs).tolist()
+    [0.5, 1.0, nan]
+    >>> funcArgs['valueType'] ='first'
+    >>> getRatioArray(np.array([[9, 19], [1.0, np.nan]]), funcArgs).tolist()
+    [9.0, nan]
+    >>> funcArgs['valueType'] ='reciprocal_ratio'
+    >>> funcArgs['pseudocount'] = 0
+    >>> getRatioArray(np.array([[2, 1], [1, 2], [1, 1]]), funcArgs).tolist()
+    [2.0, -2.0, 1.0]
+    """
+    coverage = np.asarray(coverage, dtype='float64')
+    value1 = args['scaleFactors'][0] * coverage[:, 0]
+    value2 = args['scaleFactors'][1] * coverage[:, 1]
+
+    # ratio case
+    if args['valueType'] in ['ratio', 'log2', 'reciprocal_ratio']:
+        bin_value = (value1 + args['pseudocount']) / (value2 + args['pseudocount'])
+        if args['valueType'] == 'log2':
+            bin_value = np.log2(bin_value)
+        elif args['valueType'] == 'reciprocal_ratio':
+            bin_value = np.where(bin_value >= 1, bin_value, -1.0 / bin_value)
+
+    # non ratio case (diff, sum etc)
+    else:
+        if args['valueType'] == 'subtract':
+            bin_value = value1 - value2
+        elif args['valueType'] == 'add':
+            bin_value = value1 + value2
+        elif args['valueType'] == 'first':
+            bin_value = value1.copy()
+        elif args['valueType'] == 'second':
+            bin_value = value2.copy()
+
+    # if any of the two values to compare
+    # is nan, return nan
+    bin_value[np.isnan(value1) | np.isnan(value2)] = np.nan
+
+    return bin_value
+
+
+# used by writeBedGraph.applyTileFunction
+getRatio.arrayFunction = getRatioArray
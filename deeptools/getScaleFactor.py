@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import numpy as np
 import deeptools.mapReduce as mapReduce
 from deeptools import bamHandler
 from deeptools import utilities
+from deeptools.readFilter import ReadFilter
+from deeptools.fragmentCache import FragmentCache
 import sys
 
 debug = 0
@@ -17,65 +18,22 @@ def getFractionKept_wrapper(args):
 def getFractionKept_worker(chrom, start, end, bamFile, args):
     """
     Queries the BAM file and counts the number of alignments kept/found in the
-    first 50000 bases.
+    first 50000 bases. Also returns the number of alignments rejected by each
+    of the filters (see deeptools.readFilter).
     """
-    bam = bamHandler.openBam(bamFile)
+    bam = bamHandler.getHandle(bamFile)
     end = min(end, start + 50000)
     tot = 0
-    filtered = 0
-    prev_start_pos = None  # to store the start positions
+    readFilter = ReadFilter.fromArgs(args)
     if chrom in bam.references:
-        for read in bam.fetch(chrom, start, end):
-            tot += 1
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                filtered += 1
-                continue
-
-            # filter reads based on SAM flag
-            if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-                filtered += 1
-                continue
-            if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-                filtered += 1
-                continue
-
-            # fragment length filtering
-            if args.minFragmentLength > 0 and abs(read.template_length) < args.minFragmentLength:
-                filtered += 1
-                continue
-            if args.maxFragmentLength > 0 and abs(read.template_length) > args.maxFragmentLength:
-                filtered += 1
-                continue
-
-            # get rid of duplicate reads that have same position on each of the
-            # pairs
-            if args.ignoreDuplicates and prev_start_pos \
-                    and prev_start_pos == (read.reference_start, read.pnext, read.is_reverse):
-                filtered += 1
-                continue
-            prev_start_pos = (read.reference_start, read.pnext, read.is_reverse)
-
-            # If filterRNAstrand is in args, then filter accordingly
-            # This is very similar to what's used in the get_fragment_from_read function in the filterRnaStrand class
-            if hasattr(args, "filterRNAstrand"):
-                if read.is_paired:
-                    if args.filterRNAstrand == 'forward':
-                        if not ((read.flag & 128 == 128 and read.flag & 16 == 0) or (read.flag & 64 == 64 and read.flag & 32 == 0)):
-                            filtered += 1
-                            continue
-                    elif args.filterRNAstrand == 'reverse':
-                        if not (read.flag & 144 == 144 or read.flag & 96 == 96):
-                            filtered += 1
-                            continue
-                else:
-                    if args.filterRNAstrand == 'forward' and read.flag & 16 == 0:
-                        filtered += 1
-                        continue
-                    elif args.filterRNAstrand == 'reverse' and read.flag & 16 == 16:
-                        filtered += 1
-                        continue
+        if isinstance(bam, FragmentCache):
+            reads = bam.fetchReads(chrom, start, end)
+        else:
+            reads = list(bam.fetch(chrom, start, end))
+        tot = len(reads)
+        readFilter.keep(readFilter.columns(reads))
 
-    return (filtered, tot)
+    return (readFilter.rejected(), tot, [readFilter.counts[name] for name in ReadFilter.FILTERS])
 
 
 def fraction_kept(args):
@@ -101,6 +59,7 @@ def fraction_kept(args):
     """
     filtered = 0
     total = 0
+    rejected = [0] * len(ReadFilter.FILTERS)
     distanceBetweenBins = 2000000
     bam_handle = bamHandler.openBam(args.bam)
     bam_mapped = utilities.bam_total_reads(bam_handle, args.ignoreForNormalization)
@@ -117,16 +76,23 @@ def fraction_kept(args):
         if distanceBetweenBins < 50000:
             distanceBetweenBins = 50000
 
-        res = mapReduce.mapReduce((bam_handle.filename, args),
-                                  getFractionKept_wrapper,
-                                  chrom_sizes,
-                                  genomeChunkLength=distanceBetweenBins,
-                                  blackListFileName=args.blackListFileName,
-                                  numberOfProcessors=args.numberOfProcessors,
-                                  verbose=args.verbose)
+        # the (filtered, total, rejected per filter) counts are summed as they arrive
+        filtered, total, rejected = mapReduce.mapReduce((bam_handle.filename, args),
+                                                        getFractionKept_wrapper,
+                                                        chrom_sizes,
+                                                        genomeChunkLength=distanceBetweenBins,
+                                                        blackListFileName=args.blackListFileName,
+                                                        numberOfProcessors=args.numberOfProcessors,
+                                                        verbose=args.verbose,
+                                                        reducer=lambda x, y: (x[0] + y[0], x[1] + y[1],
+                                                                              [a + b for a, b in zip(x[2], y[2])]),
+                                                        reducerInit=(0, 0, [0] * len(ReadFilter.FILTERS)),
+                                                        ordered=False)
 
-        if len(res):
-            filtered, total = np.sum(res, axis=0)
+    if args.verbose:
+        for name, n in zip(ReadFilter.FILTERS, rejected):
+            if n > 0:
+                print("{0} of the {1} sampled alignments were filtered out by --{2}".format(n, total, name))
 
     if total == 0:
         # This should never happen
@@ -162,9 +128,17 @@ def get_num_kept_reads(args):
     return num_kept_reads, bam_mapped_total
 
 
-def get_scale_factor(args):
+def get_scale_factor(args, num_kept_reads=None):
+    """
+    Returns the scale factor of the normalization given by args. The
+    number of kept reads, as returned by get_num_kept_reads, can be
+    given to compute the scale factors of several normalizations of
+    the same file without counting the reads again.
+    """
     scale_factor = args.scaleFactor
-    bam_mapped, bam_mapped_total = get_num_kept_reads(args)
+    if num_kept_reads is None:
+        num_kept_reads = get_num_kept_reads(args)
+    bam_mapped, bam_mapped_total = num_kept_reads
     if args.normalizeTo1x:
         # Print output, since normalzation stuff isn't printed to stderr otherwise
         sys.stderr.write("normalization: 1x\n")
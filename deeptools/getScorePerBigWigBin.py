@@ -7,6 +7,7 @@ import warnings
 
 # deepTools packages
 import deeptools.mapReduce as mapReduce
+from deeptools import bamHandler
 import deeptools.utilities
 # debug = 0
 
@@ -61,7 +62,7 @@ def countFragmentsInRegions_worker(chrom, start, end,
 
     bigwig_handlers = []
     for foo in bigWigFiles:
-        bigwig_handlers.append(pyBigWig.open(foo))
+        bigwig_handlers.append(bamHandler.getHandle(foo))
 
     regions_to_consider = []
     if bedRegions:
@@ -1,17 +1,30 @@
 import sys
 from os.path import splitext, basename
-import gzip
 from collections import OrderedDict
 import numpy as np
 from copy import deepcopy
-
 import pyBigWig
+
 from deeptools import getScorePerBigWigBin
 from deeptools import mapReduce
+from deeptools import bamHandler
+from deeptools import matrixFile
+from deeptools import blockGzip
 from deeptools.utilities import toString, toBytes
 
 old_settings = np.seterr(all='ignore')
 
+# pyBigWig returns the values of a region as a numpy array, instead of a
+# list, if it was built with numpy support
+BIGWIG_NUMPY = bool(getattr(pyBigWig, 'numpy', 0))
+# bins of at least this length (in bp) are summarized by pyBigWig if
+# the values would be returned as lists (see coverage_from_big_wig_summary)
+SUMMARY_MIN_BIN_LENGTH = 2000
+# the values of regions less than SPAN_MAX_GAP bp apart are fetched at
+# once, in spans of up to SPAN_MAX_LENGTH bp (see get_value_spans)
+SPAN_MAX_GAP = 10000
+SPAN_MAX_LENGTH = 1000000
+
 
 def chopRegions(exonsInput, left=0, right=0):
     """
@@ -344,7 +357,7 @@ class heatmapper(object):
         # read BAM or scores file
         score_file_handlers = []
         for sc_file in score_file_list:
-            score_file_handlers.append(pyBigWig.open(sc_file))
+            score_file_handlers.append(bamHandler.getHandle(sc_file))
 
         # determine the number of matrix columns based on the lengths
         # given by the user, times the number of score files
@@ -358,9 +371,10 @@ class heatmapper(object):
         sub_matrix = np.zeros((len(regions), matrix_cols))
         sub_matrix[:] = np.NAN
 
-        j = 0
-        sub_regions = []
-        regions_no_score = 0
+        # the zones of each region (see coverage_from_big_wig) and the
+        # number of nan bins before and after them, or None for the
+        # regions that are skipped
+        windows = []
         for transcript in regions:
             feature_chrom = transcript[0]
             exons = transcript[1]
@@ -386,9 +400,7 @@ class heatmapper(object):
                                      "({0}) {1} {2}:{3}:{4}. Skipping...\n".format((body_length - parameters['unscaled 5 prime'] - parameters['unscaled 3 prime']),
                                                                                    feature_name, feature_chrom,
                                                                                    feature_start, feature_end))
-                coverage = np.zeros(matrix_cols)
-                if not parameters['missing data as zero']:
-                    coverage[:] = np.nan
+                windows.append(None)
             else:
                 if feature_strand == '-':
                     if parameters['downstream'] > 0:
@@ -495,18 +507,48 @@ class heatmapper(object):
                     if expected - padRightNaN - e > 0:
                         padRightNaN += 1
 
+                windows.append((zones, padLeftNaN, padRightNaN))
+
+        # compute the values for each of the files being processed, for all
+        # the regions of a chromosome at once (see coverage_from_big_wig_regions)
+        chrom_windows = OrderedDict()
+        for idx, window in enumerate(windows):
+            if window is not None:
+                chrom_windows.setdefault(regions[idx][0], []).append(idx)
+        file_coverages = []
+        for sc_handler in score_file_handlers:
+            file_coverage = {}
+            for feature_chrom, indices in chrom_windows.items():
+                # We're only supporting bigWig files at this point
+                covs = heatmapper.coverage_from_big_wig_regions(
+                    sc_handler, feature_chrom, [windows[idx][0] for idx in indices],
+                    parameters['bin size'],
+                    parameters['bin avg type'],
+                    parameters['missing data as zero'],
+                    parameters['verbose'])
+                file_coverage.update(zip(indices, covs))
+            file_coverages.append(file_coverage)
+
+        j = 0
+        sub_regions = []
+        regions_no_score = 0
+        for idx, transcript in enumerate(regions):
+            feature_chrom = transcript[0]
+            feature_start = transcript[1][0][0]
+            feature_end = transcript[1][-1][1]
+            feature_name = transcript[2]
+            feature_strand = transcript[4]
+
+            if windows[idx] is None:
+                coverage = np.zeros(matrix_cols)
+                if not parameters['missing data as zero']:
+                    coverage[:] = np.nan
+            else:
+                _, padLeftNaN, padRightNaN = windows[idx]
                 coverage = []
-                # compute the values for each of the files being processed.
                 # "cov" is a numpy array of bins
-                for sc_handler in score_file_handlers:
-                    # We're only supporting bigWig files at this point
-                    cov = heatmapper.coverage_from_big_wig(
-                        sc_handler, feature_chrom, zones,
-                        parameters['bin size'],
-                        parameters['bin avg type'],
-                        parameters['missing data as zero'],
-                        parameters['verbose'])
-
+                for file_coverage in file_coverages:
+                    cov = file_coverage[idx]
                     if padLeftNaN > 0:
                         cov = np.concatenate([[np.nan] * padLeftNaN, cov])
                     if padRightNaN > 0:
@@ -565,42 +607,111 @@ class heatmapper(object):
 
     @staticmethod
     def coverage_from_array(valuesArray, zones, binSize, avgType):
+        """
+        Summarizes the per base values of the zones (see
+        coverage_from_big_wig) into their bins, using summarize_bins.
+
+        >>> values = np.array([1.0, 2, 3, 4, np.nan, 6, 7, 8, 9, 10])
+        >>> zones = [([(0, 4)], 2), ([(4, 10)], 4)]
+        >>> heatmapper.coverage_from_array(values, zones, 2, 'mean').tolist()
+        [1.5, 3.5, nan, 6.5, 8.0, 9.5]
+        """
         try:
             valuesArray[0]
         except (IndexError, TypeError) as detail:
             sys.stderr.write("{0}\nvalues array value: {1}, zones {2}\n".format(detail, valuesArray, zones))
 
-        cvglist = []
-        zoneEnd = 0
-        valStart = 0
+        binStarts = []
+        binEnds = []
         valEnd = 0
         for zone, nBins in zones:
             if nBins:
                 # linspace is used to more or less evenly partition the data points into the given number of bins
-                zoneEnd += nBins
                 valStart = valEnd
                 valEnd += np.sum([x[1] - x[0] for x in zone])
-                counts_list = []
 
                 # Partition the space into bins
                 if nBins == 1:
                     pos_array = np.array([valStart])
                 else:
                     pos_array = np.linspace(valStart, valEnd, nBins, endpoint=False, dtype=int)
-                pos_array = np.append(pos_array, valEnd)
+                pos_array = np.append(pos_array, valEnd).astype(np.int64)
 
-                idx = 0
-                while idx < nBins:
-                    idxStart = int(pos_array[idx])
-                    idxEnd = max(int(pos_array[idx + 1]), idxStart + 1)
-                    try:
-                        counts_list.append(heatmapper.my_average(valuesArray[idxStart:idxEnd], avgType))
-                    except Exception as detail:
-                        sys.stderr.write("Exception found: {0}\n".format(detail))
-                    idx += 1
-                cvglist.append(np.array(counts_list))
+                # every bin has at least one value
+                binStarts.append(pos_array[:-1])
+                binEnds.append(np.maximum(pos_array[1:], pos_array[:-1] + 1))
 
-        return np.concatenate(cvglist)
+        return heatmapper.summarize_bins(valuesArray, np.concatenate(binStarts),
+                                         np.concatenate(binEnds), avgType)
+
+    @staticmethod
+    def summarize_bins(valuesArray, binStarts, binEnds, avgType='mean'):
+        """
+        Computes the mean, median, min, max, sum or std of the values
+        valuesArray[binStarts[i]:binEnds[i]] of every bin, ignoring the
+        nan and inf values as my_average does. Bins without any value
+        get a nan.
+
+        Instead of calling my_average for every bin, the bins of the same
+        length are summarized at once as the rows of a matrix. As a row
+        is reduced in the same order as a single bin, the results are
+        identical.
+
+        >>> values = np.array([1.0, 2, np.nan, 4, 5, 6, 7])
+        >>> heatmapper.summarize_bins(values, [0, 2, 3, 5], [2, 3, 5, 9], 'mean').tolist()
+        [1.5, nan, 4.5, 6.5]
+        >>> heatmapper.summarize_bins(values, [0, 2, 3], [4, 3, 7], 'median').tolist()
+        [2.0, nan, 5.5]
+        """
+        valuesArray = np.asarray(valuesArray, dtype='float64')
+        binStarts = np.asarray(binStarts, dtype=np.int64)
+        # as for a slice, the bins end at the end of the values
+        binEnds = np.minimum(np.asarray(binEnds, dtype=np.int64), len(valuesArray))
+        lengths = binEnds - binStarts
+
+        summary = np.zeros(len(binStarts))
+        summary[:] = np.nan
+        for length in np.unique(lengths[lengths > 0]).tolist():
+            rows = np.flatnonzero(lengths == length)
+            values = valuesArray[binStarts[rows, np.newaxis] + np.arange(length)]
+            summary[rows] = heatmapper.summarize_rows(values, avgType)
+        return summary
+
+    @staticmethod
+    def summarize_rows(values, avgType='mean'):
+        """
+        Same as my_average, for each row of a matrix
+
+        >>> values = np.array([[1.0, 2, 4], [np.nan, 3, np.nan], [np.nan, np.nan, np.nan]])
+        >>> heatmapper.summarize_rows(values, 'std').tolist()
+        [1.247219128924647, 0.0, nan]
+        >>> heatmapper.summarize_rows(values, 'max').tolist()
+        [4.0, 3.0, nan]
+        """
+        invalid = ~np.isfinite(values)
+        count = values.shape[1] - invalid.sum(axis=1)
+        if avgType in ('mean', 'sum', 'std'):
+            total = np.where(invalid, 0, values).sum(axis=1)
+            if avgType == 'sum':
+                summary = total
+            else:
+                summary = total / count
+                if avgType == 'std':
+                    anomaly = np.where(invalid, 0, values - summary[:, np.newaxis])
+                    summary = np.sqrt((anomaly * anomaly).sum(axis=1) / count)
+        elif avgType == 'max':
+            summary = np.where(invalid, -np.inf, values).max(axis=1)
+        elif avgType == 'min':
+            summary = np.where(invalid, np.inf, values).min(axis=1)
+        elif avgType == 'median':
+            # the invalid values are sorted to the end of each row
+            values = np.sort(np.where(invalid, np.nan, values), axis=1)
+            rows = np.arange(values.shape[0])
+            summary = (values[rows, np.maximum(count - 1, 0) // 2] + values[rows, count // 2]) / 2.0
+        else:
+            summary = np.array([heatmapper.my_average(row, avgType) for row in values], dtype='float64')
+        summary[count == 0] = np.nan
+        return summary
 
     @staticmethod
     def change_chrom_names(chrom):
@@ -672,6 +783,50 @@ class heatmapper(object):
                 return heatmapper.coverage_from_array(values_array, zones, binSize, avgType)
 
         maxLen = bigwig.chroms(chrom)
+        if not nansAsZeros and not BIGWIG_NUMPY and binSize >= SUMMARY_MIN_BIN_LENGTH:
+            cov = heatmapper.coverage_from_big_wig_summary(bigwig, chrom, zones, avgType, maxLen)
+            if cov is not None:
+                return cov
+
+        values_array = heatmapper.values_from_zones(
+            zones, maxLen, lambda start, end: heatmapper.get_big_wig_values(bigwig, chrom, start, end),
+            nansAsZeros)
+
+        return heatmapper.coverage_from_array(values_array, zones,
+                                              binSize, avgType)
+
+    @staticmethod
+    def get_big_wig_values(bigwig, chrom, start, end):
+        """
+        Returns the per base values of an interval of a bigWig file as
+        a numpy array
+        """
+        if BIGWIG_NUMPY:
+            return bigwig.values(chrom, start, end, numpy=True)
+        return np.array(bigwig.values(chrom, start, end))
+
+    @staticmethod
+    def values_from_zones(zones, chromLength, getValues, nansAsZeros=False):
+        """
+        Returns the per base values of the zones (see coverage_from_big_wig)
+        as a single array. getValues(start, end) returns the values of an
+        interval of the chromosome. Positions outside of the chromosome
+        are nan (or zero, if nansAsZeros is set).
+
+        >>> values = np.arange(10.0)
+        >>> heatmapper.values_from_zones([([(-2, 3)], 1), ([(8, 12)], 1)], 10,
+        ...                              lambda start, end: values[start:end]).tolist()
+        [nan, nan, 0.0, 1.0, 2.0, 8.0, 9.0, nan, nan]
+        """
+        nVals = 0
+        for zone, _ in zones:
+            for region in zone:
+                nVals += region[1] - region[0]
+
+        values_array = np.zeros(nVals)
+        if not nansAsZeros:
+            values_array[:] = np.nan
+
         startIdx = 0
         endIdx = 0
         for zone, _ in zones:
@@ -682,11 +837,11 @@ class heatmapper(object):
                     values_array[startIdx:endIdx] = np.nan
                     startIdx = endIdx
                 start = max(0, region[0])
-                end = min(maxLen, region[1])
+                end = min(chromLength, region[1])
                 endIdx += end - start
                 if start < end:
                     # This won't be the case if we extend off the front of a chromosome, such as (-100, 0)
-                    values_array[startIdx:endIdx] = bigwig.values(chrom, start, end)
+                    values_array[startIdx:endIdx] = getValues(start, end)
                 if end < region[1]:
                     startIdx = endIdx
                     endIdx += region[1] - end
@@ -696,8 +851,175 @@ class heatmapper(object):
         if nansAsZeros:
             values_array[np.isnan(values_array)] = 0
 
-        return heatmapper.coverage_from_array(values_array, zones,
-                                              binSize, avgType)
+        return values_array
+
+    @staticmethod
+    def coverage_from_big_wig_regions(bigwig, chrom, zonesList, binSize, avgType, nansAsZeros=False, verbose=True):
+        """
+        Same as coverage_from_big_wig, for the zones of several regions of
+        a chromosome. Returns the list of the bin values of each region.
+
+        Instead of fetching the values of every zone separately, nearby
+        regions are grouped into spans (see get_value_spans). The values of
+        a span are fetched at once and each region takes its values from
+        them. Regions with identical zones (see unique_zones) are computed
+        only once and share their bin values.
+
+        >>> import os
+        >>> import pyBigWig
+        >>> bw = pyBigWig.open(os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/testA.bw")
+        >>> zonesList = [[([(50, 150)], 2)], [([(140, 160)], 2), ([(180, 220)], 2)]]
+        >>> [x.tolist() for x in heatmapper.coverage_from_big_wig_regions(bw, '3R', zonesList, 10, 'mean')]
+        [[1.0, 2.0], [2.0, 2.0, 2.0, nan]]
+        >>> [heatmapper.coverage_from_big_wig(bw, '3R', zones, 10, 'mean').tolist() for zones in zonesList]
+        [[1.0, 2.0], [2.0, 2.0, 2.0, nan]]
+        """
+        uniqueZones, index = heatmapper.unique_zones(zonesList)
+        if len(uniqueZones) < len(zonesList):
+            # e.g. the transcripts of a gene that share their TSS
+            coverages = heatmapper.coverage_from_big_wig_regions(bigwig, chrom, uniqueZones, binSize, avgType,
+                                                                 nansAsZeros, verbose)
+            return [coverages[idx] for idx in index]
+
+        chromNames = bigwig.chroms()
+        if chrom not in chromNames and heatmapper.change_chrom_names(chrom) in chromNames:
+            chrom = heatmapper.change_chrom_names(chrom)
+        if chrom not in chromNames or \
+                (not nansAsZeros and not BIGWIG_NUMPY and binSize >= SUMMARY_MIN_BIN_LENGTH):
+            return [heatmapper.coverage_from_big_wig(bigwig, chrom, zones, binSize, avgType, nansAsZeros, verbose)
+                    for zones in zonesList]
+        maxLen = chromNames[chrom]
+
+        # the interval of the chromosome whose values each region needs
+        extents = []
+        for zones in zonesList:
+            intervals = [(max(0, region[0]), min(maxLen, region[1])) for zone, _ in zones for region in zone]
+            intervals = [x for x in intervals if x[0] < x[1]]
+            if intervals:
+                extents.append((min([x[0] for x in intervals]), max([x[1] for x in intervals])))
+            else:
+                extents.append(None)
+
+        coverages = [None] * len(zonesList)
+        for spanStart, spanEnd, indices in heatmapper.get_value_spans(extents):
+            spanValues = heatmapper.get_big_wig_values(bigwig, chrom, spanStart, spanEnd)
+            for idx in indices:
+                values_array = heatmapper.values_from_zones(
+                    zonesList[idx], maxLen, lambda start, end: spanValues[start - spanStart:end - spanStart],
+                    nansAsZeros)
+                coverages[idx] = heatmapper.coverage_from_array(values_array, zonesList[idx], binSize, avgType)
+
+        # regions entirely outside of the chromosome
+        for idx, extent in enumerate(extents):
+            if extent is None:
+                values_array = heatmapper.values_from_zones(zonesList[idx], maxLen, None, nansAsZeros)
+                coverages[idx] = heatmapper.coverage_from_array(values_array, zonesList[idx], binSize, avgType)
+        return coverages
+
+    @staticmethod
+    def unique_zones(zonesList):
+        """
+        Returns the distinct zones of a list of zones (see
+        coverage_from_big_wig), in order of first appearance, and the
+        position of the zones of each region among them.
+
+        >>> unique, index = heatmapper.unique_zones([[([(0, 10)], 1)], [([(5, 10)], 1)], [([[0, 10]], 1)]])
+        >>> unique, index
+        ([[([(0, 10)], 1)], [([(5, 10)], 1)]], [0, 1, 0])
+        """
+        unique = []
+        index = []
+        positions = {}
+        for zones in zonesList:
+            key = tuple([(tuple([(int(region[0]), int(region[1])) for region in zone]), int(nBins))
+                         for zone, nBins in zones])
+            if key not in positions:
+                positions[key] = len(unique)
+                unique.append(zones)
+            index.append(positions[key])
+        return unique, index
+
+    @staticmethod
+    def get_value_spans(extents, maxGap=SPAN_MAX_GAP, maxLength=SPAN_MAX_LENGTH):
+        """
+        Groups the (start, end) intervals needed by several regions into
+        spans of nearby intervals, less than maxGap bp apart. A span is at
+        most maxLength bp long, unless a single interval is longer, which
+        bounds the memory used by the values of a span. Intervals that are
+        None are skipped.
+
+        Returns a list of [span start, span end, indices of the intervals].
+
+        >>> heatmapper.get_value_spans([(500, 600), (0, 100), None, (150, 300), (5000, 5100)], maxGap=1000)
+        [[0, 600, [1, 3, 0]], [5000, 5100, [4]]]
+        >>> heatmapper.get_value_spans([(0, 100), (150, 300), (350, 400)], maxGap=1000, maxLength=300)
+        [[0, 300, [0, 1]], [350, 400, [2]]]
+        """
+        order = sorted([idx for idx, extent in enumerate(extents) if extent is not None],
+                       key=lambda idx: extents[idx][0])
+        spans = []
+        for idx in order:
+            start, end = extents[idx]
+            if spans and start - spans[-1][1] < maxGap and max(end, spans[-1][1]) - spans[-1][0] <= maxLength:
+                spans[-1][1] = max(end, spans[-1][1])
+                spans[-1][2].append(idx)
+            else:
+                spans.append([start, end, [idx]])
+        return spans
+
+    @staticmethod
+    def coverage_from_big_wig_summary(bigwig, chrom, zones, avgType, chromLength):
+        """
+        Same as coverage_from_big_wig, but the bin values are computed by
+        pyBigWig from the per base values of each zone (stats with
+        exact=True) instead of being computed from the values array.
+
+        This is only possible if the bins are those of coverage_from_array:
+        every zone must be a single interval within the chromosome that is
+        split into bins of equal length, as in the common reference-point
+        case. Otherwise (e.g. for the exons of --metagene), and for the
+        median, std and sum, which pyBigWig does not compute the same way,
+        None is returned.
+
+        pyBigWig queries the file once per bin, hence this is only faster
+        for long bins and if the per base values would be returned as a
+        list (see BIGWIG_NUMPY).
+
+        >>> import os
+        >>> import pyBigWig
+        >>> bw = pyBigWig.open(os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/testA.bw")
+        >>> zones = [([(50, 150)], 2), ([(150, 200)], 1)]
+        >>> heatmapper.coverage_from_big_wig_summary(bw, '3R', zones, 'max', 200).tolist()
+        [1.0, 2.0, 2.0]
+        >>> heatmapper.coverage_from_big_wig(bw, '3R', zones, 50, 'max').tolist()
+        [1.0, 2.0, 2.0]
+        >>> heatmapper.coverage_from_big_wig_summary(bw, '3R', [([(50, 100), (150, 200)], 2)], 'max', 200) is None
+        True
+        """
+        if avgType not in ('mean', 'max', 'min'):
+            return None
+        for zone, nBins in zones:
+            length = sum([x[1] - x[0] for x in zone])
+            if nBins == 0:
+                # zones without bins must be empty, see coverage_from_array
+                if length > 0:
+                    return None
+                continue
+            if len(zone) != 1 or length == 0 or length % nBins > 0 or \
+                    zone[0][0] < 0 or zone[0][1] > chromLength:
+                return None
+
+        cov = []
+        try:
+            for zone, nBins in zones:
+                if nBins:
+                    cov.extend(bigwig.stats(chrom, int(zone[0][0]), int(zone[0][1]),
+                                            type=avgType, nBins=int(nBins), exact=True))
+        except (TypeError, RuntimeError):
+            # pyBigWig versions without exact summaries
+            return None
+        # bins without values are None
+        return np.array(cov, dtype='float64')
 
     @staticmethod
     def my_average(valuesArray, avgType='mean'):
@@ -719,57 +1041,106 @@ class heatmapper(object):
         self.lengthDict = OrderedDict()
         self.matrixAvgsDict = OrderedDict()
 
-    def read_matrix_file(self, matrix_file):
+    def read_matrix_file(self, matrix_file, numberOfProcessors=None):
         # reads a bed file containing the position
         # of genomic intervals
         # In case a hash sign '#' is found in the
         # file, this is considered as a delimiter
         # to split the heatmap into groups
 
-        import json
+        if matrixFile.isMatrixFile(matrix_file):
+            # binary matrix file, the regions and values are only read
+            # when they are needed
+            mf = matrixFile.MatrixFile(matrix_file)
+            self.parameters = deepcopy(mf.parameters)
+            self.matrix = _matrix(None, None, self.parameters['group_boundaries'],
+                                  self.parameters['sample_boundaries'],
+                                  group_labels=self.parameters['group_labels'],
+                                  sample_labels=self.parameters['sample_labels'],
+                                  matrix_file=mf)
+            if 'sort regions' in self.parameters:
+                self.matrix.set_sorting_method(self.parameters['sort regions'],
+                                               self.parameters['sort using'])
+            return
+
+        # the blocks of the file are decompressed and parsed in parallel
+        # (see deeptools.blockGzip)
         regions = []
         matrix_rows = []
+        for parameters, block_regions, block_matrix in blockGzip.readBlocks(
+                matrix_file, heatmapper.parse_matrix_block, numberOfProcessors):
+            if parameters is not None:
+                self.parameters = parameters
+            regions.extend(block_regions)
+            if len(block_regions):
+                matrix_rows.append(block_matrix)
+
+        # get the group index
         current_group_index = 0
-        max_group_bound = None
+        max_group_bound = self.parameters['group_boundaries'][1]
+        for idx, region in enumerate(regions):
+            if idx >= max_group_bound:
+                current_group_index += 1
+                max_group_bound = self.parameters['group_boundaries'][current_group_index + 1]
+            region[3] = max_group_bound
+
+        # like np.vstack of masked rows, nan values are not masked
+        matrix = np.vstack(matrix_rows).view(np.ma.MaskedArray)
+        self.matrix = _matrix(regions, matrix, self.parameters['group_boundaries'],
+                              self.parameters['sample_boundaries'],
+                              group_labels=self.parameters['group_labels'],
+                              sample_labels=self.parameters['sample_labels'])
+
+        if 'sort regions' in self.parameters:
+            self.matrix.set_sorting_method(self.parameters['sort regions'],
+                                           self.parameters['sort using'])
+        return
 
-        fh = gzip.open(matrix_file)
-        for line in fh:
-            line = toString(line).strip()
+    @staticmethod
+    def parse_matrix_block(data):
+        """
+        Parses a block of lines of a matrix file (see save_matrix).
+        Returns the parameters, if the block contains the header, the
+        regions (without their group boundaries) and the matrix values.
+
+        >>> data = b'@{"bin size":10}\\nchr1\\t0,20\\t10,30\\ta\\t0\\t+\\t1.000000\\tnan\\n'
+        >>> parameters, regions, matrix = heatmapper.parse_matrix_block(data)
+        >>> parameters == {'bin size': 10}
+        True
+        >>> regions, matrix.tolist()
+        ([['chr1', [(0, 10), (20, 30)], 'a', None, '+', '0']], [[1.0, nan]])
+        """
+        import json
+        parameters = None
+        regions = []
+        values = []
+        for line in toString(data).split("\n"):
+            line = line.strip()
+            if not line:
+                continue
             # read the header file containing the parameters
             # used
             if line.startswith("@"):
                 # the parameters used are saved using
                 # json
-                self.parameters = json.loads(line[1:].strip())
-                max_group_bound = self.parameters['group_boundaries'][1]
+                parameters = json.loads(line[1:].strip())
                 continue
 
             # split the line into bed interval and matrix values
             region = line.split('\t')
             chrom, start, end, name, score, strand = region[0:6]
-            matrix_row = np.ma.masked_invalid(np.fromiter(region[6:], np.float))
-            matrix_rows.append(matrix_row)
+            values.extend(region[6:])
             starts = start.split(",")
             ends = end.split(",")
             regs = [(int(x), int(y)) for x, y in zip(starts, ends)]
-            # get the group index
-            if len(regions) >= max_group_bound:
-                current_group_index += 1
-                max_group_bound = self.parameters['group_boundaries'][current_group_index + 1]
-            regions.append([chrom, regs, name, max_group_bound, strand, score])
-
-        matrix = np.vstack(matrix_rows)
-        self.matrix = _matrix(regions, matrix, self.parameters['group_boundaries'],
-                              self.parameters['sample_boundaries'],
-                              group_labels=self.parameters['group_labels'],
-                              sample_labels=self.parameters['sample_labels'])
+            regions.append([chrom, regs, name, None, strand, score])
 
-        if 'sort regions' in self.parameters:
-            self.matrix.set_sorting_method(self.parameters['sort regions'],
-                                           self.parameters['sort using'])
-        return
+        matrix = np.array(values, dtype=np.float64)
+        if regions:
+            matrix = matrix.reshape(len(regions), -1)
+        return parameters, regions, matrix
 
-    def save_matrix(self, file_name):
+    def save_matrix(self, file_name, file_format='gzip', numberOfProcessors=None):
         """
         saves the data required to reconstruct the matrix
         the format is:
@@ -783,7 +1154,12 @@ class heatmapper(object):
         Groups are separated by adding a line starting with a hash (#)
         and followed by the group name.
 
-        The file is gzipped.
+        The file is gzipped, as a block gzip file (see
+        deeptools.blockGzip) whose blocks are compressed by
+        numberOfProcessors threads.
+
+        If file_format is 'binary', a binary matrix file (see
+        deeptools.matrixFile) is saved instead.
         """
         import json
         self.parameters['sample_labels'] = self.matrix.sample_labels
@@ -791,32 +1167,39 @@ class heatmapper(object):
         self.parameters['sample_boundaries'] = self.matrix.sample_boundaries
         self.parameters['group_boundaries'] = self.matrix.group_boundaries
 
-        fh = gzip.open(file_name, 'wb')
+        if file_format == 'binary':
+            matrixFile.writeMatrixFile(file_name, self.parameters, self.matrix.regions, self.matrix.matrix)
+            return
+
         params_str = json.dumps(self.parameters, separators=(',', ':'))
-        fh.write(toBytes("@" + params_str + "\n"))
-        score_list = np.ma.masked_invalid(np.mean(self.matrix.matrix, axis=1))
+        blockGzip.writeBlocks(file_name, blockGzip.iterBlocks(self.matrix_lines("@" + params_str + "\n")),
+                              numberOfProcessors)
+
+    def matrix_lines(self, header):
+        """
+        Returns the header and then the lines of the regions of a matrix
+        file (see save_matrix)
+        """
+        yield header
+        values_fmt = "\t".join(["%f"] * self.matrix.matrix.shape[1])
+        # the values under the mask, if any, are saved as well
+        matrix = np.asarray(self.matrix.matrix)
         for idx, region in enumerate(self.matrix.regions):
-            # join np_array values
             # keeping nans while converting them to strings
-            if not np.ma.is_masked(score_list[idx]):
-                np.float(score_list[idx])
-            matrix_values = "\t".join(
-                np.char.mod('%f', self.matrix.matrix[idx, :]))
+            matrix_values = values_fmt % tuple(matrix[idx, :].tolist())
             starts = ["{0}".format(x[0]) for x in region[1]]
             ends = ["{0}".format(x[1]) for x in region[1]]
             starts = ",".join(starts)
             ends = ",".join(ends)
             # BEDish format (we don't currently store the score)
-            fh.write(
-                toBytes('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(
-                        region[0],
-                        starts,
-                        ends,
-                        region[2],
-                        region[5],
-                        region[4],
-                        matrix_values)))
-        fh.close()
+            yield '{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(
+                region[0],
+                starts,
+                ends,
+                region[2],
+                region[5],
+                region[4],
+                matrix_values)
 
     def save_tabulated_values(self, file_handle, reference_point_label='TSS', start_label='TSS', end_label='TES', averagetype='mean'):
         """
@@ -1002,19 +1385,26 @@ class _matrix(object):
     PolII in males vs. PolII in females.
 
     This is an internal class of the heatmapper class
+
+    The regions and matrix can also be read from a binary matrix file
+    (matrix_file, see deeptools.matrixFile), the first time that they
+    are used.
     """
 
     def __init__(self, regions, matrix, group_boundaries, sample_boundaries,
-                 group_labels=None, sample_labels=None):
+                 group_labels=None, sample_labels=None, matrix_file=None):
+
+        self.matrix_file = matrix_file
+        self._regions = regions
+        self._matrix = matrix
+        shape = matrix.shape if matrix is not None else matrix_file.shape
 
         # simple checks
-        assert matrix.shape[0] == group_boundaries[-1], \
+        assert shape[0] == group_boundaries[-1], \
             "row max do not match matrix shape"
-        assert matrix.shape[1] == sample_boundaries[-1], \
+        assert shape[1] == sample_boundaries[-1], \
             "col max do not match matrix shape"
 
-        self.regions = regions
-        self.matrix = matrix
         self.group_boundaries = group_boundaries
         self.sample_boundaries = sample_boundaries
         self.sort_method = None
@@ -1036,6 +1426,27 @@ class _matrix(object):
                 "number of sample labels does not match number of samples"
             self.sample_labels = sample_labels
 
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            # like the matrix read from a text file, nan values are not masked
+            self._matrix = self.matrix_file.matrix().astype(np.float64).view(np.ma.MaskedArray)
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self._matrix = matrix
+
+    @property
+    def regions(self):
+        if self._regions is None:
+            self._regions = self.matrix_file.regions()
+        return self._regions
+
+    @regions.setter
+    def regions(self, regions):
+        self._regions = regions
+
     def get_matrix(self, group, sample):
         """
         Returns a sub matrix from the large
@@ -1053,6 +1464,13 @@ class _matrix(object):
         sample_start = self.sample_boundaries[sample]
         sample_end = self.sample_boundaries[sample + 1]
 
+        if self._matrix is None and list(self.group_boundaries) == self.matrix_file.group_boundaries and \
+                list(self.sample_boundaries) == self.matrix_file.sample_boundaries:
+            # only read the values of this group and sample
+            return {'matrix': np.ma.masked_invalid(self.matrix_file.block(group, sample).astype(np.float64)),
+                    'group': self.group_labels[group],
+                    'sample': self.sample_labels[sample]}
+
         return {'matrix': np.ma.masked_invalid(self.matrix[group_start:group_end, :][:, sample_start:sample_end]),
                 'group': self.group_labels[group],
                 'sample': self.sample_labels[sample]}
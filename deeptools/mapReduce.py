@@ -1,9 +1,85 @@
+import atexit
 import multiprocessing
+import os
+import pickle
+import threading
+import uuid
+import numpy as np
 from deeptoolsintervals import GTF
 import random
 
+from deeptools.utilities import getTempFileName, getBlackList
+from deeptools import bamHandler
+
 debug = 0
 
+# Worker pool shared by all mapReduce calls of a tool invocation (see startPool)
+_sharedPool = None
+
+# Context (self_ and static arguments) of the current mapReduce call, as
+# loaded by a worker process (see _shareContext)
+_workerContext = {}
+
+
+def startPool(numberOfProcessors, initializer=None, initargs=()):
+    """
+    Starts a pool of worker processes that is reused by every subsequent
+    mapReduce call, instead of forking a new pool for each of them. This
+    is meant to be called once at the start of a tool, and the pool shut
+    down with closePool() once the tool is done (this also happens
+    automatically when the interpreter exits).
+
+    Note that the workers are forked at this point, so module level
+    variables set afterwards in the parent are not visible to them. Tools
+    that rely on such variables must not use a shared pool.
+
+    :param numberOfProcessors: Number of worker processes. No pool is
+                               started if this is smaller than 2.
+    :param initializer: Function called once in each worker on startup.
+    :param initargs: Arguments passed to the initializer.
+    :return: The pool, or None if no pool was started.
+    """
+    global _sharedPool
+
+    closePool()
+    if numberOfProcessors is None or numberOfProcessors < 2:
+        return None
+
+    _sharedPool = multiprocessing.Pool(numberOfProcessors, initializer, initargs)
+    return _sharedPool
+
+
+def getPool():
+    """
+    Returns the shared worker pool, or None if startPool() was not called.
+    """
+    return _sharedPool
+
+
+def closePool():
+    """
+    Shuts down the shared worker pool, if any, waiting for the workers
+    to finish. The handles opened by the current process are closed
+    as well, a file may be rewritten before the next pool is started.
+
+    >>> import os
+    >>> bamFile = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/testA.bam"
+    >>> bam = bamHandler.getHandle(bamFile)
+    >>> closePool()
+    >>> bam is bamHandler.getHandle(bamFile)
+    False
+    """
+    global _sharedPool
+
+    if _sharedPool is not None:
+        _sharedPool.close()
+        _sharedPool.join()
+    _sharedPool = None
+    bamHandler.closeHandles()
+
+
+atexit.register(closePool)
+
 
 def mapReduce(staticArgs, func, chromSize,
               genomeChunkLength=None,
@@ -17,7 +93,16 @@ def mapReduce(staticArgs, func, chromSize,
               transcriptID="transcriptID",
               exonID="exonID",
               transcript_id_designator="transcript_id",
-              self_=None):
+              self_=None,
+              reducer=None,
+              reducerInit=None,
+              ordered=True,
+              maxPendingTasks=None,
+              readDensity=None,
+              chunkAlignment=1,
+              chunkMargin=0,
+              emptyChunkFunc=None,
+              planFunc=None):
     """
     Split the genome into parts that are sent to workers using a defined
     number of procesors. Results are collected and returned.
@@ -54,10 +139,201 @@ def mapReduce(staticArgs, func, chromSize,
     :param includeLabels: Pass group and transcript labels into the calling
                           function. These are added to the static args
                           (groupLabel and transcriptName).
+    :param reducer: If given, the results are not collected into a list.
+                    Instead, tasks are generated lazily, the results are
+                    streamed back (see imapReduce) and folded as they
+                    arrive, calling reducer(accumulated, result). The
+                    final accumulated value is returned.
+    :param reducerInit: The initial value passed to the reducer.
+    :param ordered: In streaming mode, whether the results are folded in
+                    task order (True) or as soon as they finish (False).
+    :param maxPendingTasks: In streaming mode, the maximum number of
+                            tasks sent to the workers whose results have
+                            not yet been consumed.
+    :param readDensity: Estimated number of reads per genomic window, as
+                        returned by bamHandler.getReadDensity. If given,
+                        chunks holding many more reads than average are
+                        cut into pieces of roughly equal read counts and
+                        the tasks are sent to the workers largest first.
+                        The results are returned in the same order as
+                        without a read density (unless ordered is False).
+    :param chunkAlignment: The chunks cut according to readDensity start
+                           at a multiple of this value (typically the bin
+                           size) from the original chunk start. If None,
+                           chunks are not cut, but still scheduled by
+                           their number of reads.
+    :param chunkMargin: Distance, in bp, from which reads can still affect
+                        the result of a chunk (e.g. the read extension).
+    :param emptyChunkFunc: If given together with readDensity, chunks
+                           without reads (within chunkMargin) are not sent
+                           to the workers. Instead, this function is called
+                           on their arguments in the current process, and
+                           should return what 'func' would.
+    :param planFunc: If given, this function is called in the current
+                     process with the list of all tasks, as (chrom, start,
+                     end[, bed regions]) tuples in genome order, before any
+                     of them is processed. As self_ is sent to the workers
+                     only afterwards, planFunc may store information for
+                     them in it, e.g. where to write their results.
 
     If "includeLabels" is true, a tuple of (results, labels) is returned
     """
 
+    tasks, bed_interval_tree = _prepareTasks(chromSize,
+                                             genomeChunkLength=genomeChunkLength,
+                                             region=region,
+                                             bedFile=bedFile,
+                                             blackListFileName=blackListFileName,
+                                             verbose=verbose,
+                                             includeLabels=includeLabels,
+                                             keepExons=keepExons,
+                                             transcriptID=transcriptID,
+                                             exonID=exonID,
+                                             transcript_id_designator=transcript_id_designator,
+                                             readDensity=readDensity,
+                                             chunkAlignment=chunkAlignment)
+    if planFunc is not None:
+        tasks = list(tasks)
+        planFunc(tasks)
+
+    # self_ and the static arguments are sent once to each worker
+    # instead of with every task
+    context = (self_, staticArgs)
+
+    if readDensity is not None:
+        plan = _scheduleTasks(tasks, readDensity, chunkMargin,
+                              bedFile is not None)
+        results = _streamScheduled(func, context, plan, emptyChunkFunc,
+                                   numberOfProcessors,
+                                   ordered=ordered,
+                                   maxPendingTasks=maxPendingTasks,
+                                   verbose=verbose)
+        if reducer is not None:
+            res = reducerInit
+            for result in results:
+                res = reducer(res, result)
+        else:
+            res = list(results)
+    elif reducer is not None:
+        res = reducerInit
+        for _, result in _streamResults(func, context, enumerate(tasks),
+                                        numberOfProcessors,
+                                        ordered=ordered,
+                                        maxPendingTasks=maxPendingTasks,
+                                        verbose=verbose):
+            res = reducer(res, result)
+    else:
+        TASKS = list(tasks)
+        if len(TASKS) > 1 and numberOfProcessors > 1:
+            if verbose:
+                print(("using {} processors for {} "
+                       "number of tasks".format(numberOfProcessors,
+                                                len(TASKS))))
+            random.shuffle(TASKS)
+            token = _shareContext(context)
+            TASKS = [(func, token, None, task) for task in TASKS]
+            try:
+                if _sharedPool is not None:
+                    res = _sharedPool.map_async(_contextCall, TASKS).get(9999999)
+                else:
+                    pool = multiprocessing.Pool(numberOfProcessors)
+                    try:
+                        res = pool.map_async(_contextCall, TASKS).get(9999999)
+                    finally:
+                        pool.close()
+                        pool.join()
+            finally:
+                os.remove(token[0])
+            res = [result for _, result in res]
+        else:
+            res = [func(_expandTask(context, task)) for task in TASKS]
+
+    if includeLabels:
+        if bedFile:
+            return res, bed_interval_tree.labels
+        else:
+            return res, None
+    return res
+
+
+def imapReduce(staticArgs, func, chromSize, numberOfProcessors=4,
+               ordered=True, maxPendingTasks=None, verbose=False, **kwargs):
+    """
+    Streaming version of mapReduce. The tasks are generated lazily and the
+    result of each task is yielded as soon as it is available, such that
+    the caller never holds more than a few results in memory.
+
+    :param ordered: If True, results are yielded in the order of the tasks
+                    (chromosome by chromosome, then by position), otherwise
+                    they are yielded as soon as a worker finishes them.
+    :param maxPendingTasks: Maximum number of tasks that have been sent to
+                            the workers but whose results have not yet been
+                            consumed. Defaults to 4 times the number of
+                            processors.
+
+    The remaining arguments are the same as for mapReduce (includeLabels is
+    not supported).
+
+    >>> def f(args):
+    ...     return args[0], args[1], args[2], args[3]
+    >>> list(imapReduce(["foo"], f, [('chr1', 25), ('chr2', 10)],
+    ...                 genomeChunkLength=10, numberOfProcessors=1))
+    [('chr1', 0, 10, 'foo'), ('chr1', 10, 20, 'foo'), ('chr1', 20, 25, 'foo'), ('chr2', 0, 10, 'foo')]
+
+    With a read density (reads per 10 bp window here), the dense second
+    chunk of chr1 is cut in two, and chr2, which has no reads, is handled
+    by emptyChunkFunc instead of func.
+
+    >>> density = (10, {'chr1': np.array([1., 4., 1.]), 'chr2': np.array([0.])})
+    >>> list(imapReduce(["foo"], f, [('chr1', 25), ('chr2', 10)],
+    ...                 genomeChunkLength=10, numberOfProcessors=1,
+    ...                 readDensity=density, chunkAlignment=5,
+    ...                 emptyChunkFunc=lambda x: 'empty'))
+    [('chr1', 0, 10, 'foo'), ('chr1', 10, 15, 'foo'), ('chr1', 15, 20, 'foo'), ('chr1', 20, 25, 'foo'), 'empty']
+    """
+    readDensity = kwargs.get('readDensity')
+    chunkMargin = kwargs.pop('chunkMargin', 0)
+    emptyChunkFunc = kwargs.pop('emptyChunkFunc', None)
+    context = (kwargs.pop('self_', None), staticArgs)
+    tasks, _ = _prepareTasks(chromSize, verbose=verbose, **kwargs)
+    if readDensity is not None:
+        plan = _scheduleTasks(tasks, readDensity, chunkMargin,
+                              kwargs.get('bedFile') is not None)
+        results = _streamScheduled(func, context, plan, emptyChunkFunc,
+                                   numberOfProcessors,
+                                   ordered=ordered,
+                                   maxPendingTasks=maxPendingTasks,
+                                   verbose=verbose)
+    else:
+        results = (result for _, result in
+                   _streamResults(func, context, enumerate(tasks),
+                                  numberOfProcessors,
+                                  ordered=ordered,
+                                  maxPendingTasks=maxPendingTasks,
+                                  verbose=verbose))
+    for result in results:
+        yield result
+
+
+def _prepareTasks(chromSize,
+                  genomeChunkLength=None,
+                  region=None,
+                  bedFile=None,
+                  blackListFileName=None,
+                  verbose=False,
+                  includeLabels=False,
+                  keepExons=False,
+                  transcriptID="transcriptID",
+                  exonID="exonID",
+                  transcript_id_designator="transcript_id",
+                  readDensity=None,
+                  chunkAlignment=1):
+    """
+    Parses the region, BED and blacklist options and returns a tuple of
+    a generator of the tasks (see _taskGenerator) and the BED interval
+    tree (or None). If a read density is given, dense chunks are further
+    cut (see _splitChunksByDensity).
+    """
     if not genomeChunkLength:
         genomeChunkLength = 1e5
     genomeChunkLength = int(genomeChunkLength)
@@ -67,7 +343,6 @@ def mapReduce(staticArgs, func, chromSize,
             genomeChunkLength))
 
     region_start = 0
-    region_end = None
 
     # if a region is set, that means that the task should only cover
     # the given genomic position
@@ -78,16 +353,30 @@ def mapReduce(staticArgs, func, chromSize,
             print("chrom size: {0}, region start: {1}, region end: {2}, "
                   "genome chunk length sent to each procesor: {3}".format(chromSize, region_start, region_end, genomeChunkLength))
 
+    bed_interval_tree = None
     if bedFile:
         defaultGroup = None
         if len(bedFile) == 1:
             defaultGroup = "genes"
         bed_interval_tree = GTF(bedFile, defaultGroup=defaultGroup, transcriptID=transcriptID, exonID=exonID, transcript_id_designator=transcript_id_designator, keepExons=keepExons)
 
+    blackList = None
     if blackListFileName:
-        blackList = GTF(blackListFileName)
+        blackList = getBlackList(blackListFileName)
+
+    chunks = _genomeChunks(chromSize, genomeChunkLength, region_start, blackList)
+    if readDensity is not None and chunkAlignment is not None:
+        chunks = _splitChunksByDensity(list(chunks), readDensity, chunkAlignment)
+
+    tasks = _taskGenerator(chunks, bed_interval_tree, includeLabels)
+    return tasks, bed_interval_tree
 
-    TASKS = []
+
+def _genomeChunks(chromSize, genomeChunkLength, region_start, blackList):
+    """
+    Yields (chrom, start, end) chunks of genomeChunkLength bp, chromosome
+    by chromosome, minus the blacklisted regions.
+    """
     # iterate over all chromosomes
     for chrom, size in chromSize:
         # the start is zero unless a specific region is defined
@@ -96,59 +385,320 @@ def mapReduce(staticArgs, func, chromSize,
             endPos = min(size, startPos + genomeChunkLength)
 
             # Reject a chunk if it overlaps
-            if blackListFileName:
+            if blackList is not None:
                 regions = blSubtract(blackList, chrom, [startPos, endPos])
             else:
                 regions = [[startPos, endPos]]
 
             for reg in regions:
-                if self_ is not None:
-                    argsList = [self_]
-                else:
-                    argsList = []
-
-                argsList.extend([chrom, reg[0], reg[1]])
-                # add to argument list the static list received the the function
-                argsList.extend(staticArgs)
-
-                # if a bed file is given, append to the TASK list,
-                # a list of bed regions that overlap with the
-                # current genomeChunk.
-                if bedFile:
-                    # This effectively creates batches of intervals, which is
-                    # generally more performant due to the added overhead of
-                    # initializing additional workers.
-
-                    # TODO, there's no point in including the chromosome
-                    if includeLabels:
-                        bed_regions_list = [[chrom, x[4], x[2], x[3], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, reg[0], reg[1], trimOverlap=True, numericGroups=True, includeStrand=True)]
-                    else:
-                        bed_regions_list = [[chrom, x[4], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, reg[0], reg[1], trimOverlap=True, includeStrand=True)]
-
-                    if len(bed_regions_list) == 0:
-                        continue
-                    # add to argument list, the position of the bed regions to use
-                    argsList.append(bed_regions_list)
-
-                TASKS.append(tuple(argsList))
-
-    if len(TASKS) > 1 and numberOfProcessors > 1:
-        if verbose:
-            print(("using {} processors for {} "
-                   "number of tasks".format(numberOfProcessors,
-                                            len(TASKS))))
-        random.shuffle(TASKS)
-        pool = multiprocessing.Pool(numberOfProcessors)
-        res = pool.map_async(func, TASKS).get(9999999)
+                yield chrom, reg[0], reg[1]
+
+
+def _cumulativeDensity(readDensity):
+    """
+    Returns the window size and, per chromosome, the cumulative number of
+    reads at the window boundaries.
+    """
+    windowSize, density = readDensity
+    return windowSize, dict([(chrom, np.concatenate([[0], np.cumsum(values)]))
+                             for chrom, values in density.items()])
+
+
+def _readsBefore(cumDensity, windowSize, pos):
+    """
+    Estimated number of reads before pos, interpolating within windows.
+    """
+    return np.interp(pos, np.arange(len(cumDensity)) * windowSize, cumDensity)
+
+
+def _splitChunksByDensity(chunks, readDensity, chunkAlignment):
+    """
+    Cuts the chunks having more reads than the average chunk into pieces
+    of roughly equal read counts. The cuts are placed at a multiple of
+    chunkAlignment from the chunk start, so bins are not split.
+
+    >>> density = (10, {'chr1': np.array([0., 0., 12., 0.])})
+    >>> _splitChunksByDensity([('chr1', 0, 20), ('chr1', 20, 40), ('chr2', 0, 40)],
+    ...                       density, 5)
+    [('chr1', 0, 20), ('chr1', 20, 25), ('chr1', 25, 40), ('chr2', 0, 40)]
+    """
+    windowSize, cumDensity = _cumulativeDensity(readDensity)
+    reads = [_readsBefore(cumDensity[chrom], windowSize, end) -
+             _readsBefore(cumDensity[chrom], windowSize, start)
+             for chrom, start, end in chunks if chrom in cumDensity]
+    if len(reads) == 0 or sum(reads) == 0:
+        return chunks
+    readsPerChunk = float(sum(reads)) / len(reads)
+
+    newChunks = []
+    for chrom, start, end in chunks:
+        if chrom not in cumDensity:
+            newChunks.append((chrom, start, end))
+            continue
+        cum = cumDensity[chrom]
+        first, last = _readsBefore(cum, windowSize, [start, end])
+        nPieces = int(np.ceil((last - first) / readsPerChunk))
+        if nPieces < 2:
+            newChunks.append((chrom, start, end))
+            continue
+        targets = first + (last - first) * np.arange(1, nPieces) / nPieces
+        cuts = np.interp(targets, cum, np.arange(len(cum)) * windowSize)
+        cuts = start + np.round((cuts - start) / chunkAlignment).astype(np.int64) * chunkAlignment
+        bounds = [start] + [int(x) for x in np.unique(cuts) if start < x < end] + [end]
+        newChunks.extend([(chrom, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)])
+    return newChunks
+
+
+def _taskGenerator(chunks, bed_interval_tree, includeLabels):
+    """
+    Yields a (chrom, start, end) tuple for each of the given chunks. If a
+    bed file is given, the list of bed regions of the chunk is appended
+    and chunks without bed regions are skipped.
+    """
+    for chrom, start, end in chunks:
+        # if a bed file is given, append to the task
+        # a list of bed regions that overlap with the
+        # current genomeChunk.
+        if bed_interval_tree is not None:
+            # This effectively creates batches of intervals, which is
+            # generally more performant due to the added overhead of
+            # initializing additional workers.
+
+            # TODO, there's no point in including the chromosome
+            if includeLabels:
+                bed_regions_list = [[chrom, x[4], x[2], x[3], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, start, end, trimOverlap=True, numericGroups=True, includeStrand=True)]
+            else:
+                bed_regions_list = [[chrom, x[4], x[5], x[6]] for x in bed_interval_tree.findOverlaps(chrom, start, end, trimOverlap=True, includeStrand=True)]
+
+            if len(bed_regions_list) == 0:
+                continue
+            yield chrom, start, end, bed_regions_list
+        else:
+            yield chrom, start, end
+
+
+def _expandTask(context, task):
+    """
+    Returns the arguments 'func' is called with for a task: self_ (if
+    given), chrom, start, end, the static arguments and the list of bed
+    regions (if any).
+    """
+    self_, staticArgs = context
+    argsList = [] if self_ is None else [self_]
+    argsList.extend(task[:3])
+    # add to argument list the static list received the the function
+    argsList.extend(staticArgs)
+    argsList.extend(task[3:])
+    return tuple(argsList)
+
+
+def _shareContext(context):
+    """
+    Pickles the context of a mapReduce call once, into a temporary file
+    that each worker reads the first time it needs it (see _contextCall).
+    This avoids sending the (possibly large) self_ object with every task
+    and, unlike a pool initializer, also works for the shared pool, whose
+    workers exist before the context does.
+
+    Returns a token identifying the context, whose first element is the
+    name of the file, to be removed by the caller when done.
+    """
+    fileName = getTempFileName(suffix='.pickle')
+    with open(fileName, 'wb') as f:
+        pickle.dump(context, f, pickle.HIGHEST_PROTOCOL)
+    return fileName, uuid.uuid4().hex
+
+
+def _contextCall(args):
+    """
+    Runs in a worker: calls func on a task, completed with the context
+    given by the token (see _shareContext). Only the context of the
+    latest call is kept. The index of the task is returned together
+    with the result.
+    """
+    func, token, idx, task = args
+    if token[1] not in _workerContext:
+        _workerContext.clear()
+        with open(token[0], 'rb') as f:
+            _workerContext[token[1]] = pickle.load(f)
+    return idx, func(_expandTask(_workerContext[token[1]], task))
+
+
+def _taskSpan(task, hasBed):
+    """
+    Returns the chromosome, start and end of the genomic interval a task
+    reads from (for BED files, regions may extend beyond the chunk end).
+    """
+    chrom, start, end = task[:3]
+    if hasBed:
+        for region in task[-1]:
+            for exon in region[1]:
+                start = min(start, exon[0])
+                end = max(end, exon[1])
+    return chrom, start, end
+
+
+def _scheduleTasks(tasks, readDensity, chunkMargin, hasBed):
+    """
+    Returns a list of (task, estimated number of reads, isEmpty) tuples,
+    in the order of the tasks. A task is empty if, according to the read
+    density, there are no reads within chunkMargin of its interval. Tasks
+    on chromosomes without read density are never considered empty and
+    are scheduled first.
+    """
+    windowSize, cumDensity = _cumulativeDensity(readDensity)
+    plan = []
+    for task in tasks:
+        chrom, start, end = _taskSpan(task, hasBed)
+        if chrom not in cumDensity:
+            plan.append((task, float('inf'), False))
+            continue
+        cum = cumDensity[chrom]
+        reads = _readsBefore(cum, windowSize, end) - _readsBefore(cum, windowSize, start)
+        firstWindow = max(0, (start - chunkMargin) // windowSize)
+        lastWindow = min(len(cum) - 1, -(-(end + chunkMargin) // windowSize))
+        isEmpty = firstWindow >= lastWindow or cum[lastWindow] == cum[firstWindow]
+        plan.append((task, reads, isEmpty))
+    return plan
+
+
+def _streamScheduled(func, context, plan, emptyChunkFunc, numberOfProcessors,
+                     ordered=True, maxPendingTasks=None, verbose=False):
+    """
+    Like _streamResults, for a plan as returned by _scheduleTasks. Empty
+    tasks are handled by emptyChunkFunc in this process (if given) and
+    the remaining ones are sent to the workers largest first, such that
+    no worker is left with a large chunk at the end.
+
+    If ordered, the results are put back into the order of the plan. The
+    tasks are then only sorted within consecutive blocks of
+    maxPendingTasks tasks, and a task counts as pending until its result
+    is yielded, such that at most maxPendingTasks results wait for those
+    of preceding tasks.
+    """
+    if emptyChunkFunc is None:
+        skip = [False] * len(plan)
     else:
-        res = list(map(func, TASKS))
+        skip = [isEmpty for _, _, isEmpty in plan]
+    if verbose:
+        print("{} of {} tasks contain no reads".format(sum(skip), len(plan)))
+
+    def empty(idx):
+        return emptyChunkFunc(_expandTask(context, plan[idx][0]))
+
+    if numberOfProcessors is None or numberOfProcessors <= 1:
+        for idx in range(len(plan)):
+            yield empty(idx) if skip[idx] else func(_expandTask(context, plan[idx][0]))
+        return
+
+    if not maxPendingTasks:
+        maxPendingTasks = 4 * numberOfProcessors
+    dispatch = [idx for idx in range(len(plan)) if not skip[idx]]
+    window = None
+    if ordered:
+        # the task whose result is expected next is always within the
+        # block being sent, hence it is sent before the window is full
+        window = threading.Semaphore(maxPendingTasks)
+        blocks = [dispatch[i:i + maxPendingTasks] for i in range(0, len(dispatch), maxPendingTasks)]
+        dispatch = [idx for block in blocks for idx in sorted(block, key=lambda idx: -plan[idx][1])]
+    else:
+        dispatch.sort(key=lambda idx: -plan[idx][1])
+    results = _streamResults(func, context,
+                             ((idx, plan[idx][0]) for idx in dispatch),
+                             numberOfProcessors,
+                             ordered=False,
+                             maxPendingTasks=maxPendingTasks,
+                             verbose=verbose,
+                             window=window)
+    if not ordered:
+        for idx in range(len(plan)):
+            if skip[idx]:
+                yield empty(idx)
+        for _, result in results:
+            yield result
+        return
+
+    # results that arrived before those of the preceding tasks
+    pending = {}
+    nextIdx = 0
+    for idx, result in results:
+        pending[idx] = result
+        while nextIdx < len(plan) and (skip[nextIdx] or nextIdx in pending):
+            if skip[nextIdx]:
+                yield empty(nextIdx)
+            else:
+                window.release()
+                yield pending.pop(nextIdx)
+            nextIdx += 1
+    for idx in range(nextIdx, len(plan)):
+        yield empty(idx)
 
-    if includeLabels:
-        if bedFile:
-            return res, bed_interval_tree.labels
+
+def _boundedTasks(tasks, window, stop):
+    """
+    Yields the tasks, but blocks whenever the window of pending tasks is
+    full. The consumer of the results releases the window semaphore once
+    per consumed result. Setting the stop event (and releasing the window)
+    ends the iteration early.
+    """
+    for task in tasks:
+        window.acquire()
+        if stop.is_set():
+            return
+        yield task
+
+
+def _streamResults(func, context, tasks, numberOfProcessors, ordered=True,
+                   maxPendingTasks=None, verbose=False, window=None):
+    """
+    Calls func on each of the (index, task) pairs and yields the
+    (index, result) pairs as they become available. If more than one
+    processor is requested, a multiprocessing pool is used with a bounded
+    number of pending tasks, such that neither the task list nor the
+    results need to be held in memory all at once.
+
+    A task is pending until its result is yielded, unless a window
+    semaphore is given. The caller then releases it once per result it
+    is done with (see _streamScheduled).
+    """
+    if numberOfProcessors is None or numberOfProcessors <= 1:
+        for idx, task in tasks:
+            yield idx, func(_expandTask(context, task))
+        return
+
+    if not maxPendingTasks:
+        maxPendingTasks = 4 * numberOfProcessors
+    if verbose:
+        print("using {} processors with at most {} pending "
+              "tasks".format(numberOfProcessors, maxPendingTasks))
+
+    token = _shareContext(context)
+    releaseWindow = window is None
+    if window is None:
+        window = threading.Semaphore(maxPendingTasks)
+    stop = threading.Event()
+    if _sharedPool is not None:
+        pool = _sharedPool
+    else:
+        pool = multiprocessing.Pool(numberOfProcessors)
+    try:
+        tasks = ((func, token, idx, task) for idx, task in _boundedTasks(tasks, window, stop))
+        if ordered:
+            results = pool.imap(_contextCall, tasks)
         else:
-            return res, None
-    return res
+            results = pool.imap_unordered(_contextCall, tasks)
+        for result in results:
+            if releaseWindow:
+                window.release()
+            yield result
+    finally:
+        # unblock the task feeder in case of an error or early exit
+        stop.set()
+        window.release()
+        if pool is not _sharedPool:
+            pool.terminate()
+            pool.join()
+        os.remove(token[0])
 
 
 def getUserRegion(chrom_sizes, region_string, max_chunk_size=1e6):
@@ -0,0 +1,229 @@
+"""
+Binary matrix files of computeMatrix (--outFileFormat binary).
+
+The binary file holds the same information as the gzipped text format
+(see heatmapper.save_matrix): the parameters used to compute the matrix,
+the regions and the matrix values. The regions are stored as columns
+(chromosome, start and end positions of all their parts, name, score and
+strand) and the values as one float32 block per group and sample, so
+that a single sample or group can be read without reading the rest of
+the file. The blocks are compressed with zlib, unless the file is
+written with compress=False, in which case the values are used directly
+from the file. The file is memory mapped and nothing is decoded until it
+is needed (see MatrixFile).
+
+File layout: the magic number, the columns and blocks (each aligned to 8
+bytes), a JSON header with the parameters and the position, type and
+shape of every column and block, the position of the header (8 bytes,
+little endian) and the magic number again.
+"""
+
+import os
+import json
+import zlib
+import struct
+from copy import deepcopy
+import numpy as np
+
+MAGIC = b"DTMATRIX"
+VERSION = 1
+
+
+def isMatrixFile(fileName):
+    """
+    Returns True if the file is a binary matrix file
+
+    >>> from deeptools.utilities import getTempFileName
+    >>> fileName = getTempFileName(suffix='.gz')
+    >>> isMatrixFile(fileName)
+    False
+    >>> os.remove(fileName)
+    """
+    with open(fileName, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def writeMatrixFile(fileName, parameters, regions, matrix, compress=True):
+    """
+    Writes a binary matrix file. The regions are given as in
+    heatmapper._matrix, i.e. [chrom, [(start, end), ...], name, group
+    boundary, strand, score], and parameters must contain the group and
+    sample boundaries.
+
+    >>> from deeptools.utilities import getTempFileName
+    >>> fileName = getTempFileName(suffix='.dtmatrix')
+    >>> parameters = {'group_boundaries': [0, 2, 3], 'sample_boundaries': [0, 2, 3]}
+    >>> regions = [['chr1', [(0, 10)], 'a', 2, '+', '0'],
+    ...            ['chr1', [(20, 30), (40, 50)], 'b', 2, '-', '0'],
+    ...            ['chr2', [(5, 15)], 'c', 3, '.', '1.5']]
+    >>> writeMatrixFile(fileName, parameters, regions, np.arange(9.0).reshape(3, 3))
+    >>> m = MatrixFile(fileName)
+    >>> m.block(1, 0).tolist()
+    [[6.0, 7.0]]
+    >>> m.sample(1).tolist()
+    [[2.0], [5.0], [8.0]]
+    >>> m.group(0).tolist()
+    [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]]
+    >>> m.regions()[1]
+    ['chr1', [(20, 30), (40, 50)], 'b', 2, '-', '0']
+    >>> m.close()
+    >>> writeMatrixFile(fileName, parameters, regions, np.arange(9.0).reshape(3, 3), compress=False)
+    >>> m = MatrixFile(fileName)
+    >>> type(m.block(1, 0)).__name__, m.block(1, 0).tolist()
+    ('memmap', [[6.0, 7.0]])
+    >>> m.close()
+    >>> os.remove(fileName)
+    """
+    group_boundaries = parameters['group_boundaries']
+    sample_boundaries = parameters['sample_boundaries']
+    matrix = np.asarray(matrix)
+
+    chroms = []
+    chromIdx = {}
+    for region in regions:
+        if region[0] not in chromIdx:
+            chromIdx[region[0]] = len(chroms)
+            chroms.append(region[0])
+
+    f = open(fileName, 'wb')
+    f.write(MAGIC)
+
+    def writeColumn(arr):
+        arr = np.ascontiguousarray(arr)
+        pos = f.tell()
+        f.write(arr.tobytes())
+        f.write(b"\0" * (-f.tell() % 8))
+        return [pos, arr.dtype.str, list(arr.shape)]
+
+    def writeBlock(arr):
+        if not compress:
+            return writeColumn(arr)
+        arr = np.ascontiguousarray(arr)
+        pos = f.tell()
+        data = zlib.compress(arr.tobytes(), 1)
+        f.write(data)
+        f.write(b"\0" * (-f.tell() % 8))
+        return [pos, arr.dtype.str, list(arr.shape), len(data)]
+
+    def writeStrings(values):
+        # the strings of a column are joined by newlines
+        return writeColumn(np.frombuffer("\n".join(values).encode('utf-8'), dtype=np.uint8))
+
+    columns = {'chrom': writeColumn(np.array([chromIdx[x[0]] for x in regions], dtype=np.int32)),
+               'regionPtr': writeColumn(np.cumsum([0] + [len(x[1]) for x in regions], dtype=np.int64)),
+               'regionStarts': writeColumn(np.array([y[0] for x in regions for y in x[1]], dtype=np.int64)),
+               'regionEnds': writeColumn(np.array([y[1] for x in regions for y in x[1]], dtype=np.int64)),
+               'name': writeStrings([x[2] for x in regions]),
+               'strand': writeStrings([x[4] for x in regions]),
+               'score': writeStrings([str(x[5]) for x in regions])}
+
+    blocks = []
+    for group_start, group_end in zip(group_boundaries[:-1], group_boundaries[1:]):
+        blocks.append([writeBlock(matrix[group_start:group_end, sample_start:sample_end].astype(np.float32))
+                       for sample_start, sample_end in zip(sample_boundaries[:-1], sample_boundaries[1:])])
+
+    header = {'version': VERSION,
+              'parameters': parameters,
+              'chroms': chroms,
+              'rows': matrix.shape[0],
+              'compression': 'zlib' if compress else None,
+              'columns': columns,
+              'blocks': blocks}
+    headerPos = f.tell()
+    f.write(json.dumps(header).encode())
+    f.write(struct.pack('<Q', headerPos))
+    f.write(MAGIC)
+    f.close()
+
+
+class MatrixFile(object):
+    """
+    A memory mapped binary matrix file, see writeMatrixFile. The values
+    are returned as float32 arrays, with nan for missing values, which
+    are memory mapped if the file is not compressed.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            f.seek(-8 - len(MAGIC), os.SEEK_END)
+            headerEnd = f.tell()
+            headerPos, = struct.unpack('<Q', f.read(8))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("{} is not a binary matrix file".format(fileName))
+            f.seek(headerPos)
+            self.header = json.loads(f.read(headerEnd - headerPos).decode())
+        self.parameters = self.header['parameters']
+        # private copies, the boundaries of the parameters may be changed
+        # by the user of the file (e.g. computeMatrixOperations cbind)
+        self.group_boundaries = deepcopy(self.parameters['group_boundaries'])
+        self.sample_boundaries = deepcopy(self.parameters['sample_boundaries'])
+        self.shape = (self.header['rows'], self.sample_boundaries[-1])
+        self._data = np.memmap(fileName, dtype=np.uint8, mode='r')
+
+    def _column(self, column):
+        pos, dtype, shape = column
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return self._data[pos:pos + size].view(dtype).reshape(shape)
+
+    def _strings(self, name):
+        return self._column(self.header['columns'][name]).tobytes().decode('utf-8').split("\n")
+
+    def block(self, group, sample):
+        """
+        Returns the values of a group of regions for a sample
+        """
+        block = self.header['blocks'][group][sample]
+        if self.header['compression'] == 'zlib':
+            pos, dtype, shape, size = block
+            data = zlib.decompress(self._data[pos:pos + size].tobytes())
+            return np.frombuffer(data, dtype=dtype).reshape(shape)
+        return self._column(block)
+
+    def sample(self, sample):
+        """
+        Returns the values of all the regions for a sample
+        """
+        return np.concatenate([self.block(group, sample) for group in range(len(self.group_boundaries) - 1)])
+
+    def group(self, group):
+        """
+        Returns the values of all the samples for a group of regions
+        """
+        return np.hstack([self.block(group, sample) for sample in range(len(self.sample_boundaries) - 1)])
+
+    def matrix(self):
+        """
+        Returns the whole matrix
+        """
+        matrix = np.empty(self.shape, dtype=np.float32)
+        for group in range(len(self.group_boundaries) - 1):
+            matrix[self.group_boundaries[group]:self.group_boundaries[group + 1], :] = self.group(group)
+        return matrix
+
+    def regions(self):
+        """
+        Returns the regions as in heatmapper._matrix
+        """
+        if self.shape[0] == 0:
+            return []
+        chroms = self.header['chroms']
+        chrom = self._column(self.header['columns']['chrom']).tolist()
+        regionPtr = self._column(self.header['columns']['regionPtr']).tolist()
+        regionStarts = self._column(self.header['columns']['regionStarts']).tolist()
+        regionEnds = self._column(self.header['columns']['regionEnds']).tolist()
+        names = self._strings('name')
+        strands = self._strings('strand')
+        scores = self._strings('score')
+        # the group boundary of each region
+        bounds = np.repeat(self.group_boundaries[1:], np.diff(self.group_boundaries)).tolist()
+
+        regions = []
+        for idx in range(self.shape[0]):
+            parts = list(zip(regionStarts[regionPtr[idx]:regionPtr[idx + 1]],
+                             regionEnds[regionPtr[idx]:regionPtr[idx + 1]]))
+            regions.append([chroms[chrom[idx]], parts, names[idx], bounds[idx], strands[idx], scores[idx]])
+        return regions
+
+    def close(self):
+        del self._data
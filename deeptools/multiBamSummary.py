@@ -7,6 +7,8 @@ import argparse
 import numpy as np
 
 import deeptools.countReadsPerBin as countR
+from deeptools import mapReduce
+from deeptools import bamHandler
 from deeptools import parserCommon
 from deeptools._version import __version__
 
@@ -164,6 +166,15 @@ def bamcorrelate_args(case='bins'):
                        help='Save the counts per region to a tab-delimited file.',
                        metavar='FILE')
 
+    group.add_argument('--outRawCountsFormat',
+                       help='Format of the --outRawCounts file: "tab" for a '
+                       'tab-delimited file or "binary" for a compact binary '
+                       'file that is faster to write and to read with '
+                       'deeptools.rawCounts (its exportText function converts '
+                       'it to the tab-delimited format).',
+                       choices=['tab', 'binary'],
+                       default='tab')
+
     return parser
 
 
@@ -188,6 +199,9 @@ def main(args=None):
 
     """
     args = process_args(args)
+    # the worker processes are forked once and reused by all steps of the tool,
+    # each of them opens the input files once
+    mapReduce.startPool(args.numberOfProcessors, bamHandler.openHandles, (args.bamfiles,))
 
     if 'BED' in args:
         bed_regions = args.BED
@@ -219,9 +233,13 @@ def main(args=None):
         maxFragmentLength=args.maxFragmentLength,
         stepSize=stepsize,
         zerosToNans=False,
-        out_file_for_raw_data=args.outRawCounts)
+        out_file_for_raw_data=args.outRawCounts,
+        compact_counts=True,
+        raw_data_format=args.outRawCountsFormat,
+        labels=args.labels)
 
     num_reads_per_bin = c.run(allArgs=args)
+    mapReduce.closePool()
 
     sys.stderr.write("Number of bins "
                      "found: {}\n".format(num_reads_per_bin.shape[0]))
@@ -231,6 +249,8 @@ def main(args=None):
              "If using --region please check that this "
              "region is covered by reads.\n")
 
+    # the counts are saved with their compact dtype (see
+    # CountReadsPerBin.get_count_dtype).
     # numpy will append .npz to the file name if we don't do this...
     f = open(args.outFileName, "wb")
     np.savez_compressed(f,
@@ -238,17 +258,6 @@ def main(args=None):
                         labels=args.labels)
     f.close()
 
-    if args.outRawCounts:
-        # append to the generated file the
-        # labels
-        header = "#'chr'\t'start'\t'end'\t"
-        header += "'" + "'\t'".join(args.labels) + "'\n"
-        f = open(args.outRawCounts, 'r+')
-        content = f.read()
-        f.seek(0, 0)
-        f.write(header + content)
-        f.close()
-
 
 if __name__ == "__main__":
     main()
@@ -13,6 +13,8 @@ matplotlib.rcParams['svg.fonttype'] = 'none'
 import matplotlib.pyplot as plt
 
 import deeptools.countReadsPerBin as countR
+from deeptools import mapReduce
+from deeptools import bamHandler
 from deeptools import parserCommon
 from deeptools._version import __version__
 
@@ -110,6 +112,15 @@ def required_args():
                           help='Save raw counts (coverages) to file.',
                           metavar='FILE')
 
+    optional.add_argument('--outRawCountsFormat',
+                          help='Format of the --outRawCounts file: "tab" for a '
+                          'tab-delimited file or "binary" for a compact binary '
+                          'file that is faster to write and to read with '
+                          'deeptools.rawCounts (its exportText function converts '
+                          'it to the tab-delimited format).',
+                          choices=['tab', 'binary'],
+                          default='tab')
+
     optional.add_argument('--plotFileFormat',
                           metavar='FILETYPE',
                           help='Image format type. If given, this option '
@@ -124,6 +135,9 @@ def required_args():
 
 def main(args=None):
     args = process_args(args)
+    # the worker processes are forked once and reused by all steps of the tool,
+    # each of them opens the input files once
+    mapReduce.startPool(args.numberOfProcessors, bamHandler.openHandles, (args.bamfiles,))
     cr = countR.CountReadsPerBin(args.bamfiles,
                                  binLength=1,
                                  numberOfSamples=args.numberOfSamples,
@@ -139,24 +153,16 @@ def main(args=None):
                                  samFlag_exclude=args.samFlagExclude,
                                  minFragmentLength=args.minFragmentLength,
                                  maxFragmentLength=args.maxFragmentLength,
-                                 out_file_for_raw_data=args.outRawCounts)
+                                 out_file_for_raw_data=args.outRawCounts,
+                                 raw_data_format=args.outRawCountsFormat,
+                                 labels=args.labels)
 
     num_reads_per_bin = cr.run()
+    mapReduce.closePool()
 
     sys.stderr.write("Number of non zero bins "
                      "used: {}\n".format(num_reads_per_bin.shape[0]))
 
-    if args.outRawCounts:
-        # append to the generated file the
-        # labels
-        header = "#'chr'\t'start'\t'end'\t"
-        header += "'" + "'\t'".join(args.labels) + "'\n"
-        f = open(args.outRawCounts, 'r+')
-        content = f.read()
-        f.seek(0, 0)
-        f.write(header + content)
-        f.close()
-
     if num_reads_per_bin.shape[0] < 2:
         exit("ERROR: too few non-zero bins found.\n"
              "If using --region please check that this "
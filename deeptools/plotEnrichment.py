@@ -13,9 +13,10 @@ import matplotlib.gridspec as gridspec
 
 from deeptools.mapReduce import mapReduce, getUserRegion, blSubtract
 from deeptools.getFragmentAndReadSize import get_read_and_fragment_length
-from deeptools.utilities import getCommonChrNames, mungeChromosome
-from deeptools.bamHandler import openBam
-from deeptoolsintervals import Enrichment, GTF
+from deeptools.utilities import getCommonChrNames, mungeChromosome, getBlackList
+from deeptools.bamHandler import openBam, getHandle
+from deeptools.readFilter import ReadFilter
+from deeptoolsintervals import Enrichment
 from deeptools.countReadsPerBin import CountReadsPerBin as cr
 from deeptools import parserCommon
 
@@ -221,34 +222,17 @@ def getEnrichment_worker(arglist):
         odict = dict()
         for x in gtf.features:
             odict[x] = 0
-        fh = openBam(f)
+        fh = getHandle(f)
 
         chrom = mungeChromosome(chrom, fh.references)
 
-        prev_start_pos = None  # to store the start positions
-        for read in fh.fetch(chrom, start, end):
-            # Filter
-            if read.pos < start:
-                # Ensure that a given alignment is processed only once
-                continue
-            if read.flag & 4:
-                continue
-            if args.minMappingQuality and read.mapq < args.minMappingQuality:
-                continue
-            if args.samFlagInclude and read.flag & args.samFlagInclude != args.samFlagInclude:
-                continue
-            if args.samFlagExclude and read.flag & args.samFlagExclude != 0:
-                continue
-            if args.minFragmentLength > 0 and abs(read.template_length) < args.minFragmentLength:
-                continue
-            if args.maxFragmentLength > 0 and abs(read.template_length) > args.maxFragmentLength:
-                continue
-            if args.ignoreDuplicates and prev_start_pos \
-                    and prev_start_pos == (read.reference_start, read.pnext, read.is_reverse):
-                continue
-            prev_start_pos = (read.reference_start, read.pnext, read.is_reverse)
-            total[idx] += 1
-
+        # Ensure that a given alignment is processed only once
+        reads = [r for r in fh.fetch(chrom, start, end) if r.pos >= start and not r.flag & 4]
+        readFilter = ReadFilter.fromArgs(args)
+        keep = readFilter.keep(readFilter.columns(reads))
+        total[idx] += int(keep.sum())
+        for rIdx in np.flatnonzero(keep).tolist():
+            read = reads[rIdx]
             # Get blocks, possibly extending
             features = gtf.findOverlaps(chrom, getBAMBlocks(read, defaultFragmentLength, args.centerReads))
 
@@ -330,7 +314,7 @@ def getChunkLength(args, chromSize):
 
     bl = None
     if args.blackListFileName:
-        bl = GTF(args.blackListFileName)
+        bl = getBlackList(args.blackListFileName)
 
     lengths = []
     for k, v in chromSize:
@@ -13,6 +13,8 @@ from scipy import interpolate
 from scipy.stats import poisson
 
 import deeptools.countReadsPerBin as countR
+from deeptools import mapReduce
+from deeptools import bamHandler
 from deeptools import parserCommon
 
 old_settings = np.seterr(all='ignore')
@@ -341,6 +343,9 @@ def getExpected(mu):
 
 def main(args=None):
     args = process_args(args)
+    # the worker processes are forked once and reused by all steps of the tool,
+    # each of them opens the input files once
+    mapReduce.startPool(args.numberOfProcessors, bamHandler.openHandles, (args.bamfiles,))
 
     cr = countR.CountReadsPerBin(
         args.bamfiles,
@@ -360,6 +365,7 @@ def main(args=None):
         maxFragmentLength=args.maxFragmentLength)
 
     num_reads_per_bin = cr.run()
+    mapReduce.closePool()
     if num_reads_per_bin.sum() == 0:
         import sys
         sys.stderr.write(
@@ -0,0 +1,270 @@
+"""
+Raw counts files (--outRawCounts) of multiBamSummary and plotCoverage.
+
+The counts are written either as a tab-delimited text file (chromosome,
+start, end and the counts of each sample, one region per line) or as a
+binary columnar file that is written chunk by chunk, in genome order, as
+the chunks are counted. The binary file stores, for each chunk of rows,
+the start and end positions of the regions (and, for BED files, of all
+their parts) and the counts of each sample with their own type, e.g. the
+compact integer types of CountReadsPerBin. Positions are stored as 32 bit
+integers when possible, and if all the regions of a chunk have the same
+width (e.g. bins), only their start positions and the width are stored.
+It is read back without any parsing with RawCounts, and can be converted
+to the text format with exportText.
+
+File layout: the magic number, the columns of each chunk (each column
+aligned to 8 bytes), a JSON header with the sample labels and the
+chromosome, number of rows and position, type and shape of the columns
+of each chunk, the position of the header (8 bytes, little endian) and
+the magic number again.
+"""
+
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = b"DTRAWCNT"
+VERSION = 2
+
+
+def textHeader(labels):
+    """
+    Returns the header line of the text format
+
+    >>> textHeader(['a', 'b'])
+    "#'chr'\\t'start'\\t'end'\\t'a'\\t'b'\\n"
+    """
+    return "#'chr'\t'start'\t'end'\t'" + "'\t'".join(labels) + "'\n"
+
+
+def textRows(chrom, starts, ends, counts, regionPtr=None, regionStarts=None, regionEnds=None):
+    """
+    Returns the lines of the text format for the rows of a chunk. If
+    regionPtr is given, the start and end positions of all the regions of
+    each row (regionStarts[regionPtr[i]:regionPtr[i + 1]]) are written,
+    separated by commas. The counts are written as floats.
+
+    >>> textRows('chr1', [0, 50], [50, 100], [[1, 2], [0, 3.5]]).splitlines()
+    ['chr1\\t0\\t50\\t1.0\\t2.0', 'chr1\\t50\\t100\\t0.0\\t3.5']
+    >>> textRows('chr1', [0], [300], [[4]], [0, 2], [0, 200], [100, 300])
+    'chr1\\t0,200\\t100,300\\t4.0\\n'
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    if regionPtr is not None:
+        regionPtr = np.asarray(regionPtr).tolist()
+        regionStarts = [str(x) for x in np.asarray(regionStarts).tolist()]
+        regionEnds = [str(x) for x in np.asarray(regionEnds).tolist()]
+        starts = [",".join(regionStarts[a:b]) for a, b in zip(regionPtr[:-1], regionPtr[1:])]
+        ends = [",".join(regionEnds[a:b]) for a, b in zip(regionPtr[:-1], regionPtr[1:])]
+    else:
+        starts = np.asarray(starts).tolist()
+        ends = np.asarray(ends).tolist()
+    fmt = "{}\t{}\t{}\t" + "\t".join(["{}"] * counts.shape[1]) + "\n"
+    return "".join([fmt.format(chrom, s, e, *v) for s, e, v in zip(starts, ends, counts.tolist())])
+
+
+class RawCountsWriter(object):
+    """
+    Writes a binary raw counts file, chunk by chunk. If dtype is given,
+    the counts are stored with that type.
+
+    >>> from deeptools.utilities import getTempFileName
+    >>> fileName = getTempFileName(suffix='.dtraw')
+    >>> w = RawCountsWriter(fileName, labels=['a', 'b'], dtype='uint16')
+    >>> w.addChunk('chr1', [0, 50], [50, 100], [[1.0, 2.0], [0.0, 3.0]])
+    >>> w.addChunk('chr2', [10], [20], [[5.0, 6.0]])
+    >>> w.close()
+    >>> r = RawCounts(fileName)
+    >>> r.labels == ['a', 'b']
+    True
+    >>> r.column('chrom').tolist() == ['chr1', 'chr1', 'chr2']
+    True
+    >>> r.column('start').tolist(), r.column('end').tolist()
+    ([0, 50, 10], [50, 100, 20])
+    >>> r.chunks[0]['width'], r.column('start').dtype
+    (50, dtype('int32'))
+    >>> r.column('counts').dtype, r.column('counts').tolist()
+    (dtype('uint16'), [[1, 2], [0, 3], [5, 6]])
+    >>> r.close()
+    >>> os.remove(fileName)
+    """
+
+    def __init__(self, fileName, labels=None, dtype=None):
+        self.fileName = fileName
+        self.dtype = dtype
+        self.header = {'version': VERSION,
+                       'labels': list(labels) if labels is not None else None,
+                       'chunks': []}
+        self._file = open(fileName, 'wb')
+        self._file.write(MAGIC)
+
+    def _writeColumn(self, arr):
+        """
+        Writes an array at the current position, padded to 8 bytes.
+        Returns its position, type and shape.
+        """
+        arr = np.ascontiguousarray(arr)
+        pos = self._file.tell()
+        self._file.write(arr.tobytes())
+        self._file.write(b"\0" * (-self._file.tell() % 8))
+        return [pos, arr.dtype.str, list(arr.shape)]
+
+    def _writePositions(self, positions, maxPosition=None):
+        """
+        Writes an array of positions as 32 bit integers if they, and
+        maxPosition (if given), fit, otherwise as 64 bit integers.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        limits = np.iinfo(np.int32)
+        fits = len(positions) == 0 or (positions.min() >= limits.min and positions.max() <= limits.max)
+        if maxPosition is not None and maxPosition > limits.max:
+            fits = False
+        return self._writeColumn(positions.astype(np.int32) if fits else positions)
+
+    def addChunk(self, chrom, starts, ends, counts, regionPtr=None, regionStarts=None, regionEnds=None):
+        """
+        Writes the rows of a chunk. The counts are given as an array with
+        one row per region and one column per sample. For rows made of
+        several regions (e.g. the exons of a BED12 entry), the start and
+        end positions of all the regions can also be given, see textRows.
+
+        If all the rows have the same width, the end positions are not
+        stored but computed from the start positions by RawCounts.
+        """
+        counts = np.asarray(counts)
+        if self.dtype is not None:
+            counts = counts.astype(self.dtype)
+        if counts.shape[0] == 0:
+            return
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        widths = ends - starts
+        chunk = {'chrom': chrom, 'rows': counts.shape[0], 'columns': {}}
+        columns = chunk['columns']
+        if np.all(widths == widths[0]):
+            chunk['width'] = int(widths[0])
+            # the end positions are computed with the type of the start positions
+            columns['start'] = self._writePositions(starts, maxPosition=ends.max())
+        else:
+            columns['start'] = self._writePositions(starts)
+            columns['end'] = self._writePositions(ends)
+        # one column per sample
+        columns['counts'] = self._writeColumn(counts.T)
+        if regionPtr is not None:
+            columns['regionPtr'] = self._writeColumn(np.asarray(regionPtr, dtype=np.int64))
+            columns['regionStarts'] = self._writePositions(regionStarts)
+            columns['regionEnds'] = self._writePositions(regionEnds)
+        self.header['chunks'].append(chunk)
+
+    def appendFile(self, fileName):
+        """
+        Appends all the chunks of another binary raw counts file, e.g. one
+        written by a worker process, without decoding them.
+        """
+        other = RawCounts(fileName)
+        shift = self._file.tell() - len(MAGIC)
+        # copy the columns, i.e. everything between the magic number and the header
+        remaining = other.headerPos - len(MAGIC)
+        with open(fileName, 'rb') as f:
+            f.seek(len(MAGIC))
+            while remaining > 0:
+                buf = f.read(min(remaining, 1 << 22))
+                self._file.write(buf)
+                remaining -= len(buf)
+        for chunk in other.header['chunks']:
+            for column in chunk['columns'].values():
+                column[0] += shift
+            self.header['chunks'].append(chunk)
+        other.close()
+
+    def close(self):
+        headerPos = self._file.tell()
+        self._file.write(json.dumps(self.header).encode())
+        self._file.write(struct.pack('<Q', headerPos))
+        self._file.write(MAGIC)
+        self._file.close()
+
+
+class RawCounts(object):
+    """
+    A memory mapped binary raw counts file, see RawCountsWriter.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            f.seek(-8 - len(MAGIC), os.SEEK_END)
+            headerEnd = f.tell()
+            self.headerPos, = struct.unpack('<Q', f.read(8))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("{} is not a binary raw counts file".format(fileName))
+            f.seek(self.headerPos)
+            self.header = json.loads(f.read(headerEnd - self.headerPos).decode())
+        self.labels = self.header['labels']
+        self.chunks = self.header['chunks']
+        self._data = np.memmap(fileName, dtype=np.uint8, mode='r')
+
+    def _column(self, chunk, name):
+        """
+        Returns a column of a chunk as a (memory mapped) numpy array
+        """
+        if name == 'end' and 'width' in chunk:
+            start = self._column(chunk, 'start')
+            return start + start.dtype.type(chunk['width'])
+        pos, dtype, shape = chunk['columns'][name]
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        arr = self._data[pos:pos + size].view(dtype).reshape(shape)
+        if name == 'counts':
+            return arr.T
+        return arr
+
+    def column(self, name):
+        """
+        Returns a column of all the chunks: 'chrom', 'start', 'end',
+        'counts' (with one column per sample) or, if stored, 'regionPtr',
+        'regionStarts' and 'regionEnds'.
+        """
+        if name == 'chrom':
+            return np.repeat([chunk['chrom'] for chunk in self.chunks],
+                             [chunk['rows'] for chunk in self.chunks])
+        if not self.chunks:
+            return np.zeros(0)
+        if name == 'regionPtr':
+            # the pointers of each chunk start at 0
+            parts = [np.zeros(1, dtype=np.int64)]
+            for chunk in self.chunks:
+                ptr = self._column(chunk, name)
+                parts.append(ptr[1:] + parts[-1][-1])
+            return np.concatenate(parts)
+        return np.concatenate([self._column(chunk, name) for chunk in self.chunks])
+
+    def writeText(self, fileHandle):
+        """
+        Writes the counts to an open file in the text format, with a
+        header line if the file has labels.
+        """
+        if self.labels is not None:
+            fileHandle.write(textHeader(self.labels))
+        for chunk in self.chunks:
+            regions = {}
+            if 'regionPtr' in chunk['columns']:
+                regions = dict([(name, self._column(chunk, name))
+                                for name in ['regionPtr', 'regionStarts', 'regionEnds']])
+            fileHandle.write(textRows(chunk['chrom'], self._column(chunk, 'start'),
+                                      self._column(chunk, 'end'), self._column(chunk, 'counts'),
+                                      **regions))
+
+    def close(self):
+        del self._data
+
+
+def exportText(fileName, outFileName):
+    """
+    Converts a binary raw counts file to the text format.
+    """
+    r = RawCounts(fileName)
+    with open(outFileName, 'w') as f:
+        r.writeText(f)
+    r.close()
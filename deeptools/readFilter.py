@@ -0,0 +1,168 @@
+import numpy as np
+
+
+class ReadFilter(object):
+    """
+    The alignment filters shared by the deepTools tools (--minMappingQuality,
+    --samFlagInclude, --samFlagExclude, --minFragmentLength,
+    --maxFragmentLength, --ignoreDuplicates and --filterRNAstrand). The
+    filters are applied to a batch of alignments at once, as boolean masks
+    over arrays of their flags, mapping qualities, template lengths and
+    positions (see columns).
+
+    The filters are applied in the order given by FILTERS, and each rejected
+    alignment is counted for the first filter rejecting it (see counts).
+    An alignment is a duplicate if its start, mate start and strand are the
+    same as those of the previous alignment that passed the filters before
+    ignoreDuplicates.
+
+    >>> import os
+    >>> import pysam
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> bam = pysam.AlignmentFile(root + "test_filtering.bam")
+    >>> reads = list(bam.fetch('3R', 100, 160))
+    >>> f = ReadFilter(minMappingQuality=10, samFlagExclude=256, ignoreDuplicates=True)
+    >>> keep = f.keep(f.columns(reads))
+    >>> int(keep.sum()), len(reads)
+    (12, 18)
+    >>> sorted([(k, v) for k, v in f.counts.items() if v > 0])
+    [('ignoreDuplicates', 3), ('minMappingQuality', 3)]
+    """
+
+    FILTERS = ['minMappingQuality', 'samFlagInclude', 'samFlagExclude',
+               'minFragmentLength', 'maxFragmentLength', 'ignoreDuplicates',
+               'filterRNAstrand']
+
+    def __init__(self, minMappingQuality=None, samFlagInclude=None,
+                 samFlagExclude=None, minFragmentLength=0,
+                 maxFragmentLength=0, ignoreDuplicates=False,
+                 filterRNAstrand=None):
+        self.minMappingQuality = minMappingQuality
+        self.samFlagInclude = samFlagInclude
+        self.samFlagExclude = samFlagExclude
+        self.minFragmentLength = minFragmentLength if minFragmentLength else 0
+        self.maxFragmentLength = maxFragmentLength if maxFragmentLength else 0
+        self.ignoreDuplicates = ignoreDuplicates
+        self.filterRNAstrand = filterRNAstrand
+        # number of alignments rejected by each filter
+        self.counts = dict([(name, 0) for name in self.FILTERS])
+
+    @classmethod
+    def fromArgs(cls, args):
+        """
+        Returns the ReadFilter of the parsed command line arguments of a
+        tool. Options that the tool does not have are not used.
+        """
+        return cls(minMappingQuality=getattr(args, 'minMappingQuality', None),
+                   samFlagInclude=getattr(args, 'samFlagInclude', None),
+                   samFlagExclude=getattr(args, 'samFlagExclude', None),
+                   minFragmentLength=getattr(args, 'minFragmentLength', 0),
+                   maxFragmentLength=getattr(args, 'maxFragmentLength', 0),
+                   ignoreDuplicates=getattr(args, 'ignoreDuplicates', False),
+                   filterRNAstrand=getattr(args, 'filterRNAstrand', None))
+
+    @staticmethod
+    def columns(reads):
+        """
+        Returns a dictionary with the arrays of the flag ('flag'), mapping
+        quality ('mapq'), template length ('tlen'), start ('start') and
+        mate start ('pnext') of a list of alignments. The arrays of the
+        alignments of a fragment cache (see
+        deeptools.fragmentCache.CachedReads) are used as they are.
+        """
+        if hasattr(reads, 'columns'):
+            return reads.columns
+        n = len(reads)
+        return {'flag': np.fromiter((r.flag for r in reads), dtype=np.int64, count=n),
+                'mapq': np.fromiter((r.mapq for r in reads), dtype=np.int64, count=n),
+                'tlen': np.fromiter((r.template_length for r in reads), dtype=np.int64, count=n),
+                'start': np.fromiter((r.reference_start for r in reads), dtype=np.int64, count=n),
+                'pnext': np.fromiter((r.next_reference_start for r in reads), dtype=np.int64, count=n)}
+
+    def _reject(self, keep, passing, name):
+        """
+        Removes the alignments not passing a filter from keep and counts them
+        """
+        rejected = keep & ~passing
+        self.counts[name] += int(rejected.sum())
+        keep &= passing
+
+    def mask(self, cols, keep=None):
+        """
+        Returns a boolean array that is True for the alignments that pass
+        all the filters applied before ignoreDuplicates. If given, only the
+        alignments for which keep is True are considered.
+        """
+        flag = cols['flag']
+        if keep is None:
+            keep = np.ones(len(flag), dtype=bool)
+        else:
+            keep = np.array(keep, dtype=bool)
+        if self.minMappingQuality:
+            self._reject(keep, cols['mapq'] >= self.minMappingQuality, 'minMappingQuality')
+
+        # filter reads based on SAM flag
+        if self.samFlagInclude:
+            self._reject(keep, flag & self.samFlagInclude == self.samFlagInclude, 'samFlagInclude')
+        if self.samFlagExclude:
+            self._reject(keep, flag & self.samFlagExclude == 0, 'samFlagExclude')
+
+        # Fragment lengths
+        if self.minFragmentLength > 0:
+            self._reject(keep, np.abs(cols['tlen']) >= self.minFragmentLength, 'minFragmentLength')
+        if self.maxFragmentLength > 0:
+            self._reject(keep, np.abs(cols['tlen']) <= self.maxFragmentLength, 'maxFragmentLength')
+        return keep
+
+    @staticmethod
+    def duplicates(cols, index):
+        """
+        Returns a boolean array that is True for each of the alignments in
+        index (an array of positions in cols) that has the same start, mate
+        start and strand as the previous alignment in index.
+        """
+        dup = np.zeros(len(index), dtype=bool)
+        if len(index) > 1:
+            start = cols['start'][index]
+            pnext = cols['pnext'][index]
+            reverse = cols['flag'][index] & 16
+            dup[1:] = (start[1:] == start[:-1]) & (pnext[1:] == pnext[:-1]) & \
+                (reverse[1:] == reverse[:-1])
+        return dup
+
+    def strandMask(self, flag):
+        """
+        Returns a boolean array that is True for the alignments of the
+        strand given by filterRNAstrand (see bamCoverage --filterRNAstrand).
+        """
+        if self.filterRNAstrand not in ('forward', 'reverse'):
+            return np.ones(len(flag), dtype=bool)
+        paired = flag & 1 != 0
+        if self.filterRNAstrand == 'forward':
+            pairedOk = ((flag & 128 == 128) & (flag & 16 == 0)) | ((flag & 64 == 64) & (flag & 32 == 0))
+            singleOk = flag & 16 == 16
+        else:
+            pairedOk = (flag & 144 == 144) | (flag & 96 == 96)
+            singleOk = flag & 16 == 0
+        return np.where(paired, pairedOk, singleOk)
+
+    def keep(self, cols, keep=None):
+        """
+        Applies all filters. Returns a boolean array that is True for the
+        alignments that are kept.
+        """
+        keep = self.mask(cols, keep)
+        if self.ignoreDuplicates:
+            index = np.flatnonzero(keep)
+            dup = np.zeros(len(keep), dtype=bool)
+            dup[index] = self.duplicates(cols, index)
+            self._reject(keep, ~dup, 'ignoreDuplicates')
+        if self.filterRNAstrand:
+            self._reject(keep, self.strandMask(cols['flag']), 'filterRNAstrand')
+        return keep
+
+    def rejected(self):
+        """
+        Returns the number of rejected alignments
+        """
+        return sum(self.counts.values())
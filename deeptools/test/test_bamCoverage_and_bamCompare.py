@@ -73,6 +73,31 @@ def test_bam_coverage_extend_and_normalizeto1x():
     unlink(outfile)
 
 
+def test_bam_coverage_extra_outputs():
+    """
+    Test that the files of --extraOutput are the same as those of
+    separate runs
+    """
+    outfile = '/tmp/test_file.bg'
+    extrafile = '/tmp/test_file_extra.bg'
+    args = "-b {} -o {} --extendReads 100 --outFileFormat bedgraph " \
+           "--extraOutput {} binSize=10 normalizeTo1x=200".format(BAMFILE_B, outfile, extrafile).split()
+    bam_cov.main(args)
+    _foo = open(outfile, 'r')
+    resp = _foo.readlines()
+    _foo.close()
+    expected = ['3R\t0\t150\t1\n', '3R\t150\t200\t3\n']
+    assert_equal(resp, expected)
+
+    _foo = open(extrafile, 'r')
+    resp = _foo.readlines()
+    _foo.close()
+    expected = ['3R\t0\t150\t0.5\n', '3R\t150\t200\t1.5\n']
+    assert_equal(resp, expected)
+    unlink(outfile)
+    unlink(extrafile)
+
+
 def test_bam_coverage_skipnas():
     outfile = '/tmp/test_file.bg'
     args = "--bam {} -o {} --outFileFormat bedgraph --skipNAs".format(BAMFILE_B, outfile).split()
@@ -301,6 +326,53 @@ def test_bam_coverage_filter_blacklist():
     unlink(outfile)
 
 
+def test_bam_coverage_smooth_blacklist():
+    """
+    Test that the tiles next to a blacklisted region are smoothed with
+    the tiles on their side of the region only
+    """
+    outfile = '/tmp/test_file_smooth.bg'
+    blacklist = '/tmp/test_file_smooth.blacklist.bed'
+    _foo = open(blacklist, 'w')
+    _foo.write("3R\t60\t100\n")
+    _foo.close()
+    args = "--bam {} -o {} -of bedgraph -p 1 --binSize 20 --smoothLength 60 " \
+           "--blackListFileName {}".format(BAMFILE_B, outfile, blacklist).split()
+    bam_cov.main(args)
+
+    _foo = open(outfile, 'r')
+    resp = _foo.readlines()
+    _foo.close()
+    expected = ['3R\t0\t20\t0\n', '3R\t20\t40\t0.333333\n', '3R\t40\t60\t0.5\n',
+                '3R\t100\t120\t1\n', '3R\t120\t140\t1.66667\n', '3R\t140\t160\t2\n',
+                '3R\t160\t180\t2.33333\n', '3R\t180\t200\t2\n']
+    assert_equal(resp, expected)
+    unlink(outfile)
+    unlink(blacklist)
+
+
+def test_bam_coverage_blacklist_remnant():
+    """
+    Test a blacklist that leaves a region shorter than the bin size
+    """
+    outfile = '/tmp/test_file_remnant.bg'
+    blacklist = '/tmp/test_file_remnant.blacklist.bed'
+    _foo = open(blacklist, 'w')
+    _foo.write("3R\t5\t100\n")
+    _foo.close()
+    args = "--bam {} -o {} -of bedgraph -p 1 --binSize 20 " \
+           "--blackListFileName {}".format(BAMFILE_B, outfile, blacklist).split()
+    bam_cov.main(args)
+
+    _foo = open(outfile, 'r')
+    resp = _foo.readlines()
+    _foo.close()
+    expected = ['3R\t100\t140\t0.75\n', '3R\t140\t160\t2.25\n', '3R\t160\t200\t1.5\n']
+    assert_equal(resp, expected)
+    unlink(outfile)
+    unlink(blacklist)
+
+
 def test_bam_coverage_offset1():
     """
     Test -bs 1 --Offset 1
@@ -1,6 +1,8 @@
 # from unittest import TestCase
 
 import deeptools.computeMatrixOperations as cmo
+from deeptools import heatmapper
+import numpy as np
 import os
 import hashlib
 import gzip
@@ -122,3 +124,62 @@ class TestComputeMatrixOperations(object):
         assert(d == dCorrect)
         assert(h == "10ea07d1aa58f44625abe2142ef76094")
         os.remove(oname)
+
+    def testBinary(self):
+        """
+        computeMatrixOperations subset --outFileFormat binary
+        """
+        oname = "/tmp/subset.dtmatrix"
+        args = "subset -m {} --samples SRR648667.forward SRR648670.reverse -o {} --outFileFormat binary".format(self.matrix, oname)
+        args = args.split()
+        cmo.main(args)
+        hm = heatmapper.heatmapper()
+        hm.read_matrix_file(oname)
+        hm2 = heatmapper.heatmapper()
+        hm2.read_matrix_file(self.matrix)
+        assert(hm.matrix.sample_labels == ["SRR648667.forward", "SRR648670.reverse"])
+        assert(hm.matrix.sample_boundaries == [0, 100, 200])
+        sub = hm.matrix.get_matrix(0, 1)['matrix']
+        assert(np.allclose(sub, hm2.matrix.get_matrix(0, 7)['matrix'], equal_nan=True))
+        assert(hm.matrix.regions == hm2.matrix.regions)
+        assert(np.allclose(hm.matrix.matrix[:, :100], hm2.matrix.matrix[:, :100], equal_nan=True))
+
+        # back to the text format
+        oname2 = "/tmp/subset.mat.gz"
+        args = "subset -m {} -o {}".format(oname, oname2)
+        args = args.split()
+        cmo.main(args)
+        hm3 = heatmapper.heatmapper()
+        hm3.read_matrix_file(oname2)
+        assert(hm3.matrix.regions == hm2.matrix.regions)
+        assert(np.allclose(hm3.matrix.matrix, hm.matrix.matrix, equal_nan=True))
+        os.remove(oname)
+        os.remove(oname2)
+
+    def testBinaryInput(self):
+        """
+        computeMatrixOperations cbind, rbind, sort and filterStrand with binary input
+        """
+        binary = "/tmp/all.dtmatrix"
+        args = "subset -m {} -o {} --outFileFormat binary".format(self.matrix, binary)
+        cmo.main(args.split())
+
+        commands = ["cbind -m {0} {0} -o {1}",
+                    "rbind -m {0} {0} -o {1}",
+                    "sort -m {0} -o {1} -R " + self.bed,
+                    "filterStrand -m {0} -o {1} --strand +"]
+        for command in commands:
+            oname = "/tmp/fromText.mat.gz"
+            oname2 = "/tmp/fromBinary.mat.gz"
+            cmo.main(command.format(self.matrix, oname).split())
+            cmo.main(command.format(binary, oname2).split())
+            hm = heatmapper.heatmapper()
+            hm.read_matrix_file(oname)
+            hm2 = heatmapper.heatmapper()
+            hm2.read_matrix_file(oname2)
+            assert(hm.parameters == hm2.parameters)
+            assert(hm.matrix.regions == hm2.matrix.regions)
+            assert(np.allclose(hm.matrix.matrix, hm2.matrix.matrix, equal_nan=True))
+            os.remove(oname)
+            os.remove(oname2)
+        os.remove(binary)
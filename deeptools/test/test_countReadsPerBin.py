@@ -4,6 +4,8 @@ import deeptools.countReadsPerBin as cr
 import numpy as np
 import numpy.testing as nt
 import os.path
+import shutil
+import tempfile
 
 __author__ = 'Fidel'
 
@@ -174,3 +176,60 @@ class TestCountReadsPerBin(object):
                                         [np.nan, 1],
                                         [1, 1],
                                         [1, 2]]))
+
+    def test_count_reads_in_region_fragment_cache(self):
+        """
+        The counts are the same when the reads are read from the
+        fragment caches of the bam files.
+        """
+        from deeptools.fragmentCache import writeFragmentCache, FragmentCache
+        from deeptools import bamHandler
+        tmpdir = tempfile.mkdtemp()
+        bamFiles = []
+        for bamFile in [self.bamFile1, self.bamFile2]:
+            copy = os.path.join(tmpdir, os.path.basename(bamFile))
+            shutil.copy(bamFile, copy)
+            shutil.copy(bamFile + ".bai", copy + ".bai")
+            writeFragmentCache(copy)
+            assert isinstance(bamHandler.getHandle(copy), FragmentCache)
+            bamFiles.append(copy)
+
+        self.c.bamFilesList = bamFiles
+        resp, _ = self.c.count_reads_in_region(self.chrom, 0, 200)
+        nt.assert_equal(resp, np.array([[0, 0.],
+                                        [0, 1.],
+                                        [1, 1.],
+                                        [1, 2.]]))
+
+        self.c.bamFilesList = bamFiles[:1]
+        self.c.binLength = 10
+        self.c.stepSize = 10
+        resp, _ = self.c.count_reads_in_region('chr_cigar', 0, 100)
+        nt.assert_array_equal(resp[:, 0], [0, 1, 1, 0, 1, 0, 0, 0, 0, 0])
+        bamHandler.closeHandles()
+        shutil.rmtree(tmpdir)
+
+    def test_count_reads_in_region_fragment_cache_extended(self):
+        """
+        The fragments of extended paired-end reads computed from the columns
+        of a fragment cache are those computed from the bam file.
+        """
+        from deeptools.fragmentCache import writeFragmentCache
+        from deeptools import bamHandler
+        tmpdir = tempfile.mkdtemp()
+        copy = os.path.join(tmpdir, os.path.basename(self.bamFile_PE))
+        shutil.copy(self.bamFile_PE, copy)
+        shutil.copy(self.bamFile_PE + ".bai", copy + ".bai")
+
+        for extendReads, ignoreDuplicates in [(True, False), (150, True)]:
+            c = cr.CountReadsPerBin([self.bamFile_PE], binLength=10, stepSize=10,
+                                    extendReads=extendReads, ignoreDuplicates=ignoreDuplicates)
+            expected, _ = c.count_reads_in_region('chr2', 5000000, 5002000)
+            c.bamFilesList = [copy]
+            writeFragmentCache(copy)
+            resp, _ = c.count_reads_in_region('chr2', 5000000, 5002000)
+            nt.assert_array_equal(resp, expected)
+            assert resp.sum() > 0
+            bamHandler.closeHandles()
+            os.remove(copy + ".dtcache")
+        shutil.rmtree(tmpdir)
@@ -20,6 +20,8 @@ def test_multiBamSummary_gtf():
     nt.assert_equal(labels, ['test1.bam', 'test1.bam'])
     nt.assert_allclose(matrix, np.array([[144.0, 144.0],
                                          [143.0, 143.0]]))
+    # read counts are saved with a compact dtype
+    nt.assert_equal(matrix.dtype, np.uint16)
     unlink(outfile)
 
 
@@ -34,3 +36,19 @@ def test_multiBamSummary_metagene():
     nt.assert_allclose(matrix, np.array([[25.0, 25.0],
                                          [31.0, 31.0]]))
     unlink(outfile)
+
+
+def test_multiBamSummary_binary_raw_counts():
+    from deeptools.rawCounts import RawCounts
+    outfile = '/tmp/_test.npz'
+    rawfile = '/tmp/_test.dtraw'
+    args = 'BED-file --BED {0} -b {1} {1} -o {2} --metagene --outRawCounts {3} ' \
+           '--outRawCountsFormat binary'.format(GTF, BAM, outfile, rawfile).split()
+    mbs.main(args)
+    raw = RawCounts(rawfile)
+    nt.assert_equal(raw.labels, ['test1.bam', 'test1.bam'])
+    nt.assert_equal(raw.column('counts'), np.load(outfile)['matrix'])
+    nt.assert_equal(raw.column('regionStarts'), [0, 399, 979, 99, 499, 1079])
+    raw.close()
+    unlink(outfile)
+    unlink(rawfile)
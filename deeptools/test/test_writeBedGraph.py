@@ -94,7 +94,9 @@ class TestWriteBedGraph(TestCase):
         _foo = open(tempFile, 'r')
         res = _foo.readlines()
         _foo.close()
-        assert_equal(res, ['3R\t100\t120\t1\n', '3R\t120\t180\t1.33333\n', '3R\t180\t200\t1\n'])
+        # the first tile is averaged with the (empty) tile before the region,
+        # the last one is at the end of the chromosome
+        assert_equal(res, ['3R\t100\t120\t0.666667\n', '3R\t120\t180\t1.33333\n', '3R\t180\t200\t1\n'])
         os.remove(tempFile)
 
     def test_writeBedGraph_cigar(self):
@@ -120,3 +122,33 @@ class TestWriteBedGraph(TestCase):
                            'chr_cigar\t40\t50\t1\n',
                            'chr_cigar\t50\t100\t0\n'])
         os.remove(tempFile)
+
+    def test_runs_joined_across_chunks(self):
+        """
+        Runs of equal value that meet at the boundary of two chunks are
+        written as a single run, as if the region was a single chunk.
+        """
+        import pyBigWig
+        chunks = [(0, 50), (50, 150), (150, 200)]
+        expected = ['3R\t0\t100\t0\n', '3R\t100\t200\t1\n']
+
+        bedGraphFile = wr.utilities.getTempFileName(suffix='.bg')
+        writer = wr.BedGraphEntryWriter(bedGraphFile)
+        for start, end in chunks:
+            runs = self.c.get_coverage_runs('3R', start, end, scaleCoverage, self.func_args)
+            writer.add_runs(wr.writeTempBedGraphRuns(*runs))
+        writer.close()
+        _foo = open(bedGraphFile, 'r')
+        assert_equal(_foo.readlines(), expected)
+        _foo.close()
+        os.remove(bedGraphFile)
+
+        bigWigFile = wr.utilities.getTempFileName(suffix='.bw')
+        writer = wr.BigWigEntryWriter(bigWigFile, [('3R', 200)])
+        for start, end in chunks:
+            writer.add_runs(self.c.get_coverage_runs('3R', start, end, scaleCoverage, self.func_args))
+        assert_equal(writer.close(), 2)
+        bw = pyBigWig.open(bigWigFile)
+        assert_equal(bw.intervals('3R'), ((0, 100, 0.0), (100, 200, 1.0)))
+        bw.close()
+        os.remove(bigWigFile)
@@ -1,5 +1,6 @@
 import sys
 import os
+import numpy as np
 import pysam
 from deeptoolsintervals import GTF
 from deeptools.bamHandler import openBam
@@ -7,6 +8,9 @@ from deeptools.bamHandler import openBam
 
 debug = 0
 
+# blacklists loaded by the current process, see getBlackList
+_blackLists = {}
+
 
 def getGC_content(tb, chrom, fragStart, fragEnd, fraction=True):
     bases = tb.bases(chrom, fragStart, fragEnd, fraction=False)
@@ -339,6 +343,117 @@ def bam_total_reads(bam_handle, chroms_to_ignore):
     return tot_mapped_reads
 
 
+class BlackList(object):
+    """
+    The intervals of blacklist (BED) files. The files are parsed once and
+    the intervals are then stored per chromosome as numpy arrays sorted by
+    start position, together with the running maximum of their end
+    positions. Compared to the GTF object of deeptoolsintervals, this
+    takes little memory, can be pickled (e.g. to send it to worker
+    processes) and allows checking many intervals at once (see mask).
+
+    findOverlaps returns the same intervals as GTF.findOverlaps, in the
+    same order, as (start, end) tuples. As for GTF, the chromosome names
+    chr1/1 and chrM/MT are considered equal.
+
+    >>> import os
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> bl = BlackList(root + "test_filtering.blacklist.bed")
+    >>> bl.findOverlaps('3R', 0, 1000)
+    [(800, 900)]
+    >>> bl.findOverlaps('chr3R', 850, 851)
+    [(800, 900)]
+    >>> bl.findOverlaps('3R', 900, 1000)
+    []
+    >>> bl.findOverlaps('chrX', 0, 1000)
+    []
+    >>> bl.mask('3R', [0, 750, 850, 900], [800, 801, 860, 950]).tolist()
+    [False, True, True, False]
+    """
+
+    def __init__(self, fileName):
+        gtf = GTF(fileName)
+        self.chroms = sorted(set(gtf.chroms))
+        self.starts = {}
+        self.ends = {}
+        self.maxEnds = {}
+        for chrom in self.chroms:
+            overlaps = gtf.findOverlaps(chrom, 0, 4294967295)
+            if not overlaps:
+                overlaps = []
+            self.starts[chrom] = np.array([x[0] for x in overlaps], dtype=np.int64)
+            self.ends[chrom] = np.array([x[1] for x in overlaps], dtype=np.int64)
+            self.maxEnds[chrom] = np.maximum.accumulate(self.ends[chrom]) if len(overlaps) else self.ends[chrom]
+
+    def _chromName(self, chrom):
+        """
+        Returns the chromosome name used in the blacklist, or None
+        """
+        if chrom in self.starts:
+            return chrom
+        if chrom == "MT" and "chrM" in self.starts:
+            return "chrM"
+        if chrom == "chrM" and "MT" in self.starts:
+            return "MT"
+        if chrom.startswith("chr") and len(chrom) > 3 and chrom[3:] in self.starts:
+            return chrom[3:]
+        if "chr" + chrom in self.starts:
+            return "chr" + chrom
+        return None
+
+    def findOverlaps(self, chrom, start, end):
+        """
+        Returns the list of blacklisted (start, end) intervals overlapping
+        the region (start, end), sorted by start position.
+        """
+        chrom = self._chromName(chrom)
+        if chrom is None:
+            return []
+        starts = self.starts[chrom]
+        # all intervals before first end before start, as the running
+        # maximum of their end positions is sorted
+        first = np.searchsorted(self.maxEnds[chrom], start, side='right')
+        last = np.searchsorted(starts, end, side='left')
+        ends = self.ends[chrom]
+        return [(int(starts[i]), int(ends[i])) for i in range(first, last) if ends[i] > start]
+
+    def mask(self, chrom, starts, ends):
+        """
+        Returns a boolean array that is True for each of the regions given
+        by the arrays starts and ends that overlaps a blacklisted interval.
+        """
+        starts = np.asarray(starts)
+        chrom = self._chromName(chrom)
+        if chrom is None:
+            return np.zeros(starts.shape, dtype=bool)
+        # the last interval starting before the end of a region overlaps it
+        # if it or any of the intervals before it end after the region start
+        idx = np.searchsorted(self.starts[chrom], ends, side='left')
+        maxEnds = np.concatenate([[np.iinfo(np.int64).min], self.maxEnds[chrom]])
+        return maxEnds[idx] > starts
+
+
+def getBlackList(fileName):
+    """
+    Returns the BlackList of a file (or list of files). The files are
+    parsed only once per process, and (e.g. as attribute of a pickled
+    object) the result can be shared with worker processes.
+
+    >>> import os
+    >>> root = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+    >>> getBlackList(root + "test_filtering.blacklist.bed") is getBlackList(root + "test_filtering.blacklist.bed")
+    True
+    """
+    if fileName is None:
+        return None
+    key = fileName
+    if isinstance(fileName, list):
+        key = tuple(fileName)
+    if key not in _blackLists:
+        _blackLists[key] = BlackList(fileName)
+    return _blackLists[key]
+
+
 def bam_blacklisted_worker(args):
     bam, chrom, start, end = args
     fh = openBam(bam)
@@ -365,7 +480,7 @@ def bam_blacklisted_reads(bam_handle, chroms_to_ignore, blackListFileName=None,
         chrom, _len, nmapped, _nunmapped = line.split('\t')
         chromLens[chrom] = int(_len)
 
-    bl = GTF(blackListFileName)
+    bl = getBlackList(blackListFileName)
     regions = []
     for chrom in bl.chroms:
         if (not chroms_to_ignore or chrom not in chroms_to_ignore) and chrom in chromLens:
@@ -374,9 +489,16 @@ def bam_blacklisted_reads(bam_handle, chroms_to_ignore, blackListFileName=None,
 
     if len(regions) > 0:
         import multiprocessing
+        from deeptools.mapReduce import getPool
         if len(regions) > 1 and numberOfProcessors > 1:
-            pool = multiprocessing.Pool(numberOfProcessors)
-            res = pool.map_async(bam_blacklisted_worker, regions).get(9999999)
+            pool = getPool()
+            if pool is not None:
+                res = pool.map_async(bam_blacklisted_worker, regions).get(9999999)
+            else:
+                pool = multiprocessing.Pool(numberOfProcessors)
+                res = pool.map_async(bam_blacklisted_worker, regions).get(9999999)
+                pool.close()
+                pool.join()
         else:
             res = [bam_blacklisted_worker(x) for x in regions]
         for val in res:
@@ -6,7 +6,7 @@ import pyBigWig
 
 # own modules
 from deeptools import mapReduce
-from deeptools.utilities import getCommonChrNames, toBytes
+from deeptools.utilities import getCommonChrNames
 import deeptools.countReadsPerBin as cr
 from deeptools import bamHandler
 from deeptools import utilities
@@ -15,17 +15,62 @@ from deeptools import config as cfg
 debug = 0
 old_settings = np.seterr(all='ignore')
 
+# pyBigWig only accepts numpy arrays, instead of lists, if it was built
+# with numpy support
+BIGWIG_NUMPY = bool(getattr(pyBigWig, 'numpy', 0))
+
 
 def writeBedGraph_wrapper(args):
     """
-    Passes the arguments to writeBedGraph_worker.
+    Passes the arguments to get_coverage_runs and writes the runs
+    to a temporary bedgraph file (see writeTempBedGraphRuns).
     This is a step required given
     the constrains from the multiprocessing module.
     The args var, contains as first element the 'self' value
     from the WriteBedGraph object
 
     """
-    return WriteBedGraph.writeBedGraph_worker(*args)
+    return writeTempBedGraphRuns(*WriteBedGraph.get_coverage_runs(*args))
+
+
+def writeBedGraphEmpty_wrapper(args):
+    """
+    Same as writeBedGraph_wrapper, but for regions known to contain
+    no reads. The bam files are not accessed.
+    """
+    return writeTempBedGraphRuns(*WriteBedGraph.get_coverage_runs(*args, noReads=True))
+
+
+def coverageRuns_wrapper(args):
+    """
+    Same as writeBedGraph_wrapper, but the coverage runs are returned
+    instead of being written to a bedgraph file.
+    """
+    return WriteBedGraph.get_coverage_runs(*args)
+
+
+def coverageRunsEmpty_wrapper(args):
+    """
+    Same as coverageRuns_wrapper, but for regions known to contain
+    no reads. The bam files are not accessed.
+    """
+    return WriteBedGraph.get_coverage_runs(*args, noReads=True)
+
+
+def outputsRuns_wrapper(args):
+    """
+    Same as writeBedGraph_wrapper, for several outputs at once
+    (see WriteBedGraph.get_outputs_coverage_runs).
+    """
+    return WriteBedGraph.get_outputs_coverage_runs(*args)
+
+
+def outputsRunsEmpty_wrapper(args):
+    """
+    Same as outputsRuns_wrapper, but for regions known to contain
+    no reads. The bam files are not accessed.
+    """
+    return WriteBedGraph.get_outputs_coverage_runs(*args, noReads=True)
 
 
 class WriteBedGraph(cr.CountReadsPerBin):
@@ -91,7 +136,8 @@ class WriteBedGraph(cr.CountReadsPerBin):
 
     """
 
-    def run(self, func_to_call, func_args, out_file_name, blackListFileName=None, format="bedgraph", smoothLength=0):
+    def run(self, func_to_call, func_args, out_file_name, blackListFileName=None, format="bedgraph", smoothLength=0,
+            extra_outputs=None):
         r"""
         Given a list of bamfiles, a function and a function arguments,
         this method writes a bedgraph file (or bigwig) file
@@ -115,60 +161,259 @@ class WriteBedGraph(cr.CountReadsPerBin):
         smoothLength : int
             Distance in bp for smoothing the coverage per tile.
 
+        extra_outputs : list
+            List of (out_file_name, binLength, func_args, format) tuples of
+            further files to write. All files are written from a single
+            pass over the bam files: the reads of each chunk are fetched,
+            filtered and converted into fragments once, and the fragments
+            are then counted for the bins of each file. Smoothing is not
+            supported with extra outputs.
+
 
         """
         self.__dict__["smoothLength"] = smoothLength
+        outputs = [(out_file_name, self.binLength, func_args, format)]
+        if extra_outputs:
+            if smoothLength:
+                raise ValueError("smoothLength can not be used with extra outputs")
+            outputs.extend(extra_outputs)
+        # the chunks must contain a whole number of tiles of every output
+        tile_size = leastCommonMultiple([x[1] for x in outputs])
+
         bam_handlers = [bamHandler.openBam(x) for x in self.bamFilesList]
-        genome_chunk_length = getGenomeChunkLength(bam_handlers, self.binLength)
+        genome_chunk_length = max(getGenomeChunkLength(bam_handlers, tile_size), tile_size)
         # check if both bam files correspond to the same species
         # by comparing the chromosome names:
         chrom_names_and_size, non_common = getCommonChrNames(bam_handlers, verbose=False)
 
         if self.region:
             # in case a region is used, append the tilesize
-            self.region += ":{}".format(self.binLength)
+            self.region += ":{}".format(tile_size)
 
         for x in list(self.__dict__.keys()):
             sys.stderr.write("{}: {}\n".format(x, self.__getattribute__(x)))
 
-        res = mapReduce.mapReduce([func_to_call, func_args],
-                                  writeBedGraph_wrapper,
-                                  chrom_names_and_size,
-                                  self_=self,
-                                  genomeChunkLength=genome_chunk_length,
-                                  region=self.region,
-                                  blackListFileName=blackListFileName,
-                                  numberOfProcessors=self.numberOfProcessors)
-
-        # concatenate intermediary bedgraph files
-        out_file = open(out_file_name + ".bg", 'wb')
-        for tempfilename in res:
-            if tempfilename:
-                # concatenate all intermediate tempfiles into one
-                # bedgraph file
-                _foo = open(tempfilename, 'rb')
-                shutil.copyfileobj(_foo, out_file)
-                _foo.close()
-                os.remove(tempfilename)
-
-        bedgraph_file = out_file.name
-        out_file.close()
-        if format == 'bedgraph':
-            sort_cmd = cfg.config.get('external_tools', 'sort')
-            os.system("LC_ALL=C {} -k1,1 -k2,2n {} > {}".format(sort_cmd, bedgraph_file, out_file_name))
-            os.remove(bedgraph_file)
-            if self.verbose:
-                print("output file: {}".format(out_file_name))
+        # use the bam indices to balance the work among the
+        # processors and to skip regions without reads
+        readDensity = bamHandler.getReadDensity(self.bamFilesList)
+        # reads that far from a chunk can still affect its values
+        chunkMargin = self.get_read_extension()
+        if self.smoothLength:
+            chunkMargin += self.binLength * max(smoothingWindow(self.binLength, self.smoothLength))
+
+        # The chromosomes are processed in the order of their names, the
+        # order of the bigwig header. As the results are collected in the
+        # order of the chunks, the output needs no further sorting.
+        chrom_names_and_size = sorted(chrom_names_and_size)
+        # intermediary bedgraph files are concatenated as they arrive, while
+        # for bigwig files the workers return the coverage runs as arrays,
+        # which are added without a bedgraph intermediate. Runs of equal
+        # value that meet at the boundary of two chunks are joined.
+        out_files = [BedGraphEntryWriter(x[0]) if x[3] == 'bedgraph' else BigWigEntryWriter(x[0], chrom_names_and_size)
+                     for x in outputs]
+        if len(outputs) > 1:
+            static_args = [func_to_call, [x[1:] for x in outputs]]
+            out_file = out_files
+            reducer = addToOutputs
+            wrapper, empty_wrapper = outputsRuns_wrapper, outputsRunsEmpty_wrapper
+        elif format == 'bedgraph':
+            static_args = [func_to_call, func_args]
+            out_file = out_files[0]
+            reducer = BedGraphEntryWriter.add_runs
+            wrapper, empty_wrapper = writeBedGraph_wrapper, writeBedGraphEmpty_wrapper
         else:
-            bedGraphToBigWig(
-                chrom_names_and_size, bedgraph_file, out_file_name, True)
+            static_args = [func_to_call, func_args]
+            out_file = out_files[0]
+            reducer = BigWigEntryWriter.add_runs
+            wrapper, empty_wrapper = coverageRuns_wrapper, coverageRunsEmpty_wrapper
+
+        try:
+            mapReduce.mapReduce(static_args,
+                                wrapper,
+                                chrom_names_and_size,
+                                self_=self,
+                                genomeChunkLength=genome_chunk_length,
+                                region=self.region,
+                                blackListFileName=blackListFileName,
+                                numberOfProcessors=self.numberOfProcessors,
+                                reducer=reducer,
+                                reducerInit=out_file,
+                                readDensity=readDensity,
+                                chunkAlignment=tile_size,
+                                chunkMargin=chunkMargin,
+                                emptyChunkFunc=empty_wrapper)
+        except:
+            # the output files are incomplete
+            for out, (file_name, _, _, _) in zip(out_files, outputs):
+                out.close()
+                os.remove(file_name)
+            raise
+        # for a bigwig file, the number of entries written is returned
+        num_entries = [x.close() for x in out_files]
+
+        for (file_name, _, _, file_format), entries in zip(outputs, num_entries):
+            if file_format != 'bedgraph' and entries == 0:
+                os.remove(file_name)
+                sys.stderr.write(
+                    "Error: The generated bedGraphFile was empty. Please adjust\n"
+                    "your deepTools settings and check your input files.\n")
+                exit(1)
             if self.verbose:
-                print("output file: {}".format(out_file_name))
-            os.remove(bedgraph_file)
+                print("output file: {}".format(file_name))
+
+    def get_coverage_runs(self, chrom, start, end,
+                          func_to_call, func_args,
+                          bed_regions_list=None, noReads=False):
+        r"""Computes the value of each tile of the region, using the
+        given func on the read coverage found on bamFiles, and merges
+        consecutive tiles of equal value (see coverageRuns).
+
+        The parameters are the same as for writeBedGraph_worker.
+
+        Returns
+        -------
+        a tuple with the chromosome name and the start, end and value
+        arrays of the runs
+
+        Examples
+        --------
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], 50, 0, stepSize=50)
+        >>> chrom, starts, ends, values = c.get_coverage_runs('3R', 0, 200, scaleCoverage, {'scaleFactor': 1.0})
+        >>> chrom, starts.tolist(), ends.tolist(), values.tolist()
+        ('3R', [0, 100], [100, 200], [0.0, 1.0])
+        """
+        if start > end:
+            raise NameError("start position ({0}) bigger "
+                            "than end position ({1})".format(start, end))
+
+        smooth = self.smoothLength is not None and self.smoothLength > 0
+        if smooth:
+            # the tiles around the region are needed to smooth those at its
+            # edges, otherwise the result would depend on the chunk size
+            region_start, region_end = self.get_smooth_region(chrom, start, end)
+        else:
+            region_start, region_end = start, end
+
+        coverage, _ = self.count_reads_in_region(chrom, region_start, region_end, noReads=noReads)
+
+        if smooth:
+            coverage = smoothCoverage(coverage, self.binLength, self.smoothLength)
+            first_tile = (start - region_start) // self.binLength
+            coverage = coverage[first_tile:first_tile + (end - start) // self.binLength, :]
+
+        tile_values = applyTileFunction(func_to_call, coverage, func_args)
+        starts, ends, values = coverageRuns(tile_values, start, end, self.binLength)
+        return chrom, starts, ends, values
+
+    def get_outputs_coverage_runs(self, chrom, start, end,
+                                  func_to_call, outputs,
+                                  bed_regions_list=None, noReads=False):
+        r"""Same as get_coverage_runs, for several outputs with their
+        own tile size and func_args. The reads of the region are fetched
+        and converted into fragments only once for all the outputs.
+
+        Parameters
+        ----------
+        outputs : list
+            List of (binLength, func_args, format) tuples.
+
+        The other parameters are the same as for writeBedGraph_worker.
+
+        Returns
+        -------
+        a list with, for each output, the coverage runs as returned by
+        get_coverage_runs or, if the format is 'bedgraph', by
+        writeTempBedGraphRuns
+
+        Examples
+        --------
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], 50, 0, stepSize=50)
+        >>> outputs = [(50, {'scaleFactor': 1.0}, 'bigwig'), (25, {'scaleFactor': 2.0}, 'bigwig')]
+        >>> for chrom, starts, ends, values in c.get_outputs_coverage_runs('3R', 0, 200, scaleCoverage, outputs):
+        ...     starts.tolist(), ends.tolist(), values.tolist()
+        ([0, 100], [100, 200], [0.0, 1.0])
+        ([0, 100], [100, 200], [0.0, 2.0])
+        """
+        if start > end:
+            raise NameError("start position ({0}) bigger "
+                            "than end position ({1})".format(start, end))
+
+        # one list of regions per output, all of them covering the whole
+        # interval, such that the reads are fetched once (see get_fetch_clusters)
+        transcripts = [[(start, end, output[0])] for output in outputs]
+        if noReads:
+            coverages = [[self.get_empty_coverage(trans) for trans in transcripts]
+                         for _ in self.bamFilesList]
+        else:
+            clusters = self.get_fetch_clusters(chrom, transcripts, self.get_blacklist())
+            coverages = [self.get_coverage_of_regions(bamHandler.getHandle(fname), chrom, transcripts,
+                                                      clusters=clusters)
+                         for fname in self.bamFilesList]
+
+        results = []
+        for idx, (tile_size, func_args, file_format) in enumerate(outputs):
+            coverage = np.column_stack([tcovs[idx] for tcovs in coverages])
+            tile_values = applyTileFunction(func_to_call, coverage, func_args)
+            starts, ends, values = coverageRuns(tile_values, start, end, tile_size)
+            if file_format == 'bedgraph':
+                results.append(writeTempBedGraphRuns(chrom, starts, ends, values))
+            else:
+                results.append((chrom, starts, ends, values))
+        return results
+
+    def get_smooth_region(self, chrom, start, end):
+        """
+        Returns the region whose tiles are averaged to smooth the tiles
+        of the interval (start, end), i.e. the interval extended by the
+        smoothing window on both sides, within the chromosome. As for a
+        single region, the last tile of the chromosome extends to its end.
+
+        The extension stops at blacklisted intervals, otherwise the whole
+        region would be considered blacklisted. As when the chunks were
+        smoothed on their own, the window is then truncated there.
+
+        >>> test_path = os.path.dirname(os.path.abspath(__file__)) + "/test/test_data/"
+        >>> c = WriteBedGraph([test_path + "testA.bam"], 10, 0, stepSize=10)
+        >>> c.smoothLength = 30
+        >>> c.get_smooth_region('3R', 50, 100)
+        (40, 110)
+        >>> c.get_smooth_region('3R', 0, 185)
+        (0, 200)
+        >>> c = WriteBedGraph([test_path + "test_filtering.bam"], 10, 0, stepSize=10,
+        ...                   blackListFileName=test_path + "test_filtering.blacklist.bed")
+        >>> c.smoothLength = 50
+        >>> c.get_smooth_region('3R', 900, 1000)
+        (900, 1020)
+        >>> c.get_smooth_region('3R', 750, 800)
+        (730, 800)
+        """
+        before, after = smoothingWindow(self.binLength, self.smoothLength)
+        bam = bamHandler.getHandle(self.bamFilesList[0])
+        chrom_length = bam.lengths[list(bam.references).index(chrom)]
+
+        region_start = start - min(before, start // self.binLength) * self.binLength
+        region_end = min(end + max(after, 0) * self.binLength, chrom_length)
+        if chrom_length - region_end < self.binLength:
+            region_end = chrom_length
+
+        blackList = self.get_blacklist()
+        if blackList is not None:
+            # only whole tiles between the region and a blacklisted interval are added
+            overlaps = blackList.findOverlaps(chrom, region_start, start)
+            if overlaps:
+                blacklist_end = max([x[1] for x in overlaps])
+                region_start = start - max(0, (start - blacklist_end) // self.binLength) * self.binLength
+            overlaps = blackList.findOverlaps(chrom, end, region_end)
+            if overlaps:
+                blacklist_start = min([x[0] for x in overlaps])
+                region_end = end + max(0, (blacklist_start - end) // self.binLength) * self.binLength
+        return region_start, region_end
 
     def writeBedGraph_worker(self, chrom, start, end,
                              func_to_call, func_args,
-                             bed_regions_list=None):
+                             bed_regions_list=None, noReads=False):
         r"""Writes a bedgraph based on the read coverage found on bamFiles
 
         The given func is called to compute the desired bedgraph value
@@ -196,6 +441,9 @@ class WriteBedGraph(cr.CountReadsPerBin):
             corresponding to bed regions to be processed.
             If not bed file was passed to the object constructor
             then this list is empty.
+        noReads : bool
+            If True, the region is known to contain no reads and
+            the bam files are not accessed.
 
         Returns
         -------
@@ -220,66 +468,295 @@ class WriteBedGraph(cr.CountReadsPerBin):
 
 
         """
-        if start > end:
-            raise NameError("start position ({0}) bigger "
-                            "than end position ({1})".format(start, end))
+        chrom, starts, ends, values = self.get_coverage_runs(chrom, start, end,
+                                                             func_to_call, func_args,
+                                                             noReads=noReads)
 
-        coverage, _ = self.count_reads_in_region(chrom, start, end)
+        return writeTempBedGraph(chrom, starts, ends, values)
 
-        _file = open(utilities.getTempFileName(suffix='.bg'), 'w')
-        previous_value = None
-        line_string = "{}\t{}\t{}\t{:g}\n"
-        for tileIndex in range(coverage.shape[0]):
 
-            if self.smoothLength is not None and self.smoothLength > 0:
-                vector_start, vector_end = self.getSmoothRange(tileIndex,
-                                                               self.binLength,
-                                                               self.smoothLength,
-                                                               coverage.shape[0])
-                tileCoverage = np.mean(coverage[vector_start:vector_end, :], axis=0)
-            else:
-                tileCoverage = coverage[tileIndex, :]
-
-            value = func_to_call(tileCoverage, func_args)
-            """
-            # uncomment these lines if fixed step bedgraph is required
-            if not np.isnan(value):
-                writeStart = start + tileIndex*self.binLength
-                writeEnd  =  min(writeStart+self.binLength, end)
-                _file.write(line_string.format(chrom, writeStart,
-                                           end, previous_value))
-            """
-
-            if previous_value is None:
-                writeStart = start + tileIndex * self.binLength
-                writeEnd = min(writeStart + self.binLength, end)
-                previous_value = value
-
-            elif previous_value == value:
-                writeEnd = min(writeEnd + self.binLength, end)
-
-            elif previous_value != value:
-                if not np.isnan(previous_value):
-                    _file.write(
-                        line_string.format(chrom, writeStart, writeEnd, previous_value))
-                previous_value = value
-                writeStart = writeEnd
-                writeEnd = min(writeStart + self.binLength, end)
-
-        # write remaining value if not a nan
-        if previous_value is not None and writeStart != end and not np.isnan(previous_value):
-            _file.write(line_string.format(chrom, writeStart,
-                                           end, previous_value))
-
-        tempfilename = _file.name
-        _file.close()
-        return tempfilename
+def writeTempBedGraph(chrom, starts, ends, values):
+    """
+    Writes coverage runs to a temporary bedgraph file and returns its name.
+    """
+    _file = open(utilities.getTempFileName(suffix='.bg'), 'w')
+    line_string = "{}\t{}\t{}\t{:g}\n"
+    for writeStart, writeEnd, value in zip(starts, ends, values):
+        _file.write(line_string.format(chrom, writeStart, writeEnd, value))
+
+    tempfilename = _file.name
+    _file.close()
+    return tempfilename
+
+
+def writeTempBedGraphRuns(chrom, starts, ends, values):
+    r"""
+    Writes the coverage runs of a region, except the first and the last
+    one, to a temporary bedgraph file (see writeTempBedGraph). Those are
+    kept as arrays, such that BedGraphEntryWriter can join them to the
+    runs of the adjacent regions.
+
+    Returns the chromosome, the start, end and value arrays of the first
+    and last runs and the name of the temporary file, or None if the
+    region has no more than two runs.
+
+    >>> chrom, starts, ends, values, tempFile = writeTempBedGraphRuns('3R', np.array([0, 100, 150, 175]),
+    ...                                                               np.array([100, 150, 175, 200]),
+    ...                                                               np.array([0, 1, 2, 1.5]))
+    >>> starts.tolist(), ends.tolist(), values.tolist()
+    ([0, 175], [100, 200], [0.0, 1.5])
+    >>> f = open(tempFile, 'r')
+    >>> f.readlines()
+    ['3R\t100\t150\t1\n', '3R\t150\t175\t2\n']
+    >>> f.close()
+    >>> os.remove(tempFile)
+    """
+    if len(starts) <= 2:
+        return chrom, starts, ends, values, None
+    tempfilename = writeTempBedGraph(chrom, starts[1:-1], ends[1:-1], values[1:-1])
+    edges = [0, len(starts) - 1]
+    return chrom, starts[edges], ends[edges], values[edges], tempfilename
+
+
+def addToOutputs(out_files, results):
+    """
+    Adds the results of get_outputs_coverage_runs for a region to the
+    output files, bigwig files (see BigWigEntryWriter) and bedgraph files
+    (see BedGraphEntryWriter). Meant to be used as mapReduce reducer,
+    hence the list of files is returned.
+    """
+    for out_file, result in zip(out_files, results):
+        out_file.add_runs(result)
+    return out_files
+
+
+def leastCommonMultiple(values):
+    """
+    >>> leastCommonMultiple([10, 25, 4])
+    100
+    """
+    result = 1
+    for value in values:
+        a, b = result, int(value)
+        while b:
+            a, b = b, a % b
+        result = result * int(value) // a
+    return result
+
+
+def appendTempFile(out_file, tempfilename):
+    """
+    Appends the content of a temporary file, as returned by the workers,
+    to the given (binary) file handle and removes the temporary file.
+    Meant to be used as mapReduce reducer, hence the file handle
+    is returned.
+    """
+    if tempfilename:
+        _foo = open(tempfilename, 'rb')
+        shutil.copyfileobj(_foo, out_file)
+        _foo.close()
+        os.remove(tempfilename)
+    return out_file
+
+
+def smoothingWindow(tileSize, smoothLength):
+    """
+    Returns the number of tiles before and after a tile that are
+    averaged with it to smooth the coverage over smoothLength (see
+    CountReadsPerBin.getSmoothRange).
+
+    >>> smoothingWindow(10, 30)
+    (1, 1)
+    >>> smoothingWindow(10, 40)
+    (2, 1)
+    """
+    smoothTilesSide = float(int(smoothLength / tileSize) - 1) / 2
+    return int(np.ceil(smoothTilesSide)), int(np.floor(smoothTilesSide))
+
+
+def smoothCoverage(coverage, tileSize, smoothLength):
+    """
+    Returns the mean coverage of each tile (row) and the tiles around
+    it, as CountReadsPerBin.getSmoothRange does for a single tile, with
+    the window truncated at the ends of the matrix. The means of all
+    tiles are computed at once from cumulative sums. A window containing
+    a nan has a nan mean.
+
+    >>> coverage = np.array([[1.0, 2], [2, 2], [3, 2], [4, 2], [np.nan, 2]])
+    >>> smoothCoverage(coverage, 10, 30).tolist()
+    [[1.5, 2.0], [2.0, 2.0], [3.0, 2.0], [nan, 2.0], [nan, 2.0]]
+    """
+    coverage = np.asarray(coverage, dtype='float64')
+    before, after = smoothingWindow(tileSize, smoothLength)
+    tileIndex = np.arange(coverage.shape[0])
+    windowStart = np.maximum(tileIndex - before, 0)
+    windowEnd = np.minimum(tileIndex + after + 1, coverage.shape[0])
+
+    isNan = np.isnan(coverage)
+    zeros = np.zeros((1, coverage.shape[1]))
+    sums = np.concatenate([zeros, np.cumsum(np.where(isNan, 0, coverage), axis=0)])
+    nans = np.concatenate([zeros, np.cumsum(isNan, axis=0)])
+
+    means = (sums[windowEnd] - sums[windowStart]) / (windowEnd - windowStart)[:, np.newaxis]
+    means[nans[windowEnd] - nans[windowStart] > 0] = np.nan
+    return means
+
+
+def coverageRuns(tile_values, start, end, tileSize):
+    """
+    Merges consecutive tiles of equal value. The tiles are of size
+    tileSize starting at start, except the last one that extends
+    to end. Tiles with a nan value are skipped.
+
+    Returns the start, end and value arrays of the runs.
+
+    >>> starts, ends, values = coverageRuns([0, 0, 1.5, np.nan, np.nan, 2], 100, 165, 10)
+    >>> starts.tolist(), ends.tolist(), values.tolist()
+    ([100, 120, 150], [120, 130, 165], [0.0, 1.5, 2.0])
+    >>> [x.tolist() for x in coverageRuns([], 0, 5, 10)]
+    [[], [], []]
+    """
+    tile_values = np.asarray(tile_values, dtype='float64')
+    if len(tile_values) == 0:
+        # e.g. what remains of a chunk next to a blacklisted region is shorter than a tile
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), tile_values
+    # a run begins at every tile whose value differs from the value of the
+    # previous tile. Note that nan != nan, such that nans are not merged
+    first_tile = np.flatnonzero(np.concatenate([[True], tile_values[1:] != tile_values[:-1]]))
+    starts = start + first_tile * tileSize
+    ends = np.append(starts[1:], end)
+    values = tile_values[first_tile]
+    keep = ~np.isnan(values)
+    return starts[keep], ends[keep], values[keep]
+
+
+def joinRuns(last_run, chrom, starts, ends, values):
+    """
+    Joins the first run of a region to last_run, the last run of the
+    previous region, if they are on the same chromosome, adjacent and of
+    equal value. The runs are then the same as for a single region
+    covering both (see coverageRuns).
+
+    Returns last_run, or None if it is joined, and the runs of the
+    region.
+
+    >>> last_run, starts, ends, values = joinRuns(('3R', 0, 100, 1.0), '3R', np.array([100, 150]),
+    ...                                           np.array([150, 200]), np.array([1.0, 2.0]))
+    >>> last_run, starts.tolist(), ends.tolist(), values.tolist()
+    (None, [0, 150], [150, 200], [1.0, 2.0])
+    >>> joinRuns(('3R', 0, 100, 1.0), '3R', np.array([110]), np.array([150]), np.array([1.0]))[0]
+    ('3R', 0, 100, 1.0)
+    """
+    if last_run is not None and len(starts):
+        last_chrom, last_start, last_end, last_value = last_run
+        if last_chrom == chrom and last_end == starts[0] and last_value == values[0]:
+            starts = starts.copy()
+            starts[0] = last_start
+            last_run = None
+    return last_run, starts, ends, values
+
+
+class BigWigEntryWriter(object):
+    """
+    Writes coverage runs, as returned by WriteBedGraph.get_coverage_runs,
+    to a bigwig file. The runs must be added sorted by chromosome, in
+    the order of chromSizes, and by position.
+
+    The last run added is held back, to be joined with the first run
+    of the next region (see joinRuns).
+    """
+
+    def __init__(self, bigWigPath, chromSizes):
+        self.bw = pyBigWig.open(bigWigPath, "w")
+        assert(self.bw is not None)
+        # The lack of maxZooms will change the results a bit, perhaps the defaults are better
+        self.bw.addHeader([(chrom, int(size)) for chrom, size in chromSizes], maxZooms=10)
+        self.num_entries = 0
+        self.last_run = None
+
+    def add_runs(self, runs):
+        """
+        Adds the runs of a region, with a pyBigWig call for all but the
+        last one, which is held back. Meant
+        to be used as mapReduce reducer, hence the writer is returned.
+        """
+        chrom = runs[0]
+        last_run, starts, ends, values = joinRuns(self.last_run, *runs)
+        if len(starts):
+            if last_run is not None:
+                self.bw.addEntries([last_run[0]], [last_run[1]], ends=[last_run[2]], values=[last_run[3]])
+                self.num_entries += 1
+            self.last_run = (chrom, int(starts[-1]), int(ends[-1]), float(values[-1]))
+            starts, ends, values = starts[:-1], ends[:-1], values[:-1]
+            if not BIGWIG_NUMPY:
+                starts, ends, values = starts.tolist(), ends.tolist(), values.tolist()
+            if len(starts):
+                self.bw.addEntries([chrom] * len(starts), starts, ends=ends, values=values)
+                self.num_entries += len(starts)
+        return self
+
+    def close(self):
+        """
+        Closes the bigwig file and returns the number of entries written.
+        """
+        if self.last_run is not None:
+            chrom, start, end, value = self.last_run
+            self.bw.addEntries([chrom], [start], ends=[end], values=[value])
+            self.num_entries += 1
+        self.bw.close()
+        return self.num_entries
+
+
+class BedGraphEntryWriter(object):
+    """
+    Writes coverage runs, as returned by writeTempBedGraphRuns, to a bedgraph
+    file. The temporary files of the runs are appended to the file and
+    removed. As for BigWigEntryWriter, the last run added is held back,
+    to be joined with the first run of the next region.
+    """
+
+    def __init__(self, bedGraphPath):
+        self.file = open(bedGraphPath, 'wb')
+        self.last_run = None
+
+    def add_runs(self, runs):
+        """
+        Adds the runs of a region. Meant to be used as mapReduce reducer,
+        hence the writer is returned.
+        """
+        chrom, starts, ends, values, tempfilename = runs
+        last_run, starts, ends, values = joinRuns(self.last_run, chrom, starts, ends, values)
+        if len(starts):
+            if last_run is not None:
+                self._write(*last_run)
+            if len(starts) > 1:
+                self._write(chrom, starts[0], ends[0], values[0])
+            # the runs between the first and the last one
+            if tempfilename:
+                appendTempFile(self.file, tempfilename)
+            self.last_run = (chrom, int(starts[-1]), int(ends[-1]), float(values[-1]))
+        return self
+
+    def _write(self, chrom, start, end, value):
+        self.file.write("{}\t{}\t{}\t{:g}\n".format(chrom, start, end, value).encode())
+
+    def close(self):
+        """
+        Closes the bedgraph file.
+        """
+        if self.last_run is not None:
+            self._write(*self.last_run)
+            self.last_run = None
+        self.file.close()
 
 
 def bedGraphToBigWig(chromSizes, bedGraphPath, bigWigPath, sort=True):
     """
     takes a bedgraph file, orders it and converts it to
     a bigwig file using pyBigWig.
+
+    If sort is False, the bedgraph file must already be sorted
+    by chromosome name and start position.
     """
 
     from tempfile import NamedTemporaryFile
@@ -287,19 +764,7 @@ def bedGraphToBigWig(chromSizes, bedGraphPath, bigWigPath, sort=True):
 
     # Make a list of tuples for the bigWig header, this MUST be sorted identically to the bedGraph file
     sort_cmd = cfg.config.get('external_tools', 'sort')
-    _file = NamedTemporaryFile(delete=False)
-    for chrom, size in chromSizes:
-        _file.write(toBytes("{}\t{}\n".format(chrom, size)))
-    _file.close()
-    system("LC_ALL=C {} -k1,1 -k2,2n {} > {}.sorted".format(sort_cmd, _file.name, _file.name))
-    cl = []
-    f = open("{}.sorted".format(_file.name))
-    for line in f:
-        chrom, chromLen = line.split()
-        cl.append((chrom, int(chromLen)))
-    f.close()
-    remove(_file.name)
-    remove("{}.sorted".format(_file.name))
+    cl = sorted([(chrom, int(size)) for chrom, size in chromSizes])
 
     # check if the file is empty
     if os.stat(bedGraphPath).st_size < 10:
@@ -320,10 +785,20 @@ def bedGraphToBigWig(chromSizes, bedGraphPath, bigWigPath, sort=True):
     assert(bw is not None)
     # The lack of maxZooms will change the results a bit, perhaps the defaults are better
     bw.addHeader(cl, maxZooms=10)
+    # the entries are added in batches, one pyBigWig call per interval is slow
+    chroms, starts, ends, values = [], [], [], []
     f = open(bedGraphPath)
     for line in f:
         interval = line.split()
-        bw.addEntries([interval[0]], [int(interval[1])], ends=[int(interval[2])], values=[float(interval[3])])
+        chroms.append(interval[0])
+        starts.append(int(interval[1]))
+        ends.append(int(interval[2]))
+        values.append(float(interval[3]))
+        if len(chroms) == 100000:
+            bw.addEntries(chroms, starts, ends=ends, values=values)
+            chroms, starts, ends, values = [], [], [], []
+    if len(chroms):
+        bw.addEntries(chroms, starts, ends=ends, values=values)
     f.close()
     bw.close()
 
@@ -354,6 +829,33 @@ def getGenomeChunkLength(bamHandlers, tile_size):
     return genomeChunkLength
 
 
+def applyTileFunction(func, coverage, func_args):
+    """
+    Returns the vector of values of func for each tile, i.e. each row, of
+    the coverage matrix (with a column per input file).
+
+    func is called as func(tile_coverage, func_args) for one tile after the
+    other, unless it has an 'arrayFunction' attribute. This is a function
+    called as arrayFunction(coverage, func_args) that computes the values
+    of all tiles at once, which is much faster for small tiles.
+
+    >>> coverage = np.array([[1.0], [2.0], [np.nan]])
+    >>> applyTileFunction(scaleCoverage, coverage, {'scaleFactor': 2}).tolist()
+    [2.0, 4.0, nan]
+    >>> applyTileFunction(lambda x, args: x[0] + 1, coverage, None).tolist()
+    [2.0, 3.0, nan]
+    """
+    coverage = np.asarray(coverage, dtype='float64')
+    arrayFunction = getattr(func, 'arrayFunction', None)
+    if arrayFunction is not None:
+        return np.asarray(arrayFunction(coverage, func_args), dtype='float64')
+
+    tile_values = np.zeros(coverage.shape[0])
+    for tileIndex in range(coverage.shape[0]):
+        tile_values[tileIndex] = func(coverage[tileIndex, :], func_args)
+    return tile_values
+
+
 def scaleCoverage(tile_coverage, args):
     """
     tileCoverage should be an list with only one element
@@ -361,8 +863,27 @@ def scaleCoverage(tile_coverage, args):
     return args['scaleFactor'] * tile_coverage[0]
 
 
+def scaleCoverageArray(coverage, args):
+    """
+    Same as scaleCoverage, for a coverage matrix with a row per tile
+    """
+    return args['scaleFactor'] * coverage[:, 0]
+
+
 def ratio(tile_coverage, args):
     """
     tileCoverage should be an list of two elements
     """
     return float(tile_coverage[0]) / tile_coverage[1]
+
+
+def ratioArray(coverage, args):
+    """
+    Same as ratio, for a coverage matrix with a row per tile
+    """
+    return coverage[:, 0] / coverage[:, 1]
+
+
+# see applyTileFunction
+scaleCoverage.arrayFunction = scaleCoverageArray
+ratio.arrayFunction = ratioArray
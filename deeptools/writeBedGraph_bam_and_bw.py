@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import os
-import shutil
 import tempfile
 import numpy as np
 import sys
@@ -53,6 +52,8 @@ def writeBedGraph_worker(
     using the funcArgs
 
     tileSize
+
+    smoothLength is not used, see writeBedGraph.
     """
     if start > end:
         raise NameError("start position ({0}) bigger than "
@@ -61,20 +62,19 @@ def writeBedGraph_worker(
     coverage = []
 
     for indexFile, fileFormat in bamOrBwFileList:
+        # the handles are opened once per process (see bamHandler.getHandle)
         if fileFormat == 'bam':
-            bamHandle = bamHandler.openBam(indexFile)
+            bamHandle = bamHandler.getHandle(indexFile)
             coverage.append(getCoverageFromBam(
                 bamHandle, chrom, start, end, tileSize,
                 defaultFragmentLength, extendPairedEnds,
                 True))
-            bamHandle.close()
         elif fileFormat == 'bigwig':
-            bigwigHandle = pyBigWig.open(indexFile)
+            bigwigHandle = bamHandler.getHandle(indexFile)
             coverage.append(
                 getCoverageFromBigwig(
                     bigwigHandle, chrom, start, end,
                     tileSize, missingDataAsZero))
-            bigwigHandle.close()
 
     # is /dev/shm available?
     # working in this directory speeds the process
@@ -83,63 +83,36 @@ def writeBedGraph_worker(
     except OSError:
         _file = tempfile.NamedTemporaryFile(delete=False)
 
-    previousValue = None
     lengthCoverage = len(coverage[0])
-    for tileIndex in range(lengthCoverage):
-
-        tileCoverage = []
-        for index in range(len(bamOrBwFileList)):
-            if smoothLength > 0:
-                vectorStart, vectorEnd = getSmoothRange(
-                    tileIndex, tileSize, smoothLength, lengthCoverage)
-                tileCoverage.append(
-                    np.mean(coverage[index][vectorStart:vectorEnd]))
-            else:
-                try:
-                    tileCoverage.append(coverage[index][tileIndex])
-                except IndexError:
-                    sys.exit("Chromosome {} probably not in one of the bigwig "
-                             "files. Remove this chromosome from the bigwig file "
-                             "to continue".format(chrom))
+    if min([len(x) for x in coverage]) < lengthCoverage:
+        sys.exit("Chromosome {} probably not in one of the bigwig "
+                 "files. Remove this chromosome from the bigwig file "
+                 "to continue".format(chrom))
+    # a row per tile and a column per file
+    tileCoverage = np.zeros((lengthCoverage, len(bamOrBwFileList)))
+    for index in range(len(bamOrBwFileList)):
+        tileCoverage[:, index] = coverage[index][:lengthCoverage]
 
 #        if  zerosToNans == True and sum(tileCoverage) == 0.0:
 #            continue
 
-        value = func(tileCoverage, funcArgs)
+    values = applyTileFunction(func, tileCoverage, funcArgs)
 
-        if fixed_step:
+    if fixed_step:
+        for tileIndex, value in enumerate(values):
             writeStart = start + tileIndex * tileSize
             writeEnd = min(writeStart + tileSize, end)
-            try:
-                _file.write(toBytes("%s\t%d\t%d\t%.2f\n" % (chrom, writeStart,
-                                                            writeEnd, value)))
-            except TypeError:
-                _file.write(toBytes("{}\t{}\t{}\t{}\n".format(chrom, writeStart,
-                                                              writeEnd, value)))
-        else:
-            if previousValue is None:
-                writeStart = start + tileIndex * tileSize
-                writeEnd = min(writeStart + tileSize, end)
-                previousValue = value
-
-            elif previousValue == value:
-                writeEnd = min(writeEnd + tileSize, end)
-
-            elif previousValue != value:
-                if not np.isnan(previousValue):
-                    _file.write(
-                        toBytes("{0}\t{1}\t{2}\t{3:g}\n".format(chrom, writeStart,
-                                                                writeEnd, previousValue)))
-                previousValue = value
-                writeStart = writeEnd
-                writeEnd = min(writeStart + tileSize, end)
-
-    if not fixed_step:
-        # write remaining value if not a nan
-        if previousValue and writeStart != end and \
-                not np.isnan(previousValue):
-            _file.write(toBytes("{0}\t{1}\t{2}\t{3:g}\n".format(chrom, writeStart,
-                                                                end, previousValue)))
+            _file.write(toBytes("%s\t%d\t%d\t%.2f\n" % (chrom, writeStart,
+                                                        writeEnd, value)))
+    else:
+        writeStarts, writeEnds, runValues = coverageRuns(values, start, end, tileSize)
+        if lengthCoverage and values[-1] == 0:
+            # a run of zeros at the end of the region is not written
+            writeStarts, writeEnds, runValues = writeStarts[:-1], writeEnds[:-1], runValues[:-1]
+        for writeStart, writeEnd, value in zip(writeStarts, writeEnds, runValues):
+            _file.write(
+                toBytes("{0}\t{1}\t{2}\t{3:g}\n".format(chrom, writeStart,
+                                                        writeEnd, value)))
 
     tempFileName = _file.name
     _file.close()
@@ -158,7 +131,12 @@ def writeBedGraph(
     and a value for each tile that corresponds to the given function
     and that is related to the coverage underlying the tile.
 
+    Smoothing (smoothLength) is not supported.
     """
+    if smoothLength:
+        # the tiles at the edges of each chunk would be smoothed
+        # without the tiles of the adjacent chunks
+        raise ValueError("smoothLength is not supported")
 
     bamHandlers = [bamHandler.openBam(indexedFile) for
                    indexedFile,
@@ -203,37 +181,34 @@ def writeBedGraph(
         # in case a region is used, append the tilesize
         region += ":{}".format(tileSize)
 
-    res = mapReduce.mapReduce((tileSize, fragmentLength, bamOrBwFileList,
-                               func, funcArgs, extendPairedEnds, smoothLength,
-                               missingDataAsZero, fixed_step),
-                              writeBedGraph_wrapper,
-                              chromNamesAndSize,
-                              genomeChunkLength=genomeChunkLength,
-                              region=region,
-                              blackListFileName=blackListFileName,
-                              numberOfProcessors=numberOfProcessors,
-                              verbose=verbose)
-
-    # concatenate intermediary bedgraph files
-    outFile = open(outputFileName + ".bg", 'wb')
-    for tempFileName in res:
-        if tempFileName:
-            # concatenate all intermediate tempfiles into one
-            # bedgraph file
-            _foo = open(tempFileName, 'rb')
-            shutil.copyfileobj(_foo, outFile)
-            _foo.close()
-            os.remove(tempFileName)
+    # concatenate intermediary bedgraph files in the order of the chunks,
+    # the chromosomes being processed in the order of their names. Thus,
+    # the result is sorted as expected by bedGraphToBigWig.
+    if format == 'bedgraph':
+        outFile = open(outputFileName, 'wb')
+    else:
+        outFile = open(outputFileName + ".bg", 'wb')
+    mapReduce.mapReduce((tileSize, fragmentLength, bamOrBwFileList,
+                         func, funcArgs, extendPairedEnds, smoothLength,
+                         missingDataAsZero, fixed_step),
+                        writeBedGraph_wrapper,
+                        sorted(chromNamesAndSize),
+                        genomeChunkLength=genomeChunkLength,
+                        region=region,
+                        blackListFileName=blackListFileName,
+                        numberOfProcessors=numberOfProcessors,
+                        verbose=verbose,
+                        reducer=appendTempFile,
+                        reducerInit=outFile)
 
     bedGraphFile = outFile.name
     outFile.close()
     if format == 'bedgraph':
-        os.rename(bedGraphFile, outputFileName)
         if debug:
             print("output file: %s" % (outputFileName))
     else:
         bedGraphToBigWig(
-            chromNamesAndSize, bedGraphFile, outputFileName, True)
+            chromNamesAndSize, bedGraphFile, outputFileName, False)
         if debug:
             print("output file: %s" % (outputFileName))
         os.remove(bedGraphFile)
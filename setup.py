@@ -137,7 +137,8 @@ setup(
              'bin/bamPEFragmentSize', 'bin/computeMatrix', 'bin/plotProfile',
              'bin/computeGCBias', 'bin/correctGCBias', 'bin/multiBigwigSummary',
              'bin/bigwigCompare', 'bin/plotCoverage', 'bin/plotPCA', 'bin/plotCorrelation',
-             'bin/plotEnrichment', 'bin/deeptools', 'bin/computeMatrixOperations'],
+             'bin/plotEnrichment', 'bin/deeptools', 'bin/computeMatrixOperations',
+             'bin/bamFragmentCache'],
     include_package_data=True,
     package_data={'': ['config/deeptools.cfg']},
     url='http://pypi.python.org/pypi/deepTools/',